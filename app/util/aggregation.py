@@ -0,0 +1,176 @@
+import os
+import math
+import threading
+import numpy as np
+import pandas as pd
+from cachetools import LRUCache
+from app.util.dataset_query import DatasetQuery, RESERVED_PARAMS, parse_dataset_query, apply_dataset_query
+
+# Server-side aggregation for dataset endpoints, so charts can be drawn from
+# a few aggregated series instead of the whole normalized dataset.
+#
+# Query string format:
+#   group_by=a,b             group rows by these columns (optional)
+#   value=col                numeric column the metrics are computed over
+#   metrics=count,mean,...   any of count, sum, mean, min, max, median,
+#                            quantiles, histogram (default: count, plus mean
+#                            when a value column is given)
+#   quantiles=0.25,0.5,0.75  quantiles to compute
+#   bins=10                  histogram bins, shared by all groups
+#   col=value, col__gt=...   row filters, as for /normalized-data
+#
+# Results are memoized per dataset version and query.
+
+AGGREGATE_PARAMS = {'group_by', 'value', 'metrics', 'quantiles', 'bins'}
+AGGREGATE_METRICS = ['count', 'sum', 'mean', 'min', 'max', 'median', 'quantiles', 'histogram']
+DEFAULT_QUANTILES = [0.25, 0.5, 0.75]
+DEFAULT_BINS = 10
+MAX_BINS = 200
+AGGREGATE_MAX_GROUPS = int(os.getenv('BM_AGGREGATE_MAX_GROUPS', 1000))
+AGGREGATE_CACHE_SIZE = int(os.getenv('BM_AGGREGATE_CACHE_SIZE', 256))
+
+_results = LRUCache(maxsize=AGGREGATE_CACHE_SIZE)
+_results_lock = threading.Lock()
+
+class AggregateQuery:
+    def __init__(self, group_by=None, value=None, metrics=None, quantiles=None, bins=DEFAULT_BINS, filters=None):
+        self.group_by = group_by or []
+        self.value = value
+        self.metrics = metrics or (['count', 'mean'] if value else ['count'])
+        self.quantiles = quantiles or DEFAULT_QUANTILES
+        self.bins = bins
+        self.filters = filters or []
+
+    def cache_key(self):
+        return (
+            tuple(self.group_by), self.value, tuple(self.metrics), tuple(self.quantiles), self.bins,
+            tuple(sorted(self.filters)),
+        )
+
+def _split(value):
+    return [part.strip() for part in value.split(',') if part.strip()]
+
+# Function to parse request arguments into an AggregateQuery
+def parse_aggregate_query(args, columns):
+    filters = parse_dataset_query(args, columns, RESERVED_PARAMS | AGGREGATE_PARAMS).filters
+    query = AggregateQuery(filters=filters)
+    columns = set(columns)
+
+    query.group_by = _split(args.get('group_by', ''))
+    for name in query.group_by + ([args['value']] if args.get('value') else []):
+        if name not in columns:
+            raise ValueError(f"Unknown column '{name}'")
+    query.value = args.get('value') or None
+
+    if args.get('metrics'):
+        query.metrics = _split(args['metrics'])
+    elif query.value:
+        query.metrics = ['count', 'mean']
+    for metric in query.metrics:
+        if metric not in AGGREGATE_METRICS:
+            raise ValueError(f"Unknown metric '{metric}', expected one of {', '.join(AGGREGATE_METRICS)}")
+    if query.value is None and set(query.metrics) - {'count'}:
+        raise ValueError("'value' is required for metrics other than count")
+
+    if args.get('quantiles'):
+        try:
+            query.quantiles = [float(q) for q in _split(args['quantiles'])]
+        except ValueError:
+            raise ValueError("'quantiles' must be numbers between 0 and 1")
+        if not all(0 <= q <= 1 for q in query.quantiles):
+            raise ValueError("'quantiles' must be numbers between 0 and 1")
+    if args.get('bins'):
+        try:
+            query.bins = int(args['bins'])
+        except ValueError:
+            raise ValueError(f"'bins' must be an integer, got '{args['bins']}'")
+        if not 1 <= query.bins <= MAX_BINS:
+            raise ValueError(f"'bins' must be between 1 and {MAX_BINS}")
+    return query
+
+def _to_json_value(value):
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and math.isnan(value):
+        return None
+    return value
+
+def _histogram(values, group_codes, edges):
+    # Bin every value once, then count bins per group
+    bin_index = np.clip(np.searchsorted(edges, values, side='right') - 1, 0, len(edges) - 2)
+    return pd.crosstab(group_codes, bin_index).reindex(columns=range(len(edges) - 1), fill_value=0)
+
+# Function to compute an AggregateQuery over a DataFrame
+def aggregate(data, query):
+    total, data = apply_dataset_query(data, DatasetQuery(filters=query.filters))
+
+    if query.group_by:
+        grouper = data.groupby(query.group_by, dropna=False, sort=True)
+        group_codes = grouper.ngroup().to_numpy()
+        sizes = grouper.size()
+        group_keys = sizes.index.to_frame(index=False)
+        counts = sizes.to_numpy()
+    else:
+        group_codes = np.zeros(len(data), dtype=int)
+        group_keys = pd.DataFrame(index=[0])
+        counts = np.array([len(data)])
+
+    columns = {'count': counts}
+    histogram_edges = None
+    if query.value:
+        values = pd.to_numeric(data[query.value], errors='coerce')
+        grouped = values.groupby(group_codes)
+        for metric in ('sum', 'mean', 'min', 'max', 'median'):
+            if metric in query.metrics:
+                columns[metric] = getattr(grouped, metric)().reindex(range(len(group_keys)))
+        if 'quantiles' in query.metrics:
+            columns['quantiles'] = grouped.quantile(query.quantiles).unstack().reindex(range(len(group_keys)))
+        if 'histogram' in query.metrics:
+            present = values.notna().to_numpy()
+            finite = values[present].to_numpy(dtype=float)
+            if len(finite):
+                histogram_edges = np.histogram_bin_edges(finite, bins=query.bins)
+                columns['histogram'] = _histogram(finite, group_codes[present], histogram_edges).reindex(
+                    range(len(group_keys)), fill_value=0)
+
+    groups = []
+    for position in range(len(group_keys)):
+        group = {'key': {column: _to_json_value(group_keys[column].iloc[position]) for column in query.group_by}}
+        for metric in query.metrics:
+            if metric == 'quantiles':
+                row = columns['quantiles'].iloc[position]
+                group['quantiles'] = {str(q): _to_json_value(row[q]) for q in query.quantiles}
+            elif metric == 'histogram':
+                group['histogram'] = columns['histogram'].iloc[position].tolist() if 'histogram' in columns else []
+            else:
+                value = columns[metric][position] if metric == 'count' else columns[metric].iloc[position]
+                group[metric] = _to_json_value(value)
+        groups.append(group)
+
+    truncated = len(groups) > AGGREGATE_MAX_GROUPS
+    if truncated:
+        # Keep the largest groups, still in key order
+        largest = sorted(range(len(groups)), key=lambda i: -columns['count'][i])[:AGGREGATE_MAX_GROUPS]
+        groups = [groups[i] for i in sorted(largest)]
+
+    result = {
+        'groupBy': query.group_by,
+        'value': query.value,
+        'rows': total,
+        'groups': groups,
+        'truncated': truncated,
+    }
+    if histogram_edges is not None:
+        result['histogramEdges'] = [float(edge) for edge in histogram_edges]
+    return result
+
+# Function to aggregate a dataset, memoized per dataset version
+def aggregate_cached(data, version, query):
+    key = (version, query.cache_key())
+    with _results_lock:
+        result = _results.get(key)
+    if result is None:
+        result = aggregate(data, query)
+        with _results_lock:
+            _results[key] = result
+    return result
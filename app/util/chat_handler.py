@@ -1,61 +1,55 @@
 import os
 import json
 import logging
-import requests
-import subprocess
-import tempfile
 import re
+import time
 import base64
-from langchain.embeddings.openai import OpenAIEmbeddings
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain.vectorstores import Chroma
-from langchain.document_loaders import PyPDFium2Loader
-from langchain.chains.question_answering import load_qa_chain
-from langchain.chat_models import ChatOpenAI
-from langchain.chains import create_history_aware_retriever, create_retrieval_chain
-from langchain.chains.combine_documents import create_stuff_documents_chain
-from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
-from langchain_core.messages import AIMessage, HumanMessage
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from app.util.dataset_cache import normalized_data_path, dataset_version
+from app.util.sandbox_pool import run_analysis_code, run_analysis_candidates
+from app.util.execution_cache import execution_cache
+from app.util.sql_engine import get_sql_dataset, format_query_result, SQLQueryError
+from app.util.openai_client import chat_completion, completion_text, stream_chat_completion
+from app.util.intent_router import route_intent
+from app.util.document_index import get_document_index, document_context
+from app.util.dataset_profile import load_profile, profile_path, answer_from_profile
+from app.util.prompt_metadata import render_metadata
+from app.util.token_count import count_tokens, count_message_tokens, record_usage, record_response_usage
+from app.util.session_store import get_session_store, trim_session_context
+from app.util.response_cache import response_cache, response_cache_key, RESPONSE_CACHE_PRIOR_TURN
 
 logger = logging.getLogger(__name__)
 
-# In-memory storage for session contexts and PDFQuery instances
-session_contexts = {}
-pdf_query_instances = {}
-
-class PDFQuery:
-    def __init__(self, openai_api_key=None) -> None:
-        self.embeddings = OpenAIEmbeddings(openai_api_key=openai_api_key)
-        os.environ["ICED_DEMO_API_KEY"] = openai_api_key
-        self.text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
-        self.llm = ChatOpenAI(temperature=0, openai_api_key=openai_api_key)
-        self.chain = None
-        self.db = None
-
-    def ask(self, question: str, chat_history: list) -> str:
-        if self.chain is None:
-            response = "Please, add a document."
-        else:
-            docs = self.db.get_relevant_documents(question)
-            response = self.chain.run(input_documents=docs, question=question, chat_history=chat_history)
-        return response
-
-    def ingest(self, file_path: os.PathLike) -> None:
-        loader = PyPDFium2Loader(file_path)
-        documents = loader.load()
-        splitted_documents = self.text_splitter.split_documents(documents)
-        self.db = Chroma.from_documents(splitted_documents, self.embeddings).as_retriever()
-        self.chain = load_qa_chain(self.llm, chain_type="stuff")
-
-    def ingest_folder(self, folder_path: os.PathLike) -> None:
-        for filename in os.listdir(folder_path):
-            if filename.endswith('.pdf'):
-                file_path = os.path.join(folder_path, filename)
-                self.ingest(file_path)
-
-    def forget(self) -> None:
-        self.db = None
-        self.chain = None
+# Answer general questions with excerpts of the package's PDF reports
+DOCUMENT_RETRIEVAL = os.getenv('BM_DOCUMENT_RETRIEVAL', '1') != '0'
+
+# Number of code candidates generated for the first analysis attempt. With
+# more than one, the candidates run at once and the first that succeeds is
+# used; failures fall back to the error-guided retries. 'n' asks for all
+# candidates in one completion, 'parallel' makes one request per candidate
+ANALYSIS_CANDIDATES = int(os.getenv('BM_ANALYSIS_CANDIDATES', 1))
+ANALYSIS_CANDIDATE_REQUESTS = os.getenv('BM_ANALYSIS_CANDIDATE_REQUESTS', 'n')
+# Candidates generated at the usual low temperature would be nearly identical
+ANALYSIS_CANDIDATE_TEMPERATURE = float(os.getenv('BM_ANALYSIS_CANDIDATE_TEMPERATURE', 0.7))
+ANALYSIS_MAX_TRIES = 3
+# Try to answer analysis questions with one SQL query over the in-process
+# SQLite copy of the dataset before generating Python code. Off by default:
+# questions SQL cannot answer pay for an extra generation round trip
+ANALYSIS_SQL_FIRST = os.getenv('BM_ANALYSIS_SQL_FIRST', '0') == '1'
+ANALYSIS_TIMING_HISTORY = int(os.getenv('BM_ANALYSIS_TIMING_HISTORY', 1000))
+
+_analysis_timings = deque(maxlen=ANALYSIS_TIMING_HISTORY)
+_analysis_timings_lock = threading.Lock()
+
+# PDFQuery moved to app.util.pdf_query so the langchain stack is only imported
+# when it is used; keep it importable from here
+def __getattr__(name):
+    if name == 'PDFQuery':
+        from app.util.pdf_query import PDFQuery
+        return PDFQuery
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 def check_if_action_requested(user_message, session_context):
     prompt = f"""
@@ -68,32 +62,16 @@ def check_if_action_requested(user_message, session_context):
     Please also include a brief explanation of your answer.
     """
 
-    headers = {
-        'Content-Type': 'application/json',
-        'Authorization': f"Bearer {os.getenv('ICED_DEMO_API_KEY')}",
-    }
-
-    response = requests.post(
-        'https://api.openai.com/v1/chat/completions',
-        json={
-            'model': 'gpt-4o-2024-05-13',
-            'messages': [{'role': 'system', 'content': 'You are an assistant that determines user intent.'}] +
-                        session_context + [
-                        {'role': 'user', 'content': prompt},
-                    ],
-            'max_tokens': 1000,
-            'n': 1,
-            'stop': None,
-            'temperature': 0.1,
-        },
-        headers=headers
-    )
-
-    response_data = response.json()
+    messages = [{'role': 'system', 'content': 'You are an assistant that determines user intent.'}] + \
+        session_context + [
+            {'role': 'user', 'content': prompt},
+        ]
+    response_data = chat_completion(messages, max_tokens=1000, temperature=0.1)
+    record_response_usage('intent', messages, response_data)
 
     logger.info(f"GPT response_data to action request: {response_data}")
 
-    gpt_response = response_data['choices'][0]['message']['content'].strip()
+    gpt_response = completion_text(response_data)
 
     logger.info(f"GPT response to action request: {gpt_response}")
 
@@ -140,38 +118,145 @@ def string_to_base64(input_string):
     base64_string = base64_bytes.decode('utf-8')
     return base64_string
 
-def trim_metadata(metadata):
-    return [
-        {
-            "column": col["name"],
-            "data_type": col["type"],
-            **({"potential_values": col["potentialValues"]} if col["type"] != "float64" else {})
-        }
-        for col in metadata
-    ]
-
 def update_session_context(session_context, user_msg, assistant_msg):
     session_context.append({'role': 'user', 'content': user_msg})
     session_context.append({'role': 'assistant', 'content': assistant_msg})
-    # Keep only the first system message and the last two pairs of user/assistant messages
-    session_context = [session_context[0]] + session_context[-4:]
+    # Keep the system message and the latest user/assistant messages that fit in the token budget
+    session_context[:] = trim_session_context(session_context)
+
+# Function to generate a model reply, yielding ('token', ...) events as the
+# text arrives when streaming; the complete text is the generator's return value
+def generate_reply(stage, messages, stream_tokens, **kwargs):
+    if not stream_tokens:
+        response_data = chat_completion(messages, **kwargs)
+        logger.info(f"response_data {stage}: {response_data}")
+        record_response_usage(stage, messages, response_data)
+        return completion_text(response_data)
+    parts = []
+    for text in stream_chat_completion(messages, **kwargs):
+        parts.append(text)
+        yield 'token', {'stage': stage, 'text': text}
+    reply = ''.join(parts).strip()
+    record_usage(stage, count_message_tokens(messages), count_tokens(reply))
+    return reply
+
+# Function to generate several replies for the same messages, in one
+# completion with n choices or in parallel requests
+def generate_candidates(stage, messages, count, **kwargs):
+    if ANALYSIS_CANDIDATE_REQUESTS == 'parallel':
+        with ThreadPoolExecutor(max_workers=count) as executor:
+            responses = list(executor.map(lambda _: chat_completion(messages, **kwargs), range(count)))
+    else:
+        responses = [chat_completion(messages, n=count, **kwargs)]
+    replies = []
+    for response_data in responses:
+        logger.info(f"response_data {stage}: {response_data}")
+        record_response_usage(stage, messages, response_data)
+        replies.extend(completion_text(response_data, index) for index in range(len(response_data['choices'])))
+    return replies
+
+def split_analysis_reply(bot_message, user_message):
+    code_match = bot_message.split('```python')
+    if len(code_match) > 1:
+        return code_match[0], code_match[1].split('```')[0].strip()
+    return f'This is a data analysis for query: {user_message}', bot_message
+
+# Function to answer an analysis question with a SQL query, yielding code and
+# execution events; returns the query output and the timing of the attempt,
+# with no output when the question needs Python or the query failed
+def run_sql_analysis(user_message, session_context, dataset_path):
+    started = time.monotonic()
+    database = get_sql_dataset(dataset_path)
+    prompt = f"""
+    The dataset is also loaded in a SQLite table named 'dataset' with these columns:
+{database.schema}
+    Text values in the table are lowercase.
+    If the user's request can be answered with a single SQLite SELECT query over this table, write that query.
+    If it cannot (for example statistical tests, regressions or anything else SQL cannot compute), answer NO_SQL.
+    User's request: {user_message}
+    Answer with only the query in a ```sql block, or NO_SQL.
+    """
+    reply = yield from generate_reply(
+        'sql',
+        session_context + [
+            {'role': 'user', 'content': prompt},
+        ],
+        False,
+        max_tokens=500,
+        temperature=0.1,
+    )
+    generation_seconds = time.monotonic() - started
+    attempt = {'attempt': 0, 'language': 'sql', 'generationSeconds': round(generation_seconds, 3),
+               'executionSeconds': 0.0, 'succeeded': False}
 
-def handle_chat_request(token, data):
+    code_match = reply.split('```sql')
+    if 'NO_SQL' in reply or len(code_match) < 2:
+        return None, attempt
+    sql = code_match[1].split('```')[0].strip()
+    yield 'code', {'language': 'sql', 'code': sql, 'summary': code_match[0].strip()}
+
+    try:
+        result = database.query(sql)
+    except SQLQueryError as e:
+        logger.info(f"SQL analysis failed, falling back to Python: {e}")
+        attempt['executionSeconds'] = round(time.monotonic() - started - generation_seconds, 3)
+        yield 'execution', {'language': 'sql', 'output': f"Error executing SQL query: {e}", 'succeeded': False,
+                            'seconds': attempt['executionSeconds']}
+        return None, attempt
+
+    attempt['executionSeconds'] = round(result['seconds'], 3)
+    output = format_query_result(result)
+    # No rows usually means a filter did not match the data as the model expected
+    attempt['succeeded'] = bool(result['rows'])
+    yield 'execution', {'language': 'sql', 'output': output, 'succeeded': attempt['succeeded'],
+                        'seconds': attempt['executionSeconds']}
+    return (output if attempt['succeeded'] else None), attempt
+
+# Function to record how long an analysis took, over all its attempts
+def record_analysis_timing(candidates, attempts, seconds, succeeded):
+    with _analysis_timings_lock:
+        _analysis_timings.append((candidates, seconds, len(attempts), succeeded))
+    logger.info(f"Analysis with {candidates} candidate(s) took {seconds:.2f}s over {len(attempts)} attempt(s): {attempts}")
+
+def _percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))] if values else None
+
+# Function to get the latency of recent analyses per number of candidates
+def analysis_timing_stats():
+    with _analysis_timings_lock:
+        timings = list(_analysis_timings)
+    stats = {}
+    for candidates in sorted({timing[0] for timing in timings}):
+        selected = [timing for timing in timings if timing[0] == candidates]
+        seconds = [timing[1] for timing in selected]
+        stats[str(candidates)] = {
+            'analyses': len(selected),
+            'p50Seconds': _percentile(seconds, 0.5),
+            'p90Seconds': _percentile(seconds, 0.9),
+            'p99Seconds': _percentile(seconds, 0.99),
+            'averageAttempts': sum(timing[2] for timing in selected) / len(selected),
+            'successRate': sum(1 for timing in selected if timing[3]) / len(selected),
+        }
+    return {'candidates': ANALYSIS_CANDIDATES, 'byCandidates': stats, 'executionCache': execution_cache.stats()}
+
+# Function to answer a chat message as a series of (event, payload) tuples:
+# intent, token, code and execution as each stage finishes, then final with
+# the complete response (or error)
+def iter_chat_events(token, data, stream_tokens=False):
     user_message = data['message']
     package = data['package']
     filename = data['filename']
     session_id = string_to_base64(data['package']) + string_to_base64(data['filename']) + token
 
     metadata = load_metadata(package, filename)
-    metadata = trim_metadata(metadata)
-    metadata_string = json.dumps(metadata)
+    metadata_string = render_metadata(metadata, user_message)
 
     summary = load_summary(package)
 
     logger.info(f"Summary: {summary}")
 
-    session_context = session_contexts.get(session_id, [
-        {"role": "system", "content": f"""
+    system_message = {"role": "system", "content": f"""
          You are a chatbot built to help uneducated people understand this dataset. You should take on the role of a teacher, treating the user as your student.
          Keep your responses concise, and use natural language when explaining complex topics, unless the user requests detailed analysis.
          You are a chatbot on the webpage of ICED (International Center for Evaluation & Development).
@@ -184,13 +269,56 @@ def handle_chat_request(token, data):
          Summary of the dataset:
          {summary}
 
-         You are also provided with the metadata of the dataset, which includes columns, data types, and potential values.
-         Metadata of the dataset: {metadata_string}
+         You are also provided with the metadata of the dataset, one line per column with its name, data type and values
+         (all values when there are few, otherwise the range or a few examples).
+         Metadata of the dataset:
+{metadata_string}
         """}
-    ])
+    # The system message is rebuilt for every message, as the metadata shown depends on the question
+    stored_context = get_session_store().get(session_id) or []
+    session_context = [system_message] + stored_context[1:]
+
+    try:
+        dataset_version_hash = dataset_version(normalized_data_path(package, filename))
+    except FileNotFoundError:
+        dataset_version_hash = None
+    # A follow-up question can depend on the earlier turns, so it is only
+    # cached when the key includes the previous assistant turn
+    follow_up = len(session_context) > 1
+    prior_turn = session_context[-1]['content'] if follow_up else None
+    cache_key = None
+    if dataset_version_hash and (not follow_up or RESPONSE_CACHE_PRIOR_TURN):
+        cache_key = response_cache_key(package, filename, dataset_version_hash, user_message, prior_turn)
+
+    cached = response_cache.get(cache_key)
+    if cached:
+        logger.info("Answering from the response cache")
+        update_session_context(session_context, user_message, cached['contextMessage'])
+        get_session_store().set(session_id, session_context)
+        yield 'final', dict(cached['response'], sessionId=session_id)
+        return
 
     try:
-        action_requested = check_if_action_requested(user_message, session_context[-4:])
+        profile_answer = None
+        if dataset_version_hash:
+            # The profile is only a shortcut, without it the question goes
+            # through the usual routing
+            try:
+                profile = load_profile(normalized_data_path(package, filename), profile_path(package, filename))
+                profile_answer = answer_from_profile(user_message, profile)
+            except Exception as e:
+                logger.warning(f"Dataset profile of {package}/{filename} unavailable: {e}")
+        if profile_answer:
+            logger.info("Answering from the dataset profile")
+            yield 'intent', {'action': 'ANSWER_FROM_PROFILE'}
+            update_session_context(session_context, user_message, profile_answer)
+            get_session_store().set(session_id, session_context)
+            yield 'final', {'reply': profile_answer, 'sessionId': session_id}
+            return
+
+        action_requested = route_intent(
+            user_message, lambda: check_if_action_requested(user_message, session_context[-4:]))
+        yield 'intent', {'action': action_requested}
 
         if action_requested == 'GENERATE_GRAPH':
             prompt = f"""
@@ -207,29 +335,15 @@ def handle_chat_request(token, data):
             Summary: [<summary>]
             """
 
-            headers = {
-                'Content-Type': 'application/json',
-                'Authorization': f"Bearer {os.getenv('ICED_DEMO_API_KEY')}",
-            }
-
-            response = requests.post(
-                'https://api.openai.com/v1/chat/completions',
-                json={
-                    'model': 'gpt-4o-2024-05-13',
-                    'messages': session_context + [
-                        {'role': 'user', 'content': prompt},
-                    ],
-                    'max_tokens': 1000,
-                    'n': 1,
-                    'stop': None,
-                    'temperature': 0.1,
-                },
-                headers=headers
+            bot_message = yield from generate_reply(
+                'graph',
+                session_context + [
+                    {'role': 'user', 'content': prompt},
+                ],
+                stream_tokens,
+                max_tokens=1000,
+                temperature=0.1,
             )
-
-            response_data = response.json()
-            logger.info(f"response_data graph: {response_data}")
-            bot_message = response_data['choices'][0]['message']['content'].strip()
             code_match = bot_message.split('```javascript')
 
             if len(code_match) > 1:
@@ -240,18 +354,36 @@ def handle_chat_request(token, data):
                 code = bot_message
 
             code = code.replace("const ctx = document.getElementById('graph-container').getContext('2d');", '').strip()
+            yield 'code', {'language': 'javascript', 'code': code, 'summary': summary}
 
             update_session_context(session_context, user_message, bot_message)
-            session_contexts[session_id] = session_context
+            get_session_store().set(session_id, session_context)
 
-            return {'reply': bot_message, 'graphCode': code, 'summary': summary, 'sessionId': session_id}
+            result = {'reply': bot_message, 'graphCode': code, 'summary': summary}
+            response_cache.set(cache_key, {'response': result, 'contextMessage': bot_message})
+            yield 'final', dict(result, sessionId=session_id)
         
         elif action_requested == 'PREFORM_PYTHON_ANALYSIS':
 
             num_tries = 0
             error = ""
+            succeeded = False
+            attempts = []
+            output_source = 'Python script'
+            analysis_started = time.monotonic()
+            dataset_path = normalized_data_path(package, filename)
+
+            if ANALYSIS_SQL_FIRST:
+                try:
+                    output, attempt = yield from run_sql_analysis(user_message, session_context, dataset_path)
+                    attempts.append(attempt)
+                    succeeded = output is not None
+                    if succeeded:
+                        output_source = 'SQL query'
+                except Exception as e:
+                    logger.warning(f"SQL analysis unavailable: {e}")
 
-            while num_tries < 3:
+            while num_tries < ANALYSIS_MAX_TRIES and not succeeded:
 
                 prompt = f"""{error}
                 Find the metadata of the dataset from previous context.
@@ -265,153 +397,145 @@ def handle_chat_request(token, data):
                 Do not include any other extraneous content. Only include the Python code to perform the requested analysis.
                 Before giving the Python code, could you also include a brief 1-2 sentence summary of the analysis to be performed.
                 """
-
-                headers = {
-                    'Content-Type': 'application/json',
-                    'Authorization': f"Bearer {os.getenv('ICED_DEMO_API_KEY')}",
-                }
-
-                response = requests.post(
-                    'https://api.openai.com/v1/chat/completions',
-                    json={
-                        'model': 'gpt-4o-2024-05-13',
-                        'messages': session_context + [
-                            {'role': 'user', 'content': prompt},
-                        ],
-                        'max_tokens': 2000,
-                        'n': 1,
-                        'stop': None,
-                        'temperature': 0.1,
-                    },
-                    headers=headers
-                )
-
-                response_data = response.json()
-
-                logger.info(f"response_data: {response_data}")
-
-                bot_message = response_data['choices'][0]['message']['content'].strip()
-                code_match = bot_message.split('```python')
-
-                if len(code_match) > 1:
-                    summary = code_match[0]
-                    code = code_match[1].split('```')[0].strip()
+                messages = session_context + [
+                    {'role': 'user', 'content': prompt},
+                ]
+
+                attempt_started = time.monotonic()
+                # Candidates only for the first attempt, retries are guided by its errors
+                if num_tries == 0 and ANALYSIS_CANDIDATES > 1:
+                    replies = generate_candidates(
+                        'analysis', messages, ANALYSIS_CANDIDATES, max_tokens=2000, temperature=ANALYSIS_CANDIDATE_TEMPERATURE)
                 else:
-                    summary = f'This is a data analysis for query: {user_message}'
-                    code = bot_message
-
-                dataset_path = os.path.join('data', package, 'normalized_data', f"{filename.replace('.csv', '')}_normalized.csv")
-                dataset_path = dataset_path.replace('\\', '\\\\')
-                python_code = f"""
-import pandas as pd
-
-dataset = pd.read_csv('{dataset_path}')
-{code}
-"""
-                with tempfile.NamedTemporaryFile(delete=False, suffix=".py") as temp_py_file:
-                    temp_py_file.write(python_code.encode('utf-8'))
-                    temp_py_file_path = temp_py_file.name
-
-                try:
-                    result = subprocess.check_output(['python', temp_py_file_path], stderr=subprocess.STDOUT)
-                    output = result.decode('utf-8').strip()
-                except subprocess.CalledProcessError as e:
-                    output = f"Error executing Python code: {e.output.decode('utf-8').strip()}"
-                finally:
-                    os.remove(temp_py_file_path)
-
-                logger.info(f"Output: {output}")
-
-                if "Error executing Python code" in output:
+                    bot_message = yield from generate_reply(
+                        'analysis',
+                        messages,
+                        stream_tokens,
+                        max_tokens=2000,
+                        temperature=0.1,
+                    )
+                    replies = [bot_message]
+                generation_seconds = time.monotonic() - attempt_started
+
+                candidates = [split_analysis_reply(reply, user_message) for reply in replies]
+                for index, (summary, code) in enumerate(candidates):
+                    event = {'language': 'python', 'code': code, 'summary': summary, 'attempt': num_tries + 1}
+                    if len(candidates) > 1:
+                        event['candidate'] = index + 1
+                    yield 'code', event
+
+                execution_started = time.monotonic()
+                if len(candidates) > 1:
+                    winner, results = run_analysis_candidates(dataset_path, [code for _, code in candidates])
+                else:
+                    output = run_analysis_code(dataset_path, candidates[0][1])
+                    winner = None if "Error executing Python code" in output else 0
+                    results = [{'output': output, 'succeeded': winner == 0, 'cancelled': False,
+                                'seconds': time.monotonic() - execution_started}]
+                execution_seconds = time.monotonic() - execution_started
+
+                for index, result in enumerate(results):
+                    event = {'output': result['output'], 'attempt': num_tries + 1, 'succeeded': result['succeeded'],
+                             'seconds': round(result['seconds'], 3)}
+                    if len(results) > 1:
+                        event.update(candidate=index + 1, cancelled=result['cancelled'])
+                    yield 'execution', event
+
+                attempts.append({
+                    'attempt': num_tries + 1,
+                    'candidates': len(candidates),
+                    'generationSeconds': round(generation_seconds, 3),
+                    'executionSeconds': round(execution_seconds, 3),
+                    'succeeded': winner is not None,
+                })
+
+                if winner is not None:
+                    succeeded = True
+                    output = results[winner]['output']
+                    logger.info(f"Output: {output}")
+                else:
+                    output = results[0]['output']
+                    logger.info(f"Output: {output}")
                     num_tries += 1
                     error += f"There was an error with the previous attempt at answering this prompt: {output} Try number: {num_tries}\n"
                     logger.info(f"Retrying generation of python code, Try Number: {num_tries}")
-                    continue
-                else:
-                    break
+
+            record_analysis_timing(ANALYSIS_CANDIDATES, attempts, time.monotonic() - analysis_started, succeeded)
 
             better_response_prompt = f"""
             The user has asked the following question: "{user_message}".
-            Python code was ran, generating an output.
-            The output of the Python code is: "{output}".
+            A {output_source} was run over the dataset, generating an output.
+            The output is: "{output}".
             Please generate a concise and clear response to the user's question incorporating the output.
             Please tailor your response around answering the question to someone who might not understand all scientific terms.
             """
 
-            response = requests.post(
-                'https://api.openai.com/v1/chat/completions',
-                json={
-                    'model': 'gpt-4o-2024-05-13',
-                    'messages': [
-                        {'role': 'system', 'content': 'You are an assistant that generates clear and concise responses based on the given information.'},
-                        {'role': 'user', 'content': better_response_prompt},
-                    ],
-                    'max_tokens': 500,
-                    'n': 1,
-                    'stop': None,
-                    'temperature': 0.5,
-                },
-                headers=headers
+            better_response = yield from generate_reply(
+                'answer',
+                [
+                    {'role': 'system', 'content': 'You are an assistant that generates clear and concise responses based on the given information.'},
+                    {'role': 'user', 'content': better_response_prompt},
+                ],
+                stream_tokens,
+                max_tokens=500,
+                temperature=0.5,
             )
 
-            response_data = response.json()
-            better_response = response_data['choices'][0]['message']['content'].strip()
-
             python_output_context = f"""
-            Raw Python script output: {output}\n
+            Raw {output_source} output: {output}\n
             """
 
             update_session_context(session_context, user_message, python_output_context + better_response)
-            session_contexts[session_id] = session_context
+            get_session_store().set(session_id, session_context)
 
-            return {'reply': better_response, 'sessionId': session_id}
+            result = {'reply': better_response}
+            if "Error executing Python code" not in output:
+                response_cache.set(cache_key, {'response': result, 'contextMessage': python_output_context + better_response})
+            yield 'final', dict(result, sessionId=session_id)
 
         else:
 
-            # if session_id not in pdf_query_instances:
-            #     pdf_folder_path = os.path.join('data', package, 'pdfs')
-            #     if any(filename.endswith('.pdf') for filename in os.listdir(pdf_folder_path)):
-            #         pdf_query_instances[session_id] = PDFQuery(openai_api_key=os.getenv('ICED_DEMO_API_KEY'))
-            #         pdf_query_instances[session_id].ingest_folder(pdf_folder_path)
-            #     else:
-            #         pdf_query_instances[session_id] = None
-
-            pdf_query = None #pdf_query_instances[session_id]
+            prompt = f"""
+            {user_message}
+            """
 
-            if pdf_query:
-                response = pdf_query.ask(user_message, session_context)
-            else:
+            document_index = None
+            if DOCUMENT_RETRIEVAL:
+                try:
+                    document_index = get_document_index(package)
+                except Exception as e:
+                    logger.warning(f"Document index of {package} unavailable: {e}")
+            if document_index is not None:
                 prompt = f"""
+                Excerpts from the reports about this dataset, use them if they help to answer:
+                {document_context(document_index, user_message)}
+
                 {user_message}
                 """
 
-                headers = {
-                    'Content-Type': 'application/json',
-                    'Authorization': f"Bearer {os.getenv('ICED_DEMO_API_KEY')}",
-                }
-
-                response = requests.post(
-                    'https://api.openai.com/v1/chat/completions',
-                    json={
-                        'model': 'gpt-4o-2024-05-13',
-                        'messages': session_context + [
-                            {'role': 'user', 'content': prompt},
-                        ],
-                        'max_tokens': 1000,
-                        'n': 1,
-                        'stop': None,
-                        'temperature': 0.5,
-                    },
-                    headers=headers
-                )
-
-                response_data = response.json()
-                response = response_data['choices'][0]['message']['content'].strip()
-            
+            response = yield from generate_reply(
+                'answer',
+                session_context + [
+                    {'role': 'user', 'content': prompt},
+                ],
+                stream_tokens,
+                max_tokens=1000,
+                temperature=0.5,
+            )
+
             update_session_context(session_context, user_message, response)
-            session_contexts[session_id] = session_context
+            get_session_store().set(session_id, session_context)
 
-            return {'reply': response, 'sessionId': session_id}
+            result = {'reply': response}
+            response_cache.set(cache_key, {'response': result, 'contextMessage': response})
+            yield 'final', dict(result, sessionId=session_id)
     except Exception as e:
         logger.error(f"Error in handle_chat_request: {e}")
-        return {'error': str(e)}
+        yield 'final', {'error': str(e)}
+
+def handle_chat_request(token, data):
+    response = None
+    for event, payload in iter_chat_events(token, data):
+        if event == 'final':
+            response = payload
+    return response
@@ -0,0 +1,257 @@
+import base64
+from fractions import Fraction
+import numpy as np
+import pandas as pd
+
+# Running per-column statistics for chunked ingestion.
+#
+# Each chunk of a dataset is fed through ColumnStats.update, which keeps only
+# fixed-size state per column: counts, an exact numeric sum, min/max, a KMV sketch of
+# the distinct values, the first few distinct values seen and a small sample
+# of distinct values. Peak memory therefore depends on the chunk size and not
+# on the size of the file.
+#
+# That state can be saved with to_state and restored with from_state, so rows
+# appended to a dataset later are added to the statistics of the rows already
+# ingested without reading those again.
+
+# Number of distinct values listed in full as potentialValues
+POTENTIAL_VALUES_LIMIT = 20
+# Number of sampled values listed when there are more distinct values than that
+POTENTIAL_VALUES_SAMPLE = 5
+# Size of the distinct count sketch, counts are exact below this
+DISTINCT_SKETCH_SIZE = 4096
+
+_HASH_SPACE = float(2 ** 64)
+
+NULLABLE_DTYPE_NAMES = {'Int64': 'int64', 'Float64': 'float64', 'boolean': 'bool', 'string': 'object'}
+
+# Function to hash the non-null values of a column
+def hash_values(values):
+    if values.dtype == object:
+        # Hash booleans and numbers held as objects like their own dtype
+        kind = pd.api.types.infer_dtype(values, skipna=True)
+        if kind == 'boolean':
+            values = values.astype('bool')
+        elif kind in ('integer', 'floating', 'mixed-integer-float'):
+            values = values.astype('float64')
+    elif str(values.dtype) == 'boolean':
+        values = values.astype('bool')
+    if values.dtype.kind in 'iuf':
+        # Hash numbers as floats so 1 and 1.0 from different chunks match
+        values = values.astype('float64')
+    return pd.util.hash_pandas_object(values, index=False).to_numpy()
+
+# Function to name the dtype of a chunk, nullable extension dtypes count as
+# the dtype they stand for
+def dtype_name(dtype):
+    name = str(dtype)
+    return NULLABLE_DTYPE_NAMES.get(name, name)
+
+# Function to sum finite floats exactly. Each value is an integer mantissa
+# times a power of two; mantissas are summed per exponent in two halves that
+# cannot overflow, so the total (and the average) does not depend on how the
+# values were split into chunks
+def exact_sum(values):
+    mantissas, exponents = np.frexp(values)
+    integers = (mantissas * 2.0 ** 53).astype(np.int64)
+    total = Fraction(0)
+    for exponent in np.unique(exponents):
+        selected = integers[exponents == exponent]
+        high = int((selected >> 26).sum())
+        low = int((selected & (2 ** 26 - 1)).sum())
+        total += Fraction((high << 26) + low) * Fraction(2) ** (int(exponent) - 53)
+    return total
+
+# Function to combine the dtypes of two chunks the way a full read would
+def merge_dtype_names(left, right):
+    if left is None or left == right:
+        return right
+    if right is None:
+        return left
+    if 'null' in (left, right):
+        other = right if left == 'null' else left
+        if other in ('bool', 'object'):
+            return 'object'
+        return 'float64' if other.startswith(('int', 'uint')) else other
+    numeric = ('int', 'uint', 'float')
+    if left.startswith(numeric) and right.startswith(numeric):
+        return 'float64'
+    return 'object'
+
+# K-minimum-values sketch of the distinct values of a column
+class DistinctSketch:
+    def __init__(self, size=DISTINCT_SKETCH_SIZE):
+        self.size = size
+        self.hashes = np.empty(0, dtype=np.uint64)
+
+    def update(self, hashes):
+        self.hashes = np.union1d(self.hashes, hashes)[:self.size]
+
+    def to_state(self):
+        return {'size': self.size, 'hashes': base64.b64encode(self.hashes.astype('<u8').tobytes()).decode('ascii')}
+
+    @classmethod
+    def from_state(cls, state):
+        sketch = cls(state['size'])
+        sketch.hashes = np.frombuffer(base64.b64decode(state['hashes']), dtype='<u8').astype(np.uint64)
+        return sketch
+
+    def estimate(self):
+        if len(self.hashes) < self.size:
+            return len(self.hashes)
+        return int(round((self.size - 1) / (float(self.hashes[-1]) / _HASH_SPACE)))
+
+# Reservoir of distinct values that uses the value hash as sampling priority,
+# so a value occurring many times is no more likely to be kept than one
+# occurring once and the reservoir is a uniform sample of the distinct values
+class DistinctSample:
+    def __init__(self, size=POTENTIAL_VALUES_SAMPLE):
+        self.size = size
+        self.entries = {}
+
+    def update(self, hashes, values):
+        order = np.argsort(hashes, kind='stable')[:self.size * 4]
+        for i in order:
+            self.entries.setdefault(int(hashes[i]), values[i])
+        if len(self.entries) > self.size:
+            keep = sorted(self.entries)[:self.size]
+            self.entries = {h: self.entries[h] for h in keep}
+
+    def values(self):
+        return [self.entries[h] for h in sorted(self.entries)]
+
+    def to_state(self):
+        return {'size': self.size, 'entries': [[h, self.entries[h]] for h in sorted(self.entries)]}
+
+    @classmethod
+    def from_state(cls, state):
+        sample = cls(state['size'])
+        sample.entries = {int(h): value for h, value in state['entries']}
+        return sample
+
+class ColumnStats:
+    def __init__(self, name):
+        self.name = name
+        self.dtype = None
+        self.count = 0
+        self.has_null = False
+        self.numeric_count = 0
+        self.numeric_sum = Fraction(0)
+        # Sum of infinite values, which have no exact sum
+        self.nonfinite_sum = 0.0
+        self.min = None
+        self.max = None
+        self.distinct = DistinctSketch()
+        self.sample = DistinctSample()
+        # First distinct values in order of appearance, None included
+        self.first_values = {}
+        self.first_values_overflow = False
+
+    def update(self, column_data):
+        self.count += len(column_data)
+        non_null = column_data.dropna()
+        chunk_dtype = 'null' if non_null.empty and len(column_data) else dtype_name(column_data.dtype)
+        self.dtype = merge_dtype_names(self.dtype, chunk_dtype)
+        self.has_null = self.has_null or len(non_null) < len(column_data)
+
+        numeric_data = pd.to_numeric(non_null, errors='coerce').dropna()
+        if not numeric_data.empty:
+            numeric_data = numeric_data.astype('float64')
+            self.numeric_count += len(numeric_data)
+            values = numeric_data.to_numpy()
+            finite = np.isfinite(values)
+            self.numeric_sum += exact_sum(values[finite])
+            if not finite.all():
+                self.nonfinite_sum += float(values[~finite].sum())
+            chunk_min = float(numeric_data.min())
+            chunk_max = float(numeric_data.max())
+            self.min = chunk_min if self.min is None else min(self.min, chunk_min)
+            self.max = chunk_max if self.max is None else max(self.max, chunk_max)
+
+        if not non_null.empty:
+            unique_values = non_null.drop_duplicates()
+            hashes = hash_values(unique_values)
+            self.distinct.update(hashes)
+            self.sample.update(hashes, unique_values.tolist())
+
+        if not self.first_values_overflow:
+            for value in column_data.unique().tolist():
+                value = None if pd.isna(value) else value
+                if value not in self.first_values:
+                    self.first_values[value] = True
+                    if len(self.first_values) > POTENTIAL_VALUES_LIMIT:
+                        self.first_values_overflow = True
+                        break
+
+    # Returns whether every value seen so far is a boolean or missing
+    def has_only_booleans(self):
+        values = self.sample.values() if self.first_values_overflow else list(self.first_values)
+        return any(isinstance(value, bool) for value in values) \
+            and all(value is None or isinstance(value, bool) for value in values)
+
+    # Returns the state of the statistics as JSON-serializable values
+    def to_state(self):
+        return {
+            'name': self.name,
+            'dtype': self.dtype,
+            'count': int(self.count),
+            'hasNull': self.has_null,
+            'numericCount': int(self.numeric_count),
+            'numericSum': str(self.numeric_sum),
+            'nonfiniteSum': self.nonfinite_sum,
+            'min': self.min,
+            'max': self.max,
+            'distinct': self.distinct.to_state(),
+            'sample': self.sample.to_state(),
+            'firstValues': list(self.first_values),
+            'firstValuesOverflow': self.first_values_overflow,
+        }
+
+    @classmethod
+    def from_state(cls, state):
+        stats = cls(state['name'])
+        stats.dtype = state['dtype']
+        stats.count = state['count']
+        stats.has_null = state['hasNull']
+        stats.numeric_count = state['numericCount']
+        stats.numeric_sum = Fraction(state['numericSum'])
+        stats.nonfinite_sum = state.get('nonfiniteSum', 0.0)
+        stats.min = state['min']
+        stats.max = state['max']
+        stats.distinct = DistinctSketch.from_state(state['distinct'])
+        stats.sample = DistinctSample.from_state(state['sample'])
+        stats.first_values = dict.fromkeys(state['firstValues'], True)
+        stats.first_values_overflow = state['firstValuesOverflow']
+        return stats
+
+    def unique_count(self):
+        return self.distinct.estimate() + (1 if self.has_null else 0)
+
+    def _cast(self, value):
+        if value is not None and self.dtype == 'float64' and isinstance(value, (int, float)):
+            return float(value)
+        return value
+
+    def _average(self):
+        if self.nonfinite_sum:
+            return self.nonfinite_sum
+        return float(self.numeric_sum / self.numeric_count)
+
+    def to_metadata(self):
+        unique_values = self.unique_count()
+        if not self.first_values_overflow and unique_values <= POTENTIAL_VALUES_LIMIT:
+            potential_values = list(self.first_values)
+        else:
+            potential_values = self.sample.values()
+        has_numbers = self.numeric_count > 0
+        return {
+            'name': self.name,
+            'type': 'object' if self.dtype in (None, 'null') else self.dtype,
+            'min': self.min if has_numbers else None,
+            'max': self.max if has_numbers else None,
+            'avg': self._average() if has_numbers else None,
+            'count': int(self.count),
+            'uniqueValues': int(unique_values),
+            'potentialValues': [self._cast(v) for v in potential_values]
+        }
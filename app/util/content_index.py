@@ -0,0 +1,149 @@
+import os
+import glob
+import json
+import hashlib
+import logging
+import threading
+from app.util.dataset_cache import file_content_hash
+
+logger = logging.getLogger(__name__)
+
+# Index of the content of the uploaded CSV files.
+#
+# Maps the sha256 of every data/<package>/data/<file>.csv to its package, and
+# keeps the schema (the normalized column names) of each file, so that
+# uploading a file again returns the existing package right away and a file
+# with the schema of an existing one (e.g. another wave of the same survey)
+# reuses that package's title and information sheet. The index is stored in
+# data/.content_index.json; a file is only hashed again when its mtime or size
+# changed.
+
+CONTENT_INDEX_PATH = os.getenv('BM_CONTENT_INDEX_PATH', os.path.join('data', '.content_index.json'))
+HASH_BLOCK_SIZE = 1024 * 1024
+
+# Function to copy a stream to a file, returning the sha256 of what was copied
+def copy_and_hash(source, destination, block_size=HASH_BLOCK_SIZE):
+    digest = hashlib.sha256()
+    for block in iter(lambda: source.read(block_size), b''):
+        digest.update(block)
+        destination.write(block)
+    return digest.hexdigest()
+
+# Function to hash a seekable stream from its start, leaving it at its start
+def stream_content_hash(stream, block_size=HASH_BLOCK_SIZE):
+    digest = hashlib.sha256()
+    stream.seek(0)
+    for block in iter(lambda: stream.read(block_size), b''):
+        digest.update(block)
+    stream.seek(0)
+    return digest.hexdigest()
+
+# Function to fingerprint the normalized column names of a file
+def schema_fingerprint(column_names):
+    return hashlib.sha256(json.dumps(list(column_names)).encode('utf-8')).hexdigest()
+
+def _metadata_path(package_dir, filename):
+    return os.path.join(package_dir, 'metadata', f"{filename}_metadata.json")
+
+def _file_schema(package_dir, filename):
+    try:
+        with open(_metadata_path(package_dir, filename), 'r') as f:
+            return schema_fingerprint(column['name'] for column in json.load(f))
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+class ContentIndex:
+    def __init__(self, root='data', path=CONTENT_INDEX_PATH):
+        self.root = root
+        self.path = path
+        self._lock = threading.Lock()
+        # relative csv path -> {package, file, signature, hash, schema}
+        self._entries = None
+
+    def _load(self):
+        try:
+            with open(self.path, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save(self):
+        tmp_path = f"{self.path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            with open(tmp_path, 'w') as f:
+                json.dump(self._entries, f)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.warning(f"Could not save the content index: {e}")
+
+    # Re-reads the package files, hashing only new or changed ones
+    def refresh(self):
+        with self._lock:
+            entries = self._entries if self._entries is not None else self._load()
+            current = {}
+            for path in glob.glob(os.path.join(self.root, '*', 'data', '*.csv')):
+                key = os.path.relpath(path, self.root)
+                stat = os.stat(path)
+                signature = [stat.st_mtime_ns, stat.st_size]
+                entry = entries.get(key)
+                if entry is None or entry.get('signature') != signature:
+                    package_dir = os.path.dirname(os.path.dirname(path))
+                    filename = os.path.splitext(os.path.basename(path))[0]
+                    entry = {
+                        'package': os.path.basename(package_dir),
+                        'file': os.path.basename(path),
+                        'signature': signature,
+                        'hash': file_content_hash(path),
+                        'schema': _file_schema(package_dir, filename),
+                    }
+                elif entry.get('schema') is None:
+                    # The metadata is written after the original file
+                    entry['schema'] = _file_schema(os.path.join(self.root, entry['package']), os.path.splitext(entry['file'])[0])
+                current[key] = entry
+            changed = current != self._entries
+            self._entries = current
+            if changed:
+                self._save()
+            return list(current.values())
+
+    # Adds a newly ingested file whose content hash is already known
+    def record(self, path, content_hash):
+        package_dir = os.path.dirname(os.path.dirname(path))
+        filename = os.path.splitext(os.path.basename(path))[0]
+        stat = os.stat(path)
+        with self._lock:
+            if self._entries is None:
+                self._entries = self._load()
+            self._entries[os.path.relpath(path, self.root)] = {
+                'package': os.path.basename(package_dir),
+                'file': os.path.basename(path),
+                'signature': [stat.st_mtime_ns, stat.st_size],
+                'hash': content_hash,
+                'schema': _file_schema(package_dir, filename),
+            }
+            self._save()
+
+    def _complete(self, entry):
+        package_dir = os.path.join(self.root, entry['package'])
+        filename = os.path.splitext(entry['file'])[0]
+        return (
+            os.path.exists(_metadata_path(package_dir, filename))
+            and os.path.exists(os.path.join(package_dir, 'normalized_data', f"{filename}_normalized.csv"))
+        )
+
+    # Returns the entry of a fully ingested file with this content, or None
+    def find_file(self, content_hash):
+        for entry in self.refresh():
+            if entry['hash'] == content_hash and self._complete(entry):
+                return dict(entry)
+        return None
+
+    # Returns the entry of a fully ingested file with this schema, or None
+    def find_schema(self, schema):
+        for entry in self.refresh():
+            if entry['schema'] == schema and self._complete(entry):
+                return dict(entry)
+        return None
+
+content_index = ContentIndex()
@@ -0,0 +1,362 @@
+import os
+import json
+import hashlib
+import logging
+import threading
+import contextlib
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+# Columnar cache of normalized datasets.
+#
+# Next to every <file>_normalized.csv we keep a directory holding one .npy file
+# per column plus a meta.json describing the columns. Numeric columns are
+# stored as-is, text columns are dictionary encoded (int32 codes + the list of
+# distinct strings) so every array can be memory-mapped. The cache records the
+# mtime/size of the CSV it was built from and is rebuilt when those change.
+#
+# Array files are named after the content version and replaced atomically,
+# never rewritten in place, so processes that still have the previous version
+# mapped keep reading it safely while a new version is written. Rows appended
+# to a CSV are appended to its arrays (append_columnar_cache) instead of
+# parsing the whole file again.
+#
+# Loaded datasets are kept in a process-wide store (dataset_store). Numeric
+# columns stay backed by the read-only mappings, so every process attaching a
+# dataset (web workers, sandbox workers) shares the same page cache pages
+# instead of holding its own copy. With BM_DATASET_TEXT_COLUMNS=categorical
+# text columns are exposed as categoricals over the mapped codes as well,
+# instead of being decoded into per-process object arrays. This is not the
+# default: categoricals reject values outside their categories, so generated
+# analysis code doing e.g. fillna('Unknown') fails, and groupby results and
+# profile types differ from those of a plain CSV read. Attachments are
+# reference counted: a dataset in use is never evicted, and a new version is
+# loaded as soon as the CSV changes while holders of the old one finish with
+# it.
+
+CACHE_DIR_NAME = '.columnar'
+CACHE_FORMAT_VERSION = 1
+DATASET_STORE_SIZE = int(os.getenv('BM_DATASET_STORE_SIZE', 32))
+DATASET_TEXT_COLUMNS = os.getenv('BM_DATASET_TEXT_COLUMNS', 'object')
+
+_lock = threading.Lock()
+
+def _reset_lock_in_child():
+    # A forked child (e.g. a sandbox worker) may inherit the lock held by
+    # another thread of the parent, which would never release it there
+    global _lock
+    _lock = threading.Lock()
+    dataset_store._after_fork()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_lock_in_child)
+
+# Function to build the path of the normalized csv for a package file
+def normalized_data_path(package, filename):
+    filename = filename.replace(".csv", "")
+    return os.path.join('data', package, 'normalized_data', f"{filename}_normalized.csv")
+
+# Function to locate the cache directory of a normalized csv
+def columnar_cache_dir(csv_path):
+    directory, name = os.path.split(csv_path)
+    return os.path.join(directory, CACHE_DIR_NAME, os.path.splitext(name)[0])
+
+# Function to get the cheap signature used for invalidation
+def source_signature(csv_path):
+    stat = os.stat(csv_path)
+    return {'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size}
+
+# Function to hash the content of a file
+def file_content_hash(path, block_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def _read_cache_meta(cache_dir):
+    meta_path = os.path.join(cache_dir, 'meta.json')
+    if not os.path.exists(meta_path):
+        return None
+    try:
+        with open(meta_path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        logger.warning(f"Unreadable columnar cache meta {meta_path}: {e}")
+        return None
+
+def _is_fresh(meta, signature):
+    return (
+        meta is not None
+        and meta.get('format') == CACHE_FORMAT_VERSION
+        and meta.get('source') == signature
+    )
+
+def _save_array(path, array):
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        np.save(f, array)
+    os.replace(tmp_path, path)
+
+def _write_meta(cache_dir, meta):
+    # meta.json is written last so a half-written cache is never seen as fresh
+    meta_path = os.path.join(cache_dir, 'meta.json')
+    tmp_path = f"{meta_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(meta, f)
+    os.replace(tmp_path, meta_path)
+
+def _remove_unused_arrays(cache_dir, *metas):
+    # Arrays of the previous version are kept for readers that read its
+    # meta.json just before it was replaced
+    used = {column['file'] for meta in metas if meta for column in meta['columns']}
+    for name in os.listdir(cache_dir):
+        if name.endswith('.npy') and name not in used:
+            try:
+                os.remove(os.path.join(cache_dir, name))
+            except OSError:
+                pass
+
+def _arrays_exist(cache_dir, meta):
+    return all(os.path.exists(os.path.join(cache_dir, column['file'])) for column in meta['columns'])
+
+# Function to write the columnar cache for a normalized csv
+def write_columnar_cache(csv_path):
+    signature = source_signature(csv_path)
+    version = file_content_hash(csv_path)
+    cache_dir = columnar_cache_dir(csv_path)
+
+    # Only the mtime changed: point the existing arrays at the new signature
+    previous = _read_cache_meta(cache_dir)
+    if previous is not None and previous.get('format') == CACHE_FORMAT_VERSION \
+            and previous.get('version') == version and _arrays_exist(cache_dir, previous):
+        previous['source'] = signature
+        _write_meta(cache_dir, previous)
+        return previous
+
+    data = pd.read_csv(csv_path)
+    os.makedirs(cache_dir, exist_ok=True)
+
+    columns = []
+    for i, column in enumerate(data.columns):
+        column_data = data[column]
+        array_file = f"col_{i}.{version[:16]}.npy"
+        if column_data.dtype.kind in 'biuf':
+            _save_array(os.path.join(cache_dir, array_file), column_data.to_numpy())
+            columns.append({'name': column, 'kind': 'numeric', 'file': array_file})
+        else:
+            codes, uniques = pd.factorize(column_data)
+            _save_array(os.path.join(cache_dir, array_file), codes.astype(np.int32))
+            columns.append({
+                'name': column,
+                'kind': 'dictionary',
+                'file': array_file,
+                'categories': [v.item() if isinstance(v, np.generic) else v for v in uniques],
+            })
+
+    meta = {
+        'format': CACHE_FORMAT_VERSION,
+        'source': signature,
+        'version': version,
+        'rows': int(len(data)),
+        'columns': columns,
+    }
+    _write_meta(cache_dir, meta)
+    _remove_unused_arrays(cache_dir, meta, previous)
+    logger.info(f"Wrote columnar cache for {csv_path} ({meta['rows']} rows)")
+    return meta
+
+def _append_column(cache_dir, column, values, array_file):
+    old = np.load(os.path.join(cache_dir, column['file']), mmap_mode='r')
+    if column['kind'] == 'numeric':
+        # A full read infers the same dtype only if both parts are numbers
+        # (or both booleans); missing values turn integers into floats
+        if values.dtype.kind not in 'biuf' or (values.dtype.kind == 'b') != (old.dtype.kind == 'b'):
+            return None
+        _save_array(os.path.join(cache_dir, array_file), np.concatenate([old, values.to_numpy()]))
+        return dict(column, file=array_file)
+
+    if values.dtype.kind in 'biuf' and not values.isna().all():
+        return None
+    categories = list(column['categories'])
+    codes, uniques = pd.factorize(values)
+    positions = pd.Index(categories, dtype=object).get_indexer(list(uniques))
+    for i, position in enumerate(positions):
+        if position < 0:
+            positions[i] = len(categories)
+            value = uniques[i]
+            categories.append(value.item() if isinstance(value, np.generic) else value)
+    new_codes = np.where(codes < 0, -1, positions[codes] if len(positions) else codes).astype(np.int32)
+    _save_array(os.path.join(cache_dir, array_file), np.concatenate([old, new_codes]))
+    return dict(column, file=array_file, categories=categories)
+
+# Function to extend the columnar cache of a normalized csv with the rows
+# (read back from csv) that were just appended to it, without reading the
+# rows that were there before. previous_signature is the signature of the csv
+# before the append; the cache is rebuilt in full when it was not up to date
+# with it or when a column would change kind
+def append_columnar_cache(csv_path, previous_signature, new_rows, appended_hash):
+    cache_dir = columnar_cache_dir(csv_path)
+    previous = _read_cache_meta(cache_dir)
+    if not _is_fresh(previous, previous_signature) or not _arrays_exist(cache_dir, previous) \
+            or [column['name'] for column in previous['columns']] != list(new_rows.columns):
+        return write_columnar_cache(csv_path)
+
+    # The version of the appended content follows from the previous version
+    # and the appended rows, the old rows are not hashed again
+    version = hashlib.sha256(f"{previous['version']}:{appended_hash}".encode('utf-8')).hexdigest()
+    columns = []
+    for i, column in enumerate(previous['columns']):
+        appended = _append_column(cache_dir, column, new_rows[column['name']], f"col_{i}.{version[:16]}.npy")
+        if appended is None:
+            logger.info(f"Column {column['name']} of {csv_path} changed type, rebuilding its columnar cache")
+            return write_columnar_cache(csv_path)
+        columns.append(appended)
+
+    meta = {
+        'format': CACHE_FORMAT_VERSION,
+        'source': source_signature(csv_path),
+        'version': version,
+        'rows': previous['rows'] + int(len(new_rows)),
+        'columns': columns,
+    }
+    _write_meta(cache_dir, meta)
+    _remove_unused_arrays(cache_dir, meta, previous)
+    logger.info(f"Appended {len(new_rows)} rows to the columnar cache of {csv_path} ({meta['rows']} rows)")
+    return meta
+
+# Function to read a columnar cache into a DataFrame
+def _read_columnar_cache(cache_dir, meta, text_columns=DATASET_TEXT_COLUMNS):
+    columns = {}
+    for column in meta['columns']:
+        array = np.load(os.path.join(cache_dir, column['file']), mmap_mode='r')
+        if column['kind'] == 'numeric':
+            columns[column['name']] = array
+        elif text_columns == 'categorical':
+            columns[column['name']] = pd.Categorical.from_codes(array, categories=column['categories'])
+        else:
+            # The extra trailing NaN makes code -1 (missing) decode to NaN
+            lookup = np.array(column['categories'] + [np.nan], dtype=object)
+            columns[column['name']] = lookup[array]
+    return pd.DataFrame(columns, copy=False)
+
+# Function to get the columnar cache meta, rebuilding it when stale
+def ensure_columnar_cache(csv_path):
+    signature = source_signature(csv_path)
+    cache_dir = columnar_cache_dir(csv_path)
+    meta = _read_cache_meta(cache_dir)
+    if not _is_fresh(meta, signature):
+        meta = write_columnar_cache(csv_path)
+    return cache_dir, meta
+
+# Function to get the row count of a normalized csv from its columnar cache,
+# None when there is no up-to-date cache
+def cached_row_count(csv_path):
+    try:
+        signature = source_signature(csv_path)
+    except OSError:
+        return None
+    meta = _read_cache_meta(columnar_cache_dir(csv_path))
+    return meta['rows'] if _is_fresh(meta, signature) else None
+
+class _StoredDataset:
+    def __init__(self, signature, version, data):
+        self.signature = signature
+        self.version = version
+        self.data = data
+        self.refs = 0
+
+# Process-wide store of the loaded normalized datasets
+class DatasetStore:
+    def __init__(self, size=DATASET_STORE_SIZE, text_columns=DATASET_TEXT_COLUMNS):
+        self.size = size
+        self.text_columns = text_columns
+        # csv path -> _StoredDataset, least recently used first
+        self._datasets = {}
+
+    def _after_fork(self):
+        # Attachments held by threads of the parent do not exist in the child
+        for stored in self._datasets.values():
+            stored.refs = 0
+
+    def _lookup(self, csv_path, signature):
+        with _lock:
+            stored = self._datasets.pop(csv_path, None)
+            if stored is not None:
+                self._datasets[csv_path] = stored
+            return stored if stored is not None and stored.signature == signature else None
+
+    def _load(self, csv_path):
+        signature = source_signature(csv_path)
+        stored = self._lookup(csv_path, signature)
+        if stored is not None:
+            return stored
+
+        cache_dir, meta = ensure_columnar_cache(csv_path)
+        with _lock:
+            stored = self._datasets.get(csv_path)
+            if stored is not None and stored.version == meta['version']:
+                # Same content, e.g. the file was only touched
+                stored.signature = meta['source']
+                return stored
+
+        stored = _StoredDataset(meta['source'], meta['version'], _read_columnar_cache(cache_dir, meta, self.text_columns))
+        with _lock:
+            # Holders of the previous version keep their own reference to it
+            self._datasets.pop(csv_path, None)
+            self._datasets[csv_path] = stored
+            self._evict()
+        return stored
+
+    def _evict(self):
+        for csv_path in list(self._datasets):
+            if len(self._datasets) <= self.size:
+                break
+            if self._datasets[csv_path].refs == 0:
+                del self._datasets[csv_path]
+
+    # Returns the current DataFrame of a normalized csv. It is shared by the
+    # whole process and must not be modified
+    def get(self, csv_path):
+        return self._load(csv_path).data
+
+    # Returns the content version of a normalized csv without loading it
+    def version(self, csv_path):
+        signature = source_signature(csv_path)
+        stored = self._lookup(csv_path, signature)
+        if stored is not None:
+            return stored.version
+        _, meta = ensure_columnar_cache(csv_path)
+        return meta['version']
+
+    # Attaches the current version of a dataset for the duration of a with
+    # block; it is not evicted while attached
+    @contextlib.contextmanager
+    def attach(self, csv_path):
+        stored = self._load(csv_path)
+        with _lock:
+            stored.refs += 1
+        try:
+            yield stored.data
+        finally:
+            with _lock:
+                stored.refs -= 1
+
+    def stats(self):
+        with _lock:
+            return [
+                {'path': csv_path, 'version': stored.version, 'rows': len(stored.data), 'attached': stored.refs}
+                for csv_path, stored in self._datasets.items()
+            ]
+
+dataset_store = DatasetStore()
+
+# Function to load a normalized csv through the columnar cache
+def load_normalized_dataframe(csv_path):
+    return dataset_store.get(csv_path)
+
+# Function to get the content version of a normalized csv
+def dataset_version(csv_path):
+    return dataset_store.version(csv_path)
@@ -0,0 +1,142 @@
+import os
+import json
+import time
+import logging
+import threading
+from app.util.dataset_cache import cached_row_count
+
+logger = logging.getLogger(__name__)
+
+# In-memory catalog of the datasets served by /data/list.
+#
+# Built once from the data/<package>/{data,metadata,title.txt} layout and
+# kept per package, together with the mtimes of the directories and files it
+# was read from. ingest_new_data updates its package right away; changes made
+# by other processes are picked up by re-checking those mtimes, at most once
+# every BM_CATALOG_REVALIDATE_SECONDS, so listing is a read of the cached
+# entries.
+
+CATALOG_REVALIDATE_SECONDS = float(os.getenv('BM_CATALOG_REVALIDATE_SECONDS', 2))
+DEFAULT_TITLE = 'No description available'
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+# Function to get the signature of everything a package entry is read from
+def package_signature(package_path):
+    paths = [
+        package_path,
+        os.path.join(package_path, 'data'),
+        os.path.join(package_path, 'metadata'),
+        os.path.join(package_path, 'title.txt'),
+    ]
+    metadata_path = os.path.join(package_path, 'metadata')
+    if os.path.isdir(metadata_path):
+        paths += sorted(os.path.join(metadata_path, name) for name in os.listdir(metadata_path))
+    return tuple(_mtime(path) for path in paths)
+
+def _read_title(package_path):
+    title_file = os.path.join(package_path, 'title.txt')
+    if not os.path.exists(title_file):
+        return DEFAULT_TITLE
+    with open(title_file, 'r') as file:
+        return file.read().strip()
+
+def _read_metadata(package_path, name):
+    metadata_path = os.path.join(package_path, 'metadata', f"{name}_metadata.json")
+    try:
+        with open(metadata_path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+# Function to describe the datasets of one package
+def read_package_entries(root, package):
+    package_path = os.path.join(root, package)
+    data_path = os.path.join(package_path, 'data')
+    if not os.path.isdir(data_path):
+        return []
+
+    title = _read_title(package_path)
+    entries = []
+    for data_file in sorted(os.listdir(data_path)):
+        file_path = os.path.join(data_path, data_file)
+        if not data_file.endswith('.csv') or not os.path.isfile(file_path):
+            continue
+        name = os.path.splitext(data_file)[0]
+        metadata = _read_metadata(package_path, name)
+        rows = cached_row_count(os.path.join(package_path, 'normalized_data', f"{name}_normalized.csv"))
+        if rows is None and metadata:
+            rows = max((column.get('count') or 0 for column in metadata), default=0)
+        entries.append({
+            'package': package,
+            'file': data_file,
+            'title': title,
+            'rows': rows,
+            'columns': len(metadata) if metadata is not None else None,
+            'size': os.path.getsize(file_path),
+        })
+    return entries
+
+class DatasetCatalog:
+    def __init__(self, root='data', revalidate_seconds=CATALOG_REVALIDATE_SECONDS):
+        self.root = root
+        self.revalidate_seconds = revalidate_seconds
+        # package -> (signature, entries)
+        self._packages = {}
+        self._datasets = []
+        self._checked = None
+        self._lock = threading.Lock()
+
+    def _rebuild_list(self):
+        self._datasets = [entry for package in sorted(self._packages) for entry in self._packages[package][1]]
+
+    def _load_package(self, package):
+        package_path = os.path.join(self.root, package)
+        signature = package_signature(package_path)
+        cached = self._packages.get(package)
+        if cached and cached[0] == signature:
+            return False
+        self._packages[package] = (signature, read_package_entries(self.root, package))
+        return True
+
+    # Function to re-check the mtimes and reload the packages that changed
+    def refresh(self):
+        with self._lock:
+            changed = False
+            packages = set()
+            if os.path.isdir(self.root):
+                packages = {
+                    name for name in os.listdir(self.root)
+                    if not name.startswith('.') and os.path.isdir(os.path.join(self.root, name))
+                }
+            for package in set(self._packages) - packages:
+                del self._packages[package]
+                changed = True
+            for package in packages:
+                try:
+                    changed = self._load_package(package) or changed
+                except OSError as e:
+                    logger.warning(f"Could not catalog package {package}: {e}")
+            if changed:
+                self._rebuild_list()
+            self._checked = time.monotonic()
+
+    # Function to update one package, e.g. after it was ingested
+    def update_package(self, package):
+        with self._lock:
+            if os.path.isdir(os.path.join(self.root, package)):
+                self._load_package(package)
+            else:
+                self._packages.pop(package, None)
+            self._rebuild_list()
+
+    def datasets(self):
+        if self._checked is None or time.monotonic() - self._checked >= self.revalidate_seconds:
+            self.refresh()
+        return self._datasets
+
+dataset_catalog = DatasetCatalog()
@@ -0,0 +1,250 @@
+import os
+import re
+import json
+import math
+import logging
+import threading
+import numpy as np
+import pandas as pd
+from app.util.dataset_cache import load_normalized_dataframe, dataset_version
+
+logger = logging.getLogger(__name__)
+
+# Statistical profile of a normalized dataset.
+#
+# Computed once per dataset version and stored next to the metadata as
+# <file>_profile.json. Per column it holds null counts, quantiles and a
+# histogram for numeric columns and a frequency table for columns with few
+# distinct values; across columns, the count/mean/median of numeric columns
+# for every group of a low-cardinality column and the correlations between
+# numeric columns. Simple descriptive questions ("what is the median hhsize",
+# "average totincome by bl_state") are answered from it without generating
+# and running code.
+
+PROFILE_QUANTILES = [0.0, 0.05, 0.25, 0.5, 0.75, 0.95, 1.0]
+PROFILE_HISTOGRAM_BINS = int(os.getenv('BM_PROFILE_HISTOGRAM_BINS', 20))
+# Columns with at most this many distinct values get a frequency table
+PROFILE_MAX_CATEGORIES = int(os.getenv('BM_PROFILE_MAX_CATEGORIES', 30))
+# Columns with at most this many distinct values are used to group numeric columns
+PROFILE_MAX_GROUPS = int(os.getenv('BM_PROFILE_MAX_GROUPS', 12))
+PROFILE_MAX_GROUP_COLUMNS = int(os.getenv('BM_PROFILE_MAX_GROUP_COLUMNS', 25))
+PROFILE_MAX_VALUE_COLUMNS = int(os.getenv('BM_PROFILE_MAX_VALUE_COLUMNS', 60))
+PROFILE_ANSWERS = os.getenv('BM_PROFILE_ANSWERS', '1') != '0'
+PROFILE_FORMAT_VERSION = 1
+
+_profiles = {}
+_profiles_lock = threading.Lock()
+
+# Function to locate the profile of a package file
+def profile_path(package, filename):
+    filename = filename.replace(".csv", "")
+    return os.path.join('data', package, 'metadata', f"{filename}_profile.json")
+
+def _json_number(value):
+    if value is None:
+        return None
+    value = float(value)
+    if math.isnan(value) or math.isinf(value):
+        return None
+    return int(value) if value.is_integer() else value
+
+def _json_key(value):
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float):
+        return str(int(value)) if value.is_integer() else str(value)
+    return str(value)
+
+def _numeric_profile(values):
+    present = values.dropna()
+    if present.empty:
+        return {}
+    counts, edges = np.histogram(present.to_numpy(dtype=float), bins=PROFILE_HISTOGRAM_BINS)
+    return {
+        'mean': _json_number(present.mean()),
+        'std': _json_number(present.std()),
+        'sum': _json_number(present.sum()),
+        'quantiles': {str(q): _json_number(v) for q, v in zip(PROFILE_QUANTILES, present.quantile(PROFILE_QUANTILES))},
+        'histogram': {'edges': [_json_number(e) for e in edges], 'counts': counts.tolist()},
+    }
+
+def _group_stats(data, group_column, value_columns):
+    grouped = data.groupby(group_column, dropna=True)[value_columns]
+    count, mean, median = grouped.count(), grouped.mean(), grouped.median()
+    stats = {}
+    for value_column in value_columns:
+        stats[value_column] = {
+            _json_key(group): {
+                'count': int(count.at[group, value_column]),
+                'mean': _json_number(mean.at[group, value_column]),
+                'median': _json_number(median.at[group, value_column]),
+            }
+            for group in count.index
+        }
+    return stats
+
+# Function to compute the profile of a normalized DataFrame
+def build_profile(data):
+    numeric = {}
+    columns = {}
+    distinct = data.nunique(dropna=True)
+    for column in data.columns:
+        values = data[column]
+        entry = {
+            'type': str(values.dtype),
+            'count': int(values.notna().sum()),
+            'nulls': int(values.isna().sum()),
+            'uniqueValues': int(distinct[column]),
+        }
+        numeric_values = values if values.dtype.kind in 'biuf' else pd.to_numeric(values, errors='coerce')
+        if values.dtype.kind in 'biuf' or (entry['count'] and numeric_values.notna().sum() == entry['count']):
+            numeric[column] = numeric_values.astype(float)
+            entry.update(_numeric_profile(numeric[column]))
+        if distinct[column] <= PROFILE_MAX_CATEGORIES:
+            frequencies = values.value_counts(dropna=True)
+            entry['frequencies'] = {_json_key(value): int(count) for value, count in frequencies.items()}
+        columns[column] = entry
+
+    value_columns = [c for c in numeric if distinct[c] > 2][:PROFILE_MAX_VALUE_COLUMNS]
+    group_columns = [c for c in data.columns if 2 <= distinct[c] <= PROFILE_MAX_GROUPS][:PROFILE_MAX_GROUP_COLUMNS]
+
+    numeric_frame = pd.DataFrame({c: numeric[c] for c in value_columns}, index=data.index)
+    groups = {}
+    for group_column in group_columns:
+        targets = [c for c in value_columns if c != group_column]
+        if targets:
+            frame = numeric_frame[targets].assign(**{'__group__': data[group_column]})
+            groups[group_column] = _group_stats(frame, '__group__', targets)
+
+    correlations = {'columns': value_columns, 'matrix': []}
+    if len(value_columns) > 1:
+        matrix = numeric_frame.corr(min_periods=3).to_numpy()
+        correlations['matrix'] = [[_json_number(v) for v in row] for row in matrix]
+
+    return {
+        'format': PROFILE_FORMAT_VERSION,
+        'rows': len(data),
+        'columns': columns,
+        'groups': groups,
+        'correlations': correlations,
+    }
+
+# Function to compute and save the profile of a normalized csv
+def write_profile(csv_path, path):
+    profile = build_profile(load_normalized_dataframe(csv_path))
+    profile['version'] = dataset_version(csv_path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(profile, f)
+    os.replace(tmp_path, path)
+    logger.info(f"Wrote dataset profile {path}")
+    return profile
+
+# Function to get the profile of a normalized csv, building it when missing
+# or older than the dataset
+def load_profile(csv_path, path):
+    version = dataset_version(csv_path)
+    with _profiles_lock:
+        cached = _profiles.get(path)
+    if cached and cached['version'] == version:
+        return cached
+
+    profile = None
+    if os.path.exists(path):
+        try:
+            with open(path, 'r') as f:
+                profile = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Unreadable dataset profile {path}: {e}")
+    if not profile or profile.get('version') != version or profile.get('format') != PROFILE_FORMAT_VERSION:
+        profile = write_profile(csv_path, path)
+
+    with _profiles_lock:
+        _profiles[path] = profile
+    return profile
+
+STATISTIC_WORDS = {
+    'average': 'mean', 'mean': 'mean', 'median': 'median',
+    'maximum': 'max', 'max': 'max', 'highest': 'max', 'largest': 'max',
+    'minimum': 'min', 'min': 'min', 'lowest': 'min', 'smallest': 'min',
+    'total': 'sum', 'sum': 'sum', 'standard deviation': 'std',
+}
+STATISTIC_NAMES = {
+    'mean': 'average', 'median': 'median', 'max': 'highest value', 'min': 'lowest value',
+    'sum': 'total', 'std': 'standard deviation',
+}
+QUANTILE_KEYS = {'median': '0.5', 'max': '1.0', 'min': '0.0'}
+
+_STATISTIC_QUESTION = re.compile(
+    r"^(?:what(?:'s| is| was)|give me|tell me|show me)?\s*(?:the\s+)?"
+    r"(?P<statistic>" + '|'.join(sorted(STATISTIC_WORDS, key=len, reverse=True)) + r")"
+    r"\s+(?:value\s+)?(?:of\s+|for\s+)?(?:the\s+)?(?P<column>[\w ./-]+?)"
+    r"(?:\s+(?:by|per|for each|across)\s+(?P<group>[\w ./-]+?))?\s*\??$")
+_MISSING_QUESTION = re.compile(
+    r"^how many (?:missing|null|empty) (?:values|entries) (?:are there )?(?:in|for) (?:the\s+)?(?P<column>[\w ./-]+?)\s*\??$")
+_ROWS_QUESTION = re.compile(
+    r"^how many (?:rows|records|respondents|observations|entries) (?:are there|does the dataset have|are in the dataset)\s*\??$")
+
+# Function to find the column a phrase names, None unless it is unambiguous
+def resolve_column(phrase, columns):
+    phrase = phrase.strip().lower()
+    for candidate in (phrase, phrase.replace(' ', '_'), phrase.replace(' ', '')):
+        if candidate in columns:
+            return candidate
+    return None
+
+def _format_number(value):
+    if value is None:
+        return 'not available'
+    if float(value).is_integer():
+        return f"{int(value):,}"
+    return f"{value:,.2f}"
+
+def _statistic_value(entry, statistic):
+    if statistic in QUANTILE_KEYS:
+        return entry.get('quantiles', {}).get(QUANTILE_KEYS[statistic])
+    return entry.get(statistic)
+
+# Function to answer a simple descriptive question from a profile, returns
+# None when the question is not one it can answer exactly
+def answer_from_profile(question, profile):
+    if not PROFILE_ANSWERS or not profile:
+        return None
+    text = question.strip().lower()
+    columns = profile['columns']
+
+    if _ROWS_QUESTION.match(text):
+        return f"The dataset has {_format_number(profile['rows'])} rows."
+
+    match = _MISSING_QUESTION.match(text)
+    if match:
+        column = resolve_column(match.group('column'), columns)
+        if column is None:
+            return None
+        return f"{column} has {_format_number(columns[column]['nulls'])} missing values out of {_format_number(profile['rows'])} rows."
+
+    match = _STATISTIC_QUESTION.match(text)
+    if not match:
+        return None
+    statistic = STATISTIC_WORDS[match.group('statistic')]
+    column = resolve_column(match.group('column'), columns)
+    if column is None or 'quantiles' not in columns[column]:
+        return None
+    name = STATISTIC_NAMES[statistic]
+
+    if match.group('group'):
+        group_column = resolve_column(match.group('group'), columns)
+        if statistic not in ('mean', 'median') or group_column is None:
+            return None
+        groups = profile['groups'].get(group_column, {}).get(column)
+        if not groups:
+            return None
+        lines = [
+            f"- {group}: {_format_number(stats[statistic])} ({_format_number(stats['count'])} values)"
+            for group, stats in groups.items()
+        ]
+        return f"The {name} of {column} for each {group_column}:\n" + '\n'.join(lines)
+
+    value = _statistic_value(columns[column], statistic)
+    return f"The {name} of {column} is {_format_number(value)}, based on {_format_number(columns[column]['count'])} values."
@@ -0,0 +1,109 @@
+import pandas as pd
+
+# Column projection, filtering and paging for dataset endpoints.
+#
+# Query string format:
+#   columns=a,b          only return these columns
+#   offset=20&limit=100  return rows 20..119 of the filtered table
+#   col=value            keep rows where col equals value (comma separated for any of)
+#   col__gt=, col__gte=, col__lt=, col__lte=   numeric range filters
+#
+# Filters are applied before projection, so a filter column does not have to
+# be among the returned columns. Other parameters are ignored.
+
+RESERVED_PARAMS = {'columns', 'offset', 'limit'}
+RANGE_OPERATORS = {
+    'gt': lambda column, value: column > value,
+    'gte': lambda column, value: column >= value,
+    'lt': lambda column, value: column < value,
+    'lte': lambda column, value: column <= value,
+}
+
+class DatasetQuery:
+    def __init__(self, columns=None, offset=0, limit=None, filters=None):
+        self.columns = columns
+        self.offset = offset
+        self.limit = limit
+        # List of (column, operator, value) with operator 'eq' or a RANGE_OPERATORS key
+        self.filters = filters or []
+
+    def is_empty(self):
+        return self.columns is None and not self.offset and self.limit is None and not self.filters
+
+def _parse_non_negative_int(name, value):
+    try:
+        number = int(value)
+    except ValueError:
+        raise ValueError(f"'{name}' must be an integer, got '{value}'")
+    if number < 0:
+        raise ValueError(f"'{name}' must not be negative")
+    return number
+
+def _check_column(name, columns):
+    if name not in columns:
+        raise ValueError(f"Unknown column '{name}'")
+    return name
+
+# Function to parse request arguments into a DatasetQuery
+def parse_dataset_query(args, columns, reserved=RESERVED_PARAMS):
+    columns = set(columns)
+    query = DatasetQuery()
+
+    if args.get('columns'):
+        query.columns = [_check_column(c.strip(), columns) for c in args['columns'].split(',') if c.strip()]
+    if args.get('offset'):
+        query.offset = _parse_non_negative_int('offset', args['offset'])
+    if args.get('limit'):
+        query.limit = _parse_non_negative_int('limit', args['limit'])
+
+    for key in args:
+        if key in reserved:
+            continue
+        name, _, operator = key.rpartition('__')
+        if key in columns:
+            column, operator = key, 'eq'
+        elif name in columns and operator in RANGE_OPERATORS:
+            column = name
+        else:
+            # Not a filter, e.g. a cache buster like _=123
+            continue
+        for value in args.getlist(key) if hasattr(args, 'getlist') else [args[key]]:
+            query.filters.append((column, operator, value))
+    return query
+
+def _as_number(column, value):
+    try:
+        return float(value)
+    except ValueError:
+        raise ValueError(f"Filter value for '{column}' must be a number, got '{value}'")
+
+# Function to build the row mask of a single filter
+def _filter_mask(data, column, operator, value):
+    column_data = data[column]
+    numeric_column = column_data.dtype.kind in 'iufb'
+
+    if operator == 'eq':
+        values = [v.strip() for v in value.split(',')]
+        if numeric_column:
+            return column_data.isin([_as_number(column, v) for v in values])
+        return column_data.isin([v.lower() for v in values])
+
+    if not numeric_column:
+        column_data = pd.to_numeric(column_data, errors='coerce')
+    return RANGE_OPERATORS[operator](column_data, _as_number(column, value)).fillna(False)
+
+# Function to apply a DatasetQuery, returns the filtered row count and the page
+def apply_dataset_query(data, query):
+    if query.filters:
+        mask = pd.Series(True, index=data.index)
+        for column, operator, value in query.filters:
+            mask &= _filter_mask(data, column, operator, value)
+        data = data[mask]
+
+    total = len(data)
+    end = None if query.limit is None else query.offset + query.limit
+    data = data.iloc[query.offset:end]
+
+    if query.columns is not None:
+        data = data[query.columns]
+    return total, data
@@ -0,0 +1,234 @@
+import os
+import json
+import shutil
+import hashlib
+import logging
+import threading
+import numpy as np
+from app.util.dataset_cache import file_content_hash
+from app.util.embedding_cache import get_embedder
+
+logger = logging.getLogger(__name__)
+
+# Persistent vector index of the PDF reports of a package.
+#
+# The PDFs in data/<package>/pdfs are split into chunks and embedded once;
+# the chunks and their normalized float32 embeddings are stored in
+# data/<package>/pdfs/.index and memory-mapped read-only by every session.
+# The index records a hash of the PDFs it was built from and is rebuilt only
+# when that changes. Indexes are loaded lazily on first use, and can be
+# built for every package at startup.
+
+INDEX_DIR_NAME = '.index'
+INDEX_FORMAT_VERSION = 1
+DOCUMENT_CHUNK_SIZE = 1000
+DOCUMENT_CHUNK_OVERLAP = 200
+DOCUMENT_TOP_K = int(os.getenv('BM_DOCUMENT_TOP_K', 4))
+
+# In-process indexes: package -> (signature, DocumentIndex or None)
+_indexes = {}
+_indexes_lock = threading.Lock()
+_build_locks = {}
+
+# Function to locate the pdfs directory of a package
+def pdfs_dir(package):
+    return os.path.join('data', package, 'pdfs')
+
+def _pdf_paths(pdf_dir):
+    if not os.path.isdir(pdf_dir):
+        return []
+    return sorted(os.path.join(pdf_dir, name) for name in os.listdir(pdf_dir) if name.endswith('.pdf'))
+
+# Function to get the cheap signature of the PDFs of a package, used to
+# decide when their content hash has to be checked again
+def pdfs_signature(pdf_dir):
+    return [[os.path.basename(path), os.stat(path).st_mtime_ns, os.stat(path).st_size] for path in _pdf_paths(pdf_dir)]
+
+# Function to hash the content of the PDFs of a package
+def pdfs_fingerprint(pdf_dir):
+    digest = hashlib.sha256()
+    for path in _pdf_paths(pdf_dir):
+        digest.update(os.path.basename(path).encode('utf-8'))
+        digest.update(file_content_hash(path).encode('ascii'))
+    return digest.hexdigest()
+
+# Function to split the PDFs of a directory into chunks of text
+def load_pdf_chunks(pdf_dir, chunk_size=DOCUMENT_CHUNK_SIZE, chunk_overlap=DOCUMENT_CHUNK_OVERLAP):
+    from langchain_community.document_loaders import PyPDFium2Loader
+    from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+    text_splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+    chunks = []
+    for path in _pdf_paths(pdf_dir):
+        documents = text_splitter.split_documents(PyPDFium2Loader(path).load())
+        for document in documents:
+            chunks.append({
+                'text': document.page_content,
+                'source': os.path.basename(path),
+                'page': document.metadata.get('page'),
+            })
+    return chunks
+
+def _normalize_rows(vectors):
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return (vectors / norms).astype(np.float32)
+
+class DocumentIndex:
+    def __init__(self, meta, embeddings):
+        self.meta = meta
+        self.chunks = meta['chunks']
+        self.embeddings = embeddings
+
+    @classmethod
+    def load(cls, index_dir):
+        with open(os.path.join(index_dir, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+        embeddings = np.load(os.path.join(index_dir, 'embeddings.npy'), mmap_mode='r')
+        return cls(meta, embeddings)
+
+    # Returns the k chunks closest to a query embedding, with their scores
+    def search(self, query_vector, k=DOCUMENT_TOP_K):
+        if not len(self.chunks):
+            return []
+        query_vector = _normalize_rows(np.asarray(query_vector, dtype=np.float32).reshape(1, -1))[0]
+        scores = self.embeddings @ query_vector
+        k = min(k, len(scores))
+        best = np.argpartition(-scores, k - 1)[:k]
+        best = best[np.argsort(-scores[best])]
+        return [dict(self.chunks[i], score=float(scores[i])) for i in best]
+
+    def query(self, question, embedder=None, k=DOCUMENT_TOP_K):
+        embedder = embedder or document_embedder()
+        return self.search(embedder([question])[0], k)
+
+# Function to locate the index directory of a package
+def document_index_dir(package):
+    return os.path.join(pdfs_dir(package), INDEX_DIR_NAME)
+
+def _read_index_meta(index_dir):
+    try:
+        with open(os.path.join(index_dir, 'meta.json'), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def _is_current(meta, fingerprint, model):
+    return (
+        meta is not None
+        and meta.get('format') == INDEX_FORMAT_VERSION
+        and meta.get('fingerprint') == fingerprint
+        and meta.get('model') == model
+        and meta.get('chunk_size') == DOCUMENT_CHUNK_SIZE
+        and meta.get('chunk_overlap') == DOCUMENT_CHUNK_OVERLAP
+    )
+
+# Function to get the embedder of document chunks, which reuses cached
+# embeddings of chunks that did not change
+def document_embedder():
+    return get_embedder(DOCUMENT_CHUNK_SIZE, DOCUMENT_CHUNK_OVERLAP)
+
+# Function to build and save the index of a package
+def build_document_index(package, embedder=None, fingerprint=None):
+    embedder = embedder or document_embedder()
+    pdf_dir = pdfs_dir(package)
+    fingerprint = fingerprint or pdfs_fingerprint(pdf_dir)
+    chunks = load_pdf_chunks(pdf_dir)
+    logger.info(f"Indexing {len(chunks)} chunks of the PDFs of {package}")
+    embeddings = embedder([chunk['text'] for chunk in chunks]) if chunks else np.zeros((0, 0), dtype=np.float32)
+    embeddings = _normalize_rows(np.asarray(embeddings, dtype=np.float32).reshape(len(chunks), -1))
+
+    meta = {
+        'format': INDEX_FORMAT_VERSION,
+        'fingerprint': fingerprint,
+        'model': embedder.model,
+        'chunk_size': DOCUMENT_CHUNK_SIZE,
+        'chunk_overlap': DOCUMENT_CHUNK_OVERLAP,
+        'chunks': chunks,
+    }
+
+    # Build next to the live index and swap directories, so readers never
+    # see a half written index
+    index_dir = document_index_dir(package)
+    tmp_dir = f"{index_dir}.{os.getpid()}.{threading.get_ident()}.tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    np.save(os.path.join(tmp_dir, 'embeddings.npy'), embeddings)
+    with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+    old_dir = f"{tmp_dir}.old"
+    if os.path.exists(index_dir):
+        os.replace(index_dir, old_dir)
+    os.replace(tmp_dir, index_dir)
+    shutil.rmtree(old_dir, ignore_errors=True)
+    logger.info(f"Wrote document index for {package} ({len(chunks)} chunks)")
+    return DocumentIndex.load(index_dir)
+
+def _build_lock(package):
+    with _indexes_lock:
+        return _build_locks.setdefault(package, threading.Lock())
+
+# Function to get the index of a package, loading it on first use and
+# rebuilding it when the PDFs changed. None when the package has no PDFs
+def get_document_index(package, embedder=None):
+    embedder = embedder or document_embedder()
+    model = embedder.model
+    pdf_dir = pdfs_dir(package)
+    signature = pdfs_signature(pdf_dir)
+    with _indexes_lock:
+        cached = _indexes.get(package)
+    if cached and cached[0] == signature:
+        return cached[1]
+    if not signature:
+        return None
+
+    with _build_lock(package):
+        with _indexes_lock:
+            cached = _indexes.get(package)
+        if cached and cached[0] == signature:
+            return cached[1]
+
+        index_dir = document_index_dir(package)
+        meta = _read_index_meta(index_dir)
+        # Only hash the PDFs when the saved index was built from files with
+        # another mtime or size
+        if meta is not None and meta.get('signature') == signature and _is_current(meta, meta.get('fingerprint'), model):
+            index = DocumentIndex.load(index_dir)
+        else:
+            fingerprint = pdfs_fingerprint(pdf_dir)
+            if _is_current(meta, fingerprint, model):
+                index = DocumentIndex.load(index_dir)
+            else:
+                index = build_document_index(package, embedder, fingerprint)
+            _save_signature(index_dir, index.meta, signature)
+
+        with _indexes_lock:
+            _indexes[package] = (signature, index)
+        return index
+
+def _save_signature(index_dir, meta, signature):
+    meta['signature'] = signature
+    tmp_path = os.path.join(index_dir, f"meta.json.{os.getpid()}.{threading.get_ident()}.tmp")
+    with open(tmp_path, 'w') as f:
+        json.dump(meta, f)
+    os.replace(tmp_path, os.path.join(index_dir, 'meta.json'))
+
+# Function to build or load the indexes of all packages, e.g. at startup
+def warm_document_indexes():
+    if not os.path.isdir('data'):
+        return
+    for package in sorted(os.listdir('data')):
+        if not _pdf_paths(pdfs_dir(package)):
+            continue
+        try:
+            get_document_index(package)
+        except Exception as e:
+            logger.warning(f"Could not build the document index of {package}: {e}")
+
+# Function to render the chunks relevant to a question as prompt context
+def document_context(index, question, k=DOCUMENT_TOP_K):
+    excerpts = index.query(question, k=k)
+    return '\n\n'.join(
+        f"[{excerpt['source']}, page {excerpt['page'] + 1 if excerpt['page'] is not None else '?'}]\n{excerpt['text']}"
+        for excerpt in excerpts
+    )
@@ -0,0 +1,204 @@
+import os
+import re
+import json
+import hashlib
+import logging
+import threading
+import numpy as np
+from app.util.openai_client import create_embeddings, OPENAI_EMBEDDING_MODEL
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# Content-addressed cache of text embeddings.
+#
+# An embedding is keyed by the hash of the text, the embedding model and the
+# chunking parameters the text came from, so re-indexing a package only
+# embeds chunks that were not embedded before. Each model has a directory
+# holding the vectors as one raw float32 matrix (vectors.f32, memory-mapped
+# for lookups) and the keys of its rows in the same order (keys.txt). Both
+# are append-only and appends are serialized with a file lock, so several
+# processes can share the cache.
+#
+# BM_EMBEDDINGS=fake replaces the OpenAI embeddings with FakeEmbedder, a
+# deterministic local embedder for development and tests.
+
+EMBEDDING_CACHE_DIR = os.getenv('BM_EMBEDDING_CACHE_DIR', os.path.join('data', '.embeddings'))
+EMBEDDINGS_PROVIDER = os.getenv('BM_EMBEDDINGS', 'openai')
+FAKE_EMBEDDING_DIM = 256
+EMBEDDING_BATCH_SIZE = int(os.getenv('BM_EMBEDDING_BATCH_SIZE', 100))
+
+_TOKEN_PATTERN = re.compile(r"\w+")
+
+# Function to embed texts in batches with the OpenAI embeddings API
+def embed_texts(texts, model=OPENAI_EMBEDDING_MODEL):
+    vectors = []
+    for start in range(0, len(texts), EMBEDDING_BATCH_SIZE):
+        vectors.extend(create_embeddings(texts[start:start + EMBEDDING_BATCH_SIZE], model))
+    return np.asarray(vectors, dtype=np.float32).reshape(len(texts), -1)
+
+# Function to build the cache key of a text
+def embedding_key(text, model, chunk_size=None, chunk_overlap=None):
+    payload = json.dumps([model, chunk_size, chunk_overlap, text], ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+class EmbeddingCache:
+    def __init__(self, model, directory=EMBEDDING_CACHE_DIR):
+        self.model = model
+        self.directory = os.path.join(directory, re.sub(r'[^\w.-]', '_', model))
+        self.vectors_path = os.path.join(self.directory, 'vectors.f32')
+        self.keys_path = os.path.join(self.directory, 'keys.txt')
+        self.meta_path = os.path.join(self.directory, 'meta.json')
+        self.dim = None
+        self._rows = {}
+        self._keys_size = 0
+        self._vectors = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _file_lock(self):
+        os.makedirs(self.directory, exist_ok=True)
+        return _FileLock(os.path.join(self.directory, '.lock'))
+
+    # Read the keys appended since the last look, by this or another process
+    def _refresh(self):
+        try:
+            size = os.path.getsize(self.keys_path)
+        except OSError:
+            return
+        if size == self._keys_size and self._vectors is not None:
+            return
+        if self.dim is None:
+            with open(self.meta_path, 'r') as f:
+                self.dim = json.load(f)['dim']
+        with open(self.keys_path, 'r') as f:
+            f.seek(self._keys_size)
+            data = f.read()
+        # Only whole lines, a writer may be half way through one
+        complete = data[:data.rfind('\n') + 1]
+        for key in complete.splitlines():
+            self._rows.setdefault(key, len(self._rows))
+        self._keys_size += len(complete.encode('utf-8'))
+        self._vectors = np.memmap(self.vectors_path, dtype=np.float32, mode='r', shape=(len(self._rows), self.dim)) \
+            if self._rows else None
+
+    # Returns a (len(keys), dim) float32 matrix and a mask of the keys found,
+    # or (None, all False) when nothing is cached yet
+    def lookup(self, keys):
+        with self._lock:
+            self._refresh()
+            rows = np.array([self._rows.get(key, -1) for key in keys], dtype=np.int64)
+            found = rows >= 0
+            self.hits += int(found.sum())
+            self.misses += int((~found).sum())
+            if self._vectors is None:
+                return None, found
+            vectors = np.zeros((len(keys), self.dim), dtype=np.float32)
+            if found.any():
+                vectors[found] = self._vectors[rows[found]]
+            return vectors, found
+
+    def store(self, keys, vectors):
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        if not len(keys):
+            return
+        with self._lock, self._file_lock():
+            self._refresh()
+            if self.dim is None:
+                self.dim = vectors.shape[1]
+                with open(self.meta_path, 'w') as f:
+                    json.dump({'model': self.model, 'dim': self.dim}, f)
+            if vectors.shape[1] != self.dim:
+                raise ValueError(f"Embedding size {vectors.shape[1]} does not match the cache ({self.dim})")
+            new = [i for i, key in enumerate(keys) if key not in self._rows]
+            new = list({keys[i]: i for i in new}.values())
+            if not new:
+                return
+            # Drop vectors left by a writer that died before adding their keys
+            expected_size = len(self._rows) * self.dim * 4
+            with open(self.vectors_path, 'ab') as f:
+                if f.tell() != expected_size:
+                    f.truncate(expected_size)
+                    f.seek(expected_size)
+                f.write(vectors[new].tobytes())
+            with open(self.keys_path, 'a') as f:
+                f.write(''.join(f"{keys[i]}\n" for i in new))
+            self._refresh()
+
+class _FileLock:
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+
+    def __enter__(self):
+        self.file = open(self.path, 'a')
+        if fcntl is not None:
+            fcntl.flock(self.file, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc_info):
+        if fcntl is not None:
+            fcntl.flock(self.file, fcntl.LOCK_UN)
+        self.file.close()
+
+# Embedder that only embeds the texts missing from the cache
+class CachedEmbedder:
+    def __init__(self, embed, model, cache=None, chunk_size=None, chunk_overlap=None):
+        self.embed = embed
+        self.model = model
+        self.cache = cache or EmbeddingCache(model)
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+
+    def __call__(self, texts):
+        keys = [embedding_key(text, self.model, self.chunk_size, self.chunk_overlap) for text in texts]
+        vectors, found = self.cache.lookup(keys)
+        missing = [i for i in range(len(texts)) if not found[i]]
+        if missing:
+            logger.info(f"Embedding {len(missing)} of {len(texts)} texts, the rest are cached")
+            embedded = np.asarray(self.embed([texts[i] for i in missing]), dtype=np.float32).reshape(len(missing), -1)
+            self.cache.store([keys[i] for i in missing], embedded)
+            if vectors is None:
+                vectors = np.zeros((len(texts), embedded.shape[1]), dtype=np.float32)
+            vectors[missing] = embedded
+        if vectors is None:
+            return np.zeros((0, 0), dtype=np.float32)
+        return vectors
+
+# Deterministic local embedder: hashes the words of a text into a fixed
+# number of signed buckets, so texts sharing words are similar
+class FakeEmbedder:
+    def __init__(self, dim=FAKE_EMBEDDING_DIM):
+        self.dim = dim
+        self.model = f"fake-{dim}"
+
+    def __call__(self, texts):
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for token in _TOKEN_PATTERN.findall(text.lower()):
+                digest = int.from_bytes(hashlib.blake2b(token.encode('utf-8'), digest_size=8).digest(), 'little')
+                vectors[row, digest % self.dim] += 1.0 if digest >> 63 else -1.0
+        return vectors
+
+# Function to get the embedder configured by BM_EMBEDDINGS, cached per chunking
+def get_embedder(chunk_size=None, chunk_overlap=None):
+    if EMBEDDINGS_PROVIDER == 'fake':
+        embed = FakeEmbedder()
+        model = embed.model
+    else:
+        embed, model = embed_texts, OPENAI_EMBEDDING_MODEL
+    return CachedEmbedder(embed, model, _shared_cache(model), chunk_size, chunk_overlap)
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+def _shared_cache(model):
+    with _caches_lock:
+        if model not in _caches:
+            _caches[model] = EmbeddingCache(model)
+        return _caches[model]
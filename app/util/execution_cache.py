@@ -0,0 +1,112 @@
+import os
+import ast
+import hashlib
+import logging
+import threading
+from cachetools import LRUCache
+
+logger = logging.getLogger(__name__)
+
+# Cache of the results of generated analysis code.
+#
+# Keyed on a hash of the code's syntax tree, so code that only differs in
+# formatting or comments shares an entry, and on the content version of the
+# normalized dataset it ran against. A re-ingested dataset gets a new version,
+# so its old results are never reused and are dropped the first time the new
+# version is seen. Entries are evicted least recently used first
+# once their outputs exceed BM_EXECUTION_CACHE_BYTES.
+#
+# Code that looks non-deterministic (random numbers, sampling, the current
+# time) is never cached.
+
+EXECUTION_CACHE_BYTES = int(os.getenv('BM_EXECUTION_CACHE_BYTES', 16 * 1024 * 1024))
+EXECUTION_CACHE = os.getenv('BM_EXECUTION_CACHE', '1') != '0'
+
+NONDETERMINISTIC_MODULES = {'random', 'time', 'datetime', 'uuid', 'secrets', 'os', 'subprocess', 'socket', 'requests'}
+NONDETERMINISTIC_ATTRIBUTES = {'random', 'now', 'today', 'utcnow', 'shuffle', 'permutation'}
+
+# Function to hash the syntax tree of parsed Python code
+def code_fingerprint(tree):
+    return hashlib.sha256(ast.dump(tree, annotate_fields=False).encode('utf-8')).hexdigest()
+
+# Function to tell whether code may print something else when run again
+def is_deterministic(tree):
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import) and any(alias.name.split('.')[0] in NONDETERMINISTIC_MODULES for alias in node.names):
+            return False
+        if isinstance(node, ast.ImportFrom) and (node.module or '').split('.')[0] in NONDETERMINISTIC_MODULES:
+            return False
+        if isinstance(node, ast.Attribute) and node.attr in NONDETERMINISTIC_ATTRIBUTES:
+            return False
+        # DataFrame.sample without a random_state
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute) and node.func.attr == 'sample' \
+                and not any(keyword.arg == 'random_state' for keyword in node.keywords):
+            return False
+    return True
+
+def _entry_size(value):
+    return len(value[1]) + 1
+
+class ExecutionCache:
+    def __init__(self, maxbytes=EXECUTION_CACHE_BYTES, enabled=EXECUTION_CACHE):
+        self.enabled = enabled and maxbytes > 0
+        self._results = LRUCache(maxsize=max(maxbytes, 1), getsizeof=_entry_size)
+        # dataset path -> version the cached results were computed with
+        self._versions = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    # Returns the cache key of running code against a dataset version, None
+    # when the result must not be cached
+    def key(self, code, dataset_path, version):
+        if not self.enabled:
+            return None
+        try:
+            tree = ast.parse(code)
+        except (SyntaxError, ValueError):
+            return None
+        if not is_deterministic(tree):
+            return None
+        with self._lock:
+            if self._versions.get(dataset_path) != version:
+                self._invalidate(dataset_path)
+                self._versions[dataset_path] = version
+        return (dataset_path, version, code_fingerprint(tree))
+
+    def _invalidate(self, dataset_path):
+        stale = [key for key in self._results if key[0] == dataset_path]
+        for key in stale:
+            del self._results[key]
+        if stale:
+            logger.info(f"Dropped {len(stale)} cached execution results of {dataset_path}")
+
+    # Returns the cached (succeeded, output) of a key, or None
+    def get(self, key):
+        if key is None:
+            return None
+        with self._lock:
+            result = self._results.get(key)
+            if result is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return result
+
+    def set(self, key, succeeded, output):
+        if key is None or _entry_size((succeeded, output)) > self._results.maxsize:
+            return
+        with self._lock:
+            self._results[key] = (succeeded, output)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._results),
+                'bytes': self._results.currsize,
+                'maxBytes': self._results.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+execution_cache = ExecutionCache()
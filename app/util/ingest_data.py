@@ -1,99 +1,223 @@
 import pandas as pd
-import requests
 import os
 import json
 import re
-import random
+import shutil
+import tempfile
+import threading
 from flask import Flask, request, jsonify
+from app.util.dataset_cache import write_columnar_cache, append_columnar_cache, source_signature, file_content_hash
+from app.util.dataset_catalog import dataset_catalog
+from app.util.column_stats import ColumnStats, merge_dtype_names
+from app.util.dataset_profile import write_profile, profile_path
+from app.util.response_stream import precompress_file
+from app.util.openai_client import chat_completion, completion_text
+from app.util.content_index import content_index, stream_content_hash, schema_fingerprint
+
+# Rows read per chunk when ingesting a CSV, bounds the memory used by ingestion
+INGEST_CHUNK_ROWS = int(os.getenv('BM_INGEST_CHUNK_ROWS', 50000))
+STATS_STATE_FORMAT = 1
+# dtypes new rows are read with, per type of the statistics they are added to
+STATS_READ_DTYPES = {'int64': 'Int64', 'bool': 'boolean', 'float64': 'float64', 'object': str}
+
+CHAR_MAP = {
+    '%': 'percent',
+    '&': 'and',
+    '<': 'less_than',
+    '>': 'greater_than',
+    '#': 'number',
+    '$': 'dollar',
+    '@': 'at',
+    '!': 'exclamation',
+    '^': 'caret',
+    '*': 'asterisk',
+    '(': 'left_parenthesis',
+    ')': 'right_parenthesis',
+    '+': 'plus',
+    '=': 'equals',
+    '{': 'left_curly_brace',
+    '}': 'right_curly_brace',
+    '[': 'left_square_bracket',
+    ']': 'right_square_bracket',
+    '|': 'pipe',
+    '\\': 'backslash',
+    ':': 'colon',
+    ';': 'semicolon',
+    '"': 'double_quote',
+    "'": 'single_quote',
+    ',': 'comma',
+    '.': 'dot',
+    '?': 'question_mark',
+    '/': 'slash'
+}
+
+# Function to normalize a column name
+def normalize_key(key):
+    key = key.strip().lower()
+    key = re.sub(r'[^a-zA-Z0-9]', lambda match: CHAR_MAP.get(match.group(0), '_'), key)
+    if re.match(r'^[0-9]', key):
+        key = '_' + key
+    return key
+
+# Function to normalize a single column of values
+def normalize_column(column_data):
+    if column_data.dtype != object:
+        if len(column_data) and column_data.isna().all():
+            # An all-missing column comes back as None values, not NaN floats
+            return pd.Series(None, index=column_data.index, dtype=object)
+        return column_data
+    try:
+        normalized = column_data.str.strip().str.lower()
+    except AttributeError:
+        # No string values at all, nothing to strip or lower
+        normalized = column_data
+    else:
+        # .str gives NaN for non-string cells, keep those as they were
+        normalized = normalized.where(normalized.notna(), column_data)
+    return normalized.where(normalized.notna(), None)
+
+# Function to normalize a DataFrame column by column
+def normalize_dataframe(data):
+    # Columns whose names normalize to the same key keep the position of the
+    # first one and the values of the last one, like the row-wise dict did
+    sources = {}
+    for column in data.columns:
+        sources[normalize_key(column)] = column
+    return pd.DataFrame(
+        {key: normalize_column(data[column]) for key, column in sources.items()},
+        index=data.index,
+    )
+
+# Function to turn a normalized DataFrame into row dicts with NaN as None
+def dataframe_to_records(data):
+    data = data.astype(object)
+    return data.where(data.notna(), None).to_dict(orient='records')
 
 # Function to normalize data
 def normalize_data(data):
-    char_map = {
-        '%': 'percent',
-        '&': 'and',
-        '<': 'less_than',
-        '>': 'greater_than',
-        '#': 'number',
-        '$': 'dollar',
-        '@': 'at',
-        '!': 'exclamation',
-        '^': 'caret',
-        '*': 'asterisk',
-        '(': 'left_parenthesis',
-        ')': 'right_parenthesis',
-        '+': 'plus',
-        '=': 'equals',
-        '{': 'left_curly_brace',
-        '}': 'right_curly_brace',
-        '[': 'left_square_bracket',
-        ']': 'right_square_bracket',
-        '|': 'pipe',
-        '\\': 'backslash',
-        ':': 'colon',
-        ';': 'semicolon',
-        '"': 'double_quote',
-        "'": 'single_quote',
-        ',': 'comma',
-        '.': 'dot',
-        '?': 'question_mark',
-        '/': 'slash'
-    }
+    if not isinstance(data, pd.DataFrame):
+        data = pd.DataFrame(data)
+    return dataframe_to_records(normalize_dataframe(data))
 
-    def normalize_key(key):
-        key = key.strip().lower()
-        key = re.sub(r'[^a-zA-Z0-9]', lambda match: char_map.get(match.group(0), '_'), key)
-        if re.match(r'^[0-9]', key):
-            key = '_' + key
-        return key
-
-    def handle_nan(value):
-        if pd.isna(value):
-            return None
-        return value
-
-    normalized_data = []
-    for row in data:
-        normalized_row = {}
-        for key, value in row.items():
-            normalized_key = normalize_key(key)
-            if isinstance(value, str):
-                normalized_row[normalized_key] = value.strip().lower()
+def _rewind(file):
+    if hasattr(file, 'seek'):
+        file.seek(0)
+
+# Function to find the dtypes a single read of a whole CSV infers, from the
+# dtypes inferred for each chunk. Chunks read with these dtypes all get the
+# types of the whole file, so a column is never written as 1 in one chunk and
+# as 1.0 in another. Boolean columns are left to per-chunk inference: a
+# single read keeps their values as booleans next to missing values, which a
+# pinned dtype would turn into strings
+def infer_csv_dtypes(file, chunk_rows=INGEST_CHUNK_ROWS):
+    merged = {}
+    kinds = {}
+    for chunk in pd.read_csv(file, chunksize=chunk_rows):
+        for column in chunk.columns:
+            values = chunk[column]
+            if len(values) and values.isna().all():
+                name = 'null'
+            elif pd.api.types.infer_dtype(values, skipna=True) == 'boolean':
+                # Booleans next to missing values come back as object
+                name = 'bool'
             else:
-                normalized_row[normalized_key] = handle_nan(value)
-        normalized_data.append(normalized_row)
-
-    return normalized_data
-
-# Function to generate metadata from the file
-def generate_metadata_from_file(file):
-    data = pd.read_csv(file)
-    normalized_data = normalize_data(data.to_dict(orient='records'))
-    data = pd.DataFrame(normalized_data)
-    columns = data.columns
-    metadata = []
-    for column in columns:
-        column_data = data[column]
-        numeric_data = column_data.dropna().apply(pd.to_numeric, errors='coerce').dropna()
-        min_value = numeric_data.min() if not numeric_data.empty else None
-        max_value = numeric_data.max() if not numeric_data.empty else None
-        avg_value = numeric_data.mean() if not numeric_data.empty else None
-        unique_values = column_data.unique().tolist()
-        cleaned_values = [v if pd.notna(v) else None for v in unique_values]
-        if len(cleaned_values) <= 20:
-            potential_values = cleaned_values
-        else:
-            potential_values = random.sample(cleaned_values, 5)
-        metadata.append({
-            'name': column,
-            'type': str(column_data.dtype),
-            'min': min_value if min_value is None else float(min_value),
-            'max': max_value if max_value is None else float(max_value),
-            'avg': avg_value if avg_value is None else float(avg_value),
-            'count': int(len(column_data)),
-            'uniqueValues': int(len(unique_values)),
-            'potentialValues': potential_values
-        })
-    return metadata, normalized_data
+                name = str(values.dtype)
+            merged[column] = merge_dtype_names(merged.get(column), name)
+            kinds.setdefault(column, set()).add(name)
+    _rewind(file)
+    return {
+        column: 'float64' if name == 'null' else name
+        for column, name in merged.items()
+        if not ('bool' in kinds[column] and kinds[column] <= {'bool', 'null'})
+    }
+
+def _read_chunks(file, chunk_rows, dtypes):
+    try:
+        yield from pd.read_csv(file, chunksize=chunk_rows, dtype=dtypes)
+    except (ValueError, TypeError, OverflowError) as e:
+        raise ValueError(f"The values do not fit the column types: {e}")
+
+# Function to get the dtypes to read the raw columns of a CSV with, from the
+# types of the statistics its rows are added to. Integers and booleans are
+# read as nullable types, so a missing value keeps the type of the column.
+# Text columns holding booleans next to missing values are left to inference
+def stats_dtypes(file, column_stats):
+    header = pd.read_csv(file, nrows=0).columns
+    _rewind(file)
+    stats_by_name = {stats.name: stats for stats in column_stats}
+    dtypes = {}
+    for column in header:
+        stats = stats_by_name.get(normalize_key(column))
+        if stats is None or stats.dtype not in STATS_READ_DTYPES:
+            continue
+        if stats.dtype == 'object' and stats.has_only_booleans():
+            continue
+        dtypes[column] = STATS_READ_DTYPES[stats.dtype]
+    return dtypes
+
+# Function to read a CSV in chunks and normalize each one
+def iter_normalized_chunks(file, chunk_rows=INGEST_CHUNK_ROWS):
+    for chunk in _read_chunks(file, chunk_rows, infer_csv_dtypes(file, chunk_rows)):
+        yield normalize_dataframe(chunk)
+
+# Function to write the normalized data of a CSV, without statistics
+def write_normalized_data(file, normalized_data_path, chunk_rows=INGEST_CHUNK_ROWS):
+    header_written = False
+    for chunk in iter_normalized_chunks(file, chunk_rows):
+        chunk.to_csv(normalized_data_path, mode='a' if header_written else 'w', header=not header_written, index=False)
+        header_written = True
+    return normalized_data_path
+
+def _report(progress, stage, rows=None):
+    if progress is not None:
+        progress(stage, rows)
+
+# Function to read a CSV in chunks, normalize them and add them to the
+# per-column statistics, optionally writing the normalized data to
+# normalized_data_path as it goes. column_stats continues the statistics of
+# rows ingested before, and the chunks must then have the same columns and
+# are read with its types. progress(stage, rows) is called as each chunk is
+# parsed, normalized and added to the stats. Returns the statistics and the
+# number of rows read
+def collect_column_stats(file, normalized_data_path=None, chunk_rows=INGEST_CHUNK_ROWS, progress=None,
+                         column_stats=None, header=True):
+    columns = [stats.name for stats in column_stats] if column_stats is not None else None
+    header_written = not header
+    rows = 0
+    _report(progress, 'parse', rows)
+    if column_stats is None:
+        dtypes = infer_csv_dtypes(file, chunk_rows)
+    else:
+        dtypes = stats_dtypes(file, column_stats)
+    for chunk in _read_chunks(file, chunk_rows, dtypes):
+        rows += len(chunk)
+        _report(progress, 'normalize', rows)
+        chunk = normalize_dataframe(chunk)
+        if columns is None:
+            columns = list(chunk.columns)
+        elif set(chunk.columns) != set(columns):
+            missing = [column for column in columns if column not in chunk.columns]
+            extra = [column for column in chunk.columns if column not in columns]
+            raise ValueError(f"The columns do not match the existing data (missing: {missing}, unexpected: {extra})")
+        if list(chunk.columns) != columns:
+            chunk = chunk[columns]
+        _report(progress, 'stats', rows)
+        if column_stats is None:
+            column_stats = [ColumnStats(column) for column in columns]
+        for stats, column in zip(column_stats, columns):
+            stats.update(chunk[column])
+        if normalized_data_path:
+            chunk.to_csv(normalized_data_path, mode='a' if header_written else 'w', header=not header_written, index=False)
+            header_written = True
+        _report(progress, 'parse', rows)
+    return column_stats or [], rows
+
+# Function to generate metadata from the file, optionally writing the
+# normalized data to normalized_data_path as it goes. progress(stage, rows)
+# is called as each chunk is parsed, normalized and added to the stats
+def generate_metadata_from_file(file, normalized_data_path=None, chunk_rows=INGEST_CHUNK_ROWS, progress=None):
+    column_stats, _ = collect_column_stats(file, normalized_data_path, chunk_rows, progress)
+    return [stats.to_metadata() for stats in column_stats]
 
 # Function to call GPT and get the title and information sheet
 def get_metadata_information(filename, metadata):
@@ -123,34 +247,47 @@ Usage Notes:
 Technical Information:
 • Format: CSV (.csv)"""
 
-    headers = {
-        'Content-Type': 'application/json',
-        'Authorization': f"Bearer {os.getenv('ICED_DEMO_API_KEY')}",
-    }
-
-    response = requests.post(
-        'https://api.openai.com/v1/chat/completions',
-        json={
-            'model': 'gpt-4o-2024-05-13',
-            'messages': [
-                {'role': 'user', 'content': prompt},
-            ],
-            'max_tokens': 4096,
-            'n': 1,
-            'stop': None,
-            'temperature': 0.2,
-        },
-        headers=headers
+    response_data = chat_completion(
+        [
+            {'role': 'user', 'content': prompt},
+        ],
+        max_tokens=4096,
+        temperature=0.2,
     )
-
-    response_data = response.json()
     print(f"response_data: {response_data}")
-    content = response_data['choices'][0]['message']['content'].strip()
+    content = completion_text(response_data)
     title = content.split('title:')[1].split('\n')[0].strip()
     information_sheet = content.split('information sheet:')[1].strip()
 
     return title, information_sheet
 
+# Function to read the title and information sheet of an existing package,
+# None when it has none
+def load_package_description(package):
+    package_dir = os.path.join('data', package)
+    try:
+        with open(os.path.join(package_dir, 'title.txt'), 'r') as title_file:
+            title = title_file.read().strip()
+        with open(os.path.join(package_dir, 'datainfo.md'), 'r') as info_file:
+            information_sheet = info_file.read()
+    except OSError:
+        return None
+    return (title, information_sheet) if title else None
+
+# Function to find an already ingested file with the same content, returns
+# the result of its ingestion or None
+def find_existing_upload(content_hash):
+    entry = content_index.find_file(content_hash)
+    if entry is None:
+        return None
+    description = load_package_description(entry['package'])
+    return {
+        'package': entry['package'],
+        'file': entry['file'],
+        'title': description[0] if description else entry['package'],
+        'duplicate': True,
+    }
+
 # Function to save metadata
 def save_metadata(directory, filename, metadata):
     metadata_dir = os.path.join(directory, 'metadata')
@@ -160,6 +297,38 @@ def save_metadata(directory, filename, metadata):
         json.dump(metadata, f)
     return metadata_path
 
+# Function to build the saved statistics state of a freshly ingested file
+def new_stats_state(column_stats, rows, content_hash):
+    return {
+        'format': STATS_STATE_FORMAT,
+        'version': 1,
+        'rows': rows,
+        'uploads': [content_hash],
+        'columns': [stats.to_state() for stats in column_stats],
+    }
+
+# Function to save the running statistics of a file, from which its metadata
+# is updated when rows are appended
+def save_stats_state(directory, filename, state):
+    metadata_dir = os.path.join(directory, 'metadata')
+    os.makedirs(metadata_dir, exist_ok=True)
+    state_path = os.path.join(metadata_dir, f"{filename}_stats.json")
+    tmp_path = f"{state_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f)
+    os.replace(tmp_path, state_path)
+    return state_path
+
+# Function to load the running statistics of a file, None when it has none
+def load_stats_state(directory, filename):
+    state_path = os.path.join(directory, 'metadata', f"{filename}_stats.json")
+    try:
+        with open(state_path, 'r') as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return state if state.get('format') == STATS_STATE_FORMAT else None
+
 # Function to save normalized data
 def save_normalized_data(directory, filename, normalized_data):
     normalized_data_dir = os.path.join(directory, 'normalized_data')
@@ -167,6 +336,16 @@ def save_normalized_data(directory, filename, normalized_data):
     normalized_data_path = os.path.join(normalized_data_dir, f"{filename}_normalized.csv")
     df = pd.DataFrame(normalized_data)
     df.to_csv(normalized_data_path, index=False)
+    write_columnar_cache(normalized_data_path)
+    return normalized_data_path
+
+# Function to move an already written normalized CSV into a package
+def move_normalized_data(directory, filename, source_path):
+    normalized_data_dir = os.path.join(directory, 'normalized_data')
+    os.makedirs(normalized_data_dir, exist_ok=True)
+    normalized_data_path = os.path.join(normalized_data_dir, f"{filename}_normalized.csv")
+    shutil.move(source_path, normalized_data_path)
+    write_columnar_cache(normalized_data_path)
     return normalized_data_path
 
 # Function to save original CSV
@@ -177,7 +356,7 @@ def save_original_data(directory, filename, file):
     
     file.seek(0)  # Move to the beginning of the file
     with open(data_path, 'wb') as f:
-        f.write(file.read())
+        shutil.copyfileobj(file, f)
     
     return data_path
 
@@ -185,23 +364,63 @@ def save_original_data(directory, filename, file):
 def sanitize_directory_name(name):
     return re.sub(r'[<>:"/\\|?*]', '_', name)
 
-# Function to ingest new data
-def ingest_new_data(file, package):
+# Function to ingest new data, reporting progress(stage, rows) through the
+# parse, normalize, stats, describe, write and profile stages. A file that was
+# already ingested is not ingested again, and a file with the columns of an
+# existing one reuses its title and information sheet
+def ingest_new_data(file, package, progress=None, content_hash=None):
     filename = os.path.splitext(file.filename)[0]
-    metadata, normalized_data = generate_metadata_from_file(file)
-    title, information_sheet = get_metadata_information(filename, metadata)
+
+    if content_hash is None:
+        content_hash = stream_content_hash(file)
+    existing = find_existing_upload(content_hash)
+    if existing is not None:
+        print(f"{file.filename} was already ingested as {existing['package']}/{existing['file']}")
+        return existing
+
+    # The package directory depends on the title, so the normalized data is
+    # streamed to a temporary file first and moved into place afterwards
+    os.makedirs('data', exist_ok=True)
+    normalized_fd, normalized_tmp_path = tempfile.mkstemp(suffix='.csv', dir='data')
+    os.close(normalized_fd)
+    try:
+        column_stats, rows = collect_column_stats(file, normalized_tmp_path, progress=progress)
+        metadata = [stats.to_metadata() for stats in column_stats]
+        _report(progress, 'describe')
+        same_schema = content_index.find_schema(schema_fingerprint(column['name'] for column in metadata))
+        description = load_package_description(same_schema['package']) if same_schema else None
+        reused_package = None
+        if description is not None:
+            print(f"Reusing the description of {same_schema['package']}, its file {same_schema['file']} has the same columns")
+            title, information_sheet = description
+            reused_package = same_schema['package']
+        else:
+            title, information_sheet = get_metadata_information(filename, metadata)
+    except Exception:
+        os.remove(normalized_tmp_path)
+        raise
 
     title.replace("*", "")
 
-    # Sanitize the title for directory name
-    sanitized_title = sanitize_directory_name(title.replace(' ', '_'))
+    # Sanitize the title for directory name, files with the columns of an
+    # existing package go to that package
+    sanitized_title = reused_package or sanitize_directory_name(title.replace(' ', '_'))
     title_dir = os.path.join('data', sanitized_title)
     os.makedirs(title_dir, exist_ok=True)
+    _report(progress, 'write')
 
     # Save original data, metadata, and normalized data in the appropriate directories
-    save_original_data(title_dir, filename, file)
+    data_path = save_original_data(title_dir, filename, file)
+    precompress_file(data_path)
     save_metadata(title_dir, filename, metadata)
-    save_normalized_data(title_dir, filename, normalized_data)
+    save_stats_state(title_dir, filename, new_stats_state(column_stats, rows, content_hash))
+    normalized_path = move_normalized_data(title_dir, filename, normalized_tmp_path)
+    _report(progress, 'profile')
+    try:
+        write_profile(normalized_path, profile_path(sanitized_title, filename))
+    except Exception as e:
+        # The profile is rebuilt on first use, it must not fail the ingestion
+        print(f"Could not build the profile of {normalized_path}: {e}")
 
     pdfs_dir = os.path.join(title_dir, 'pdfs')
 
@@ -211,12 +430,138 @@ def ingest_new_data(file, package):
     with open(os.path.join(title_dir, 'title.txt'), 'w') as title_file:
         title_file.write(title)
 
-    # Save title and information sheet
-    with open(os.path.join(title_dir, 'summary.txt'), 'w') as summary_file:
-        summary_file.write("")
-    
+    # Keep the summary of an existing package
+    summary_path = os.path.join(title_dir, 'summary.txt')
+    if not os.path.exists(summary_path):
+        with open(summary_path, 'w') as summary_file:
+            summary_file.write("")
+
     with open(os.path.join(title_dir, 'datainfo.md'), 'w') as info_file:
         info_file.write(information_sheet)
-    
+
+    dataset_catalog.update_package(sanitized_title)
+    content_index.record(data_path, content_hash)
+
     print(f"Title: {title}")
     print("Information sheet saved to datainfo.md")
+
+    return {'package': sanitized_title, 'file': f"{filename}.csv", 'title': title}
+
+_append_locks = {}
+_append_locks_lock = threading.Lock()
+
+def _append_lock(data_path):
+    with _append_locks_lock:
+        return _append_locks.setdefault(data_path, threading.Lock())
+
+def _ends_with_newline(path):
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        if f.tell() == 0:
+            return True
+        f.seek(-1, os.SEEK_END)
+        return f.read(1) == b'\n'
+
+# Function to append the rows of an upload to the original CSV of a file. The
+# rows are copied as they are when the upload has the columns in the same
+# order, and are reordered to the columns of the original otherwise
+def append_original_data(data_path, file, columns, chunk_rows=INGEST_CHUNK_ROWS):
+    file.seek(0)
+    header = list(pd.read_csv(file, nrows=0, dtype=str).columns)
+    sources = {}
+    for column in header:
+        sources[normalize_key(column)] = column
+
+    file.seek(0)
+    with open(data_path, 'ab') as f:
+        if not _ends_with_newline(data_path):
+            f.write(b'\n')
+        if len(sources) == len(header) and list(sources) == columns:
+            file.readline()
+            shutil.copyfileobj(file, f)
+            return data_path
+        # Read the values as text so they are written back exactly as uploaded
+        for chunk in pd.read_csv(file, chunksize=chunk_rows, dtype=str, keep_default_na=False):
+            f.write(chunk[[sources[column] for column in columns]].to_csv(header=False, index=False).encode('utf-8'))
+    return data_path
+
+# Function to rebuild the running statistics of a file ingested before they
+# were saved, from its normalized data
+def rebuild_stats_state(directory, filename, normalized_path):
+    print(f"No saved statistics for {normalized_path}, reading it once to rebuild them")
+    column_stats, rows = collect_column_stats(normalized_path)
+    state = new_stats_state(column_stats, rows, None)
+    state['uploads'] = []
+    save_stats_state(directory, filename, state)
+    return state
+
+# Function to append the rows of an upload to an existing file of a package,
+# reporting progress(stage, rows) through the parse, normalize, stats, write
+# and profile stages. Only the new rows are normalized and added to the
+# statistics, the normalized data and its columnar cache; the rows that were
+# already ingested are not read again. The version in the saved statistics
+# counts the appends, and appending the same upload again does nothing
+def append_new_data(file, package, target, progress=None, content_hash=None):
+    filename = os.path.splitext(os.path.basename(target))[0]
+    package_dir = os.path.join('data', package)
+    data_path = os.path.join(package_dir, 'data', f"{filename}.csv")
+    normalized_path = os.path.join(package_dir, 'normalized_data', f"{filename}_normalized.csv")
+    if not os.path.isfile(data_path) or not os.path.isfile(normalized_path):
+        raise FileNotFoundError(f"{package}/{filename}.csv has not been ingested")
+    if content_hash is None:
+        content_hash = stream_content_hash(file)
+
+    description = load_package_description(package)
+    result = {'package': package, 'file': f"{filename}.csv", 'title': description[0] if description else package}
+
+    with _append_lock(data_path):
+        state = load_stats_state(package_dir, filename)
+        if state is None:
+            state = rebuild_stats_state(package_dir, filename, normalized_path)
+        if content_hash in state['uploads']:
+            print(f"{file.filename} was already appended to {package}/{filename}.csv")
+            return dict(result, duplicate=True, rows=state['rows'], version=state['version'])
+
+        # The new rows are normalized to a temporary file first, so nothing is
+        # appended when they do not fit the existing columns
+        column_stats = [ColumnStats.from_state(column) for column in state['columns']]
+        appended_fd, appended_path = tempfile.mkstemp(suffix='.csv', dir='data')
+        os.close(appended_fd)
+        try:
+            column_stats, rows = collect_column_stats(
+                file, appended_path, progress=progress, column_stats=column_stats, header=False)
+            _report(progress, 'write')
+            if rows == 0:
+                return dict(result, rowsAppended=0, rows=state['rows'], version=state['version'])
+
+            columns = [stats.name for stats in column_stats]
+            new_rows = pd.read_csv(appended_path, header=None, names=columns)
+            previous_signature = source_signature(normalized_path)
+            append_original_data(data_path, file, columns)
+            with open(appended_path, 'rb') as source, open(normalized_path, 'ab') as destination:
+                shutil.copyfileobj(source, destination)
+            append_columnar_cache(normalized_path, previous_signature, new_rows, file_content_hash(appended_path))
+        finally:
+            os.remove(appended_path)
+
+        state = dict(
+            state,
+            version=state['version'] + 1,
+            rows=state['rows'] + rows,
+            uploads=state['uploads'] + [content_hash],
+            columns=[stats.to_state() for stats in column_stats],
+        )
+        save_metadata(package_dir, filename, [stats.to_metadata() for stats in column_stats])
+        save_stats_state(package_dir, filename, state)
+
+        precompress_file(data_path)
+        _report(progress, 'profile')
+        try:
+            write_profile(normalized_path, profile_path(package, filename))
+        except Exception as e:
+            print(f"Could not build the profile of {normalized_path}: {e}")
+
+    dataset_catalog.update_package(package)
+    print(f"Appended {rows} rows to {package}/{filename}.csv, version {state['version']}")
+
+    return dict(result, rowsAppended=rows, rows=state['rows'], version=state['version'])
@@ -0,0 +1,237 @@
+import os
+import json
+import time
+import uuid
+import queue
+import logging
+import threading
+from werkzeug.datastructures import FileStorage
+from app.util.ingest_data import ingest_new_data, append_new_data, find_existing_upload
+from app.util.content_index import copy_and_hash
+
+logger = logging.getLogger(__name__)
+
+# Background ingestion of uploaded CSV files.
+#
+# /upload spools the file to disk, queues a job and returns its id right
+# away; a few worker threads run ingest_new_data for the queued jobs. The
+# queue is bounded, so when it is full new uploads are refused instead of
+# piling up. The state of every job is also written to a JSON file next to
+# the spooled uploads, so any worker process can answer /upload/<job_id>.
+#
+# Uploads are hashed while they are spooled; a file that was already ingested
+# completes at once with the existing package and is not queued.
+#
+# Jobs in append mode add the rows of the upload to an existing file of the
+# package (append_new_data) instead of ingesting it as a new file.
+
+INGEST_WORKERS = int(os.getenv('BM_INGEST_WORKERS', 2))
+INGEST_QUEUE_SIZE = int(os.getenv('BM_INGEST_QUEUE_SIZE', 8))
+INGEST_JOB_TTL = float(os.getenv('BM_INGEST_JOB_TTL', 24 * 60 * 60))
+INGEST_UPLOAD_DIR = os.getenv('BM_INGEST_UPLOAD_DIR', os.path.join('data', '.uploads'))
+
+STAGES = ['parse', 'normalize', 'stats', 'describe', 'write', 'profile']
+APPEND_STAGES = ['parse', 'normalize', 'stats', 'write', 'profile']
+INGEST_MODES = ('create', 'append')
+
+class IngestQueueFull(Exception):
+    pass
+
+class IngestJob:
+    def __init__(self, job_id, filename, package, upload_path, mode='create', target=None):
+        self.id = job_id
+        self.filename = filename
+        self.package = package
+        self.upload_path = upload_path
+        self.mode = mode
+        # File of the package the rows are appended to in append mode
+        self.target = target
+        self.content_hash = None
+        self.status = 'queued'
+        self.stage = None
+        self.rows = 0
+        self.stage_seconds = {}
+        self.stage_started = None
+        self.error = None
+        self.result = None
+        self.created = time.time()
+        self.finished = None
+
+    # Called by ingest_new_data and append_new_data as they move through the stages
+    def progress(self, stage, rows=None):
+        now = time.time()
+        if self.stage is not None:
+            self.stage_seconds[self.stage] = self.stage_seconds.get(self.stage, 0.0) + now - self.stage_started
+        self.stage = stage
+        self.stage_started = now
+        if rows is not None:
+            self.rows = rows
+
+    def _stage_status(self, stage):
+        if stage not in self.stage_seconds and stage != self.stage:
+            return 'pending'
+        if self.status == 'running' and stage == self.stage:
+            return 'running'
+        if self.status == 'failed' and stage == self.stage:
+            return 'failed'
+        return 'done'
+
+    def to_dict(self):
+        return {
+            'jobId': self.id,
+            'file': self.filename,
+            'package': self.package,
+            'mode': self.mode,
+            'target': self.target,
+            'status': self.status,
+            'stage': self.stage,
+            'rowsProcessed': self.rows,
+            'stages': [
+                {'name': stage, 'status': self._stage_status(stage), 'seconds': round(self.stage_seconds.get(stage, 0.0), 3)}
+                for stage in (APPEND_STAGES if self.mode == 'append' else STAGES)
+            ],
+            'error': self.error,
+            'result': self.result,
+            'created': self.created,
+            'finished': self.finished,
+        }
+
+class IngestJobQueue:
+    def __init__(self, workers=INGEST_WORKERS, maxsize=INGEST_QUEUE_SIZE, directory=INGEST_UPLOAD_DIR, ttl=INGEST_JOB_TTL):
+        self.workers = workers
+        self.directory = directory
+        self.ttl = ttl
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def _start_workers(self):
+        with self._lock:
+            self._threads = [thread for thread in self._threads if thread.is_alive()]
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._work, name=f"ingest-{len(self._threads)}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def _status_path(self, job_id):
+        return os.path.join(self.directory, f"{job_id}.json")
+
+    def _save(self, job):
+        path = self._status_path(job.id)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(job.to_dict(), f)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f"Could not save the state of ingest job {job.id}: {e}")
+
+    # Function to spool an upload and queue its ingestion, or the append of
+    # its rows to the file target of the package, returns the job
+    def submit(self, file, package, mode='create', target=None):
+        if mode not in INGEST_MODES:
+            raise ValueError(f"Unknown ingest mode {mode}")
+        self._start_workers()
+        self._prune()
+        # Refuse before spooling the file when nothing can be queued anyway
+        if self._queue.full():
+            raise IngestQueueFull(f"{self._queue.maxsize} uploads are already waiting to be processed")
+        os.makedirs(self.directory, exist_ok=True)
+        job_id = uuid.uuid4().hex
+        upload_path = os.path.join(self.directory, f"{job_id}.csv")
+        with open(upload_path, 'wb') as f:
+            content_hash = copy_and_hash(file.stream, f)
+
+        job = IngestJob(job_id, file.filename, package, upload_path, mode, target)
+        job.content_hash = content_hash
+        # Appending a file that was ingested on its own is fine, appending it
+        # twice is caught by append_new_data
+        existing = find_existing_upload(content_hash) if mode == 'create' else None
+        if existing is not None:
+            os.remove(upload_path)
+            job.status = 'succeeded'
+            job.result = existing
+            job.finished = time.time()
+            with self._lock:
+                self._jobs[job_id] = job
+            self._save(job)
+            return job
+
+        try:
+            self._queue.put_nowait(job)
+        except queue.Full:
+            os.remove(upload_path)
+            raise IngestQueueFull(f"{self._queue.maxsize} uploads are already waiting to be processed")
+        with self._lock:
+            self._jobs[job_id] = job
+        self._save(job)
+        return job
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            # Save on every change of stage, not on every chunk
+            def progress(stage, rows=None, job=job):
+                changed = stage != job.stage
+                job.progress(stage, rows)
+                if changed:
+                    self._save(job)
+
+            job.status = 'running'
+            self._save(job)
+            try:
+                with open(job.upload_path, 'rb') as stream:
+                    upload = FileStorage(stream=stream, filename=job.filename)
+                    if job.mode == 'append':
+                        job.result = append_new_data(upload, job.package, job.target, progress, job.content_hash)
+                    else:
+                        job.result = ingest_new_data(upload, job.package, progress, job.content_hash)
+                job.progress(None)
+                job.status = 'succeeded'
+            except Exception as e:
+                logger.exception(f"Ingest job {job.id} failed")
+                job.progress(job.stage)
+                job.status = 'failed'
+                job.error = str(e)
+            finally:
+                job.finished = time.time()
+                self._save(job)
+                try:
+                    os.remove(job.upload_path)
+                except OSError:
+                    pass
+                self._queue.task_done()
+
+    # Function to get the state of a job, from this process or from the
+    # state file written by another one
+    def get(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is not None:
+            return job.to_dict()
+        if not job_id or not all(c in '0123456789abcdef' for c in job_id):
+            return None
+        try:
+            with open(self._status_path(job_id), 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _prune(self):
+        now = time.time()
+        with self._lock:
+            for job_id, job in list(self._jobs.items()):
+                if job.finished is not None and now - job.finished > self.ttl:
+                    del self._jobs[job_id]
+        if not os.path.isdir(self.directory):
+            return
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                if name.endswith('.json') and now - os.path.getmtime(path) > self.ttl:
+                    os.remove(path)
+            except OSError:
+                pass
+
+ingest_jobs = IngestJobQueue()
@@ -0,0 +1,184 @@
+import os
+import re
+import math
+import time
+import logging
+import threading
+from collections import Counter
+
+logger = logging.getLogger(__name__)
+
+# Local intent router for /bm-chat.
+#
+# Decides between GENERATE_GRAPH, PREFORM_PYTHON_ANALYSIS and
+# DONT_GENERATE_GRAPH_OR_CODE without an LLM call when it can do so
+# confidently: with keyword rules that the small naive Bayes classifier
+# trained on the examples below agrees with, or with that classifier alone
+# when it is nearly certain. A short message such as "show me" gives the
+# classifier little evidence, so classifier-only decisions need a higher
+# confidence than rule ones. Messages it is unsure about are passed to the
+# LLM classifier. Counters of how each message was routed are
+# kept so the saved latency can be measured.
+
+GENERATE_GRAPH = 'GENERATE_GRAPH'
+PREFORM_PYTHON_ANALYSIS = 'PREFORM_PYTHON_ANALYSIS'
+DONT_GENERATE_GRAPH_OR_CODE = 'DONT_GENERATE_GRAPH_OR_CODE'
+
+ROUTER_ENABLED = os.getenv('BM_INTENT_ROUTER', '1') != '0'
+ROUTER_THRESHOLD = float(os.getenv('BM_INTENT_ROUTER_THRESHOLD', 0.9))
+# Confidence needed when no rule agrees with the classifier
+CLASSIFIER_THRESHOLD = float(os.getenv('BM_INTENT_CLASSIFIER_THRESHOLD', 0.99))
+
+# (label, confidence, pattern). A rule only decides when the classifier
+# agrees with it, so a keyword used in another sense ("what is the average
+# plot size", "draw conclusions") is left to the classifier and the LLM
+INTENT_RULES = [
+    # Questions about what a term or column means are never analysis
+    (DONT_GENERATE_GRAPH_OR_CODE, 0.95, re.compile(
+        r"^\s*(what (does|do) .+ (mean|stand for)|what is (meant by|the meaning of|the definition of)|define|explain what)\b")),
+    (GENERATE_GRAPH, 0.97, re.compile(
+        r"\b(plot|graph|chart|visuali[sz]e|visuali[sz]ation|histogram|pie|scatter|bar ?chart|line ?chart|diagram"
+        r"|draw (a|an|me)\b)")),
+    (PREFORM_PYTHON_ANALYSIS, 0.93, re.compile(
+        r"\b(average|mean|median|sum|total|how many|number of|count|percentage|percent|proportion|share of"
+        r"|correlat\w*|regress\w*|t-?test|chi-?square|anova|standard deviation|variance|significan\w*"
+        r"|maximum|minimum|highest|lowest|calculate|compute|statistic\w*|ratio)\b")),
+    (DONT_GENERATE_GRAPH_OR_CODE, 0.95, re.compile(
+        r"^\s*(hi|hello|hey|good (morning|afternoon|evening)|thanks|thank you|ok|okay|bye)\b[\s!.?]*$")),
+    (DONT_GENERATE_GRAPH_OR_CODE, 0.92, re.compile(
+        r"^\s*(what can you do|who are you|what are you|what is iced|what does iced do|help)\b")),
+]
+
+TRAINING_EXAMPLES = [
+    (GENERATE_GRAPH, "plot household size by state"),
+    (GENERATE_GRAPH, "show me a bar chart of income by region"),
+    (GENERATE_GRAPH, "graph dietary diversity by region"),
+    (GENERATE_GRAPH, "can you visualize the distribution of farm area"),
+    (GENERATE_GRAPH, "draw a pie chart of beneficiary status"),
+    (GENERATE_GRAPH, "show the trend of income over the years"),
+    (GENERATE_GRAPH, "make a histogram of age"),
+    (GENERATE_GRAPH, "show me a scatter of income against farm size"),
+    (GENERATE_GRAPH, "display income by gender in a chart"),
+    (GENERATE_GRAPH, "show a line chart of yield per year"),
+    (GENERATE_GRAPH, "compare beneficiaries and non beneficiaries visually"),
+    (GENERATE_GRAPH, "show me the breakdown of crops in a graph"),
+    (PREFORM_PYTHON_ANALYSIS, "what is the average household size by state"),
+    (PREFORM_PYTHON_ANALYSIS, "how many women are in the dataset"),
+    (PREFORM_PYTHON_ANALYSIS, "what percentage of households have access to credit"),
+    (PREFORM_PYTHON_ANALYSIS, "is there a significant difference in income between beneficiaries"),
+    (PREFORM_PYTHON_ANALYSIS, "calculate the median income"),
+    (PREFORM_PYTHON_ANALYSIS, "what is the correlation between farm size and yield"),
+    (PREFORM_PYTHON_ANALYSIS, "which state has the highest total income"),
+    (PREFORM_PYTHON_ANALYSIS, "run a t test on dietary diversity scores"),
+    (PREFORM_PYTHON_ANALYSIS, "count the respondents per region"),
+    (PREFORM_PYTHON_ANALYSIS, "what is the mean yield for beneficiaries"),
+    (PREFORM_PYTHON_ANALYSIS, "compare the income of men and women"),
+    (PREFORM_PYTHON_ANALYSIS, "what share of farmers use irrigation"),
+    (DONT_GENERATE_GRAPH_OR_CODE, "what is this dataset about"),
+    (DONT_GENERATE_GRAPH_OR_CODE, "tell me about the context of this study"),
+    (DONT_GENERATE_GRAPH_OR_CODE, "who collected this data"),
+    (DONT_GENERATE_GRAPH_OR_CODE, "what does dietary diversity mean"),
+    (DONT_GENERATE_GRAPH_OR_CODE, "explain what a beneficiary is"),
+    (DONT_GENERATE_GRAPH_OR_CODE, "hello"),
+    (DONT_GENERATE_GRAPH_OR_CODE, "thank you that was helpful"),
+    (DONT_GENERATE_GRAPH_OR_CODE, "what can you help me with"),
+    (DONT_GENERATE_GRAPH_OR_CODE, "what are the limitations of this data"),
+    (DONT_GENERATE_GRAPH_OR_CODE, "why was this survey done"),
+    (DONT_GENERATE_GRAPH_OR_CODE, "what does the column bl_state mean"),
+    (DONT_GENERATE_GRAPH_OR_CODE, "summarize the findings of the evaluation"),
+]
+
+_TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+
+# Function to split a message into unigram and bigram features
+def message_features(message):
+    tokens = _TOKEN_PATTERN.findall(message.lower())
+    return tokens + [f"{a} {b}" for a, b in zip(tokens, tokens[1:])]
+
+# Multinomial naive Bayes over message_features with add-one smoothing
+class NaiveBayesIntentClassifier:
+    def __init__(self, examples):
+        self.labels = sorted({label for label, _ in examples})
+        self.feature_counts = {label: Counter() for label in self.labels}
+        label_counts = Counter()
+        for label, message in examples:
+            label_counts[label] += 1
+            self.feature_counts[label].update(message_features(message))
+        self.vocabulary = set().union(*self.feature_counts.values())
+        self.log_priors = {label: math.log(label_counts[label] / len(examples)) for label in self.labels}
+        self.totals = {label: sum(counts.values()) for label, counts in self.feature_counts.items()}
+
+    # Returns (label, probability) of the most likely label
+    def predict(self, message):
+        features = [f for f in message_features(message) if f in self.vocabulary]
+        if not features:
+            return None, 0.0
+        scores = {}
+        for label in self.labels:
+            denominator = self.totals[label] + len(self.vocabulary)
+            scores[label] = self.log_priors[label] + sum(
+                math.log((self.feature_counts[label][f] + 1) / denominator) for f in features)
+        best = max(scores, key=scores.get)
+        norm = sum(math.exp(score - scores[best]) for score in scores.values())
+        return best, 1.0 / norm
+
+_classifier = NaiveBayesIntentClassifier(TRAINING_EXAMPLES)
+
+_stats_lock = threading.Lock()
+_stats = {
+    'messages': 0,
+    'rule': 0,
+    'classifier': 0,
+    'llm_fallback': 0,
+    'llm_fallback_seconds': 0.0,
+    'labels': Counter(),
+}
+
+# Function to classify a message locally, returns (label, confidence, source)
+def classify_locally(message):
+    text = message.lower()
+    label, probability = _classifier.predict(message)
+    for rule_label, confidence, pattern in INTENT_RULES:
+        if pattern.search(text):
+            if rule_label == label:
+                return label, max(confidence, probability), 'rule'
+            # The first matching rule disagrees with the classifier, so
+            # neither is trusted on its own
+            return label, min(probability, ROUTER_THRESHOLD / 2), 'classifier'
+    return label, probability, 'classifier'
+
+# Function to pick the action for a message, calling llm_fallback() when
+# the local router is not confident enough
+def route_intent(message, llm_fallback):
+    label, confidence, source = (None, 0.0, None)
+    if ROUTER_ENABLED:
+        label, confidence, source = classify_locally(message)
+
+    threshold = ROUTER_THRESHOLD if source == 'rule' else CLASSIFIER_THRESHOLD
+    if label is not None and confidence >= threshold:
+        logger.info(f"Intent routed locally by {source}: {label} ({confidence:.2f})")
+    else:
+        start = time.perf_counter()
+        label = llm_fallback()
+        elapsed = time.perf_counter() - start
+        source = 'llm_fallback'
+        with _stats_lock:
+            _stats['llm_fallback_seconds'] += elapsed
+
+    with _stats_lock:
+        _stats['messages'] += 1
+        _stats[source] += 1
+        _stats['labels'][label] += 1
+    return label
+
+# Function to get the router counters
+def router_stats():
+    with _stats_lock:
+        stats = dict(_stats, labels=dict(_stats['labels']))
+    local = stats['rule'] + stats['classifier']
+    stats['local_hit_rate'] = local / stats['messages'] if stats['messages'] else 0.0
+    average_llm_seconds = stats['llm_fallback_seconds'] / stats['llm_fallback'] if stats['llm_fallback'] else None
+    stats['average_llm_seconds'] = average_llm_seconds
+    # Every local decision saves roughly one LLM classification round trip
+    stats['estimated_seconds_saved'] = local * average_llm_seconds if average_llm_seconds is not None else None
+    return stats
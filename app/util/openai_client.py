@@ -0,0 +1,123 @@
+import os
+import json
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Shared client for the OpenAI chat completions API.
+#
+# All calls go through one requests.Session per process, so TLS connections
+# are kept alive and reused instead of being opened for every call. Calls
+# have connect/read timeouts and are retried with exponential backoff on 429
+# and 5xx responses and on connection errors. A request that timed out or
+# failed while reading the response is not retried, as OpenAI may already be
+# generating (and billing) the completion.
+#
+# OPENAI_API_BASE can point the client at a local stub server.
+
+OPENAI_API_BASE = os.getenv('OPENAI_API_BASE', 'https://api.openai.com/v1').rstrip('/')
+OPENAI_MODEL = 'gpt-4o-2024-05-13'
+OPENAI_EMBEDDING_MODEL = os.getenv('BM_EMBEDDING_MODEL', 'text-embedding-ada-002')
+OPENAI_CONNECT_TIMEOUT = float(os.getenv('BM_OPENAI_CONNECT_TIMEOUT', 10))
+OPENAI_READ_TIMEOUT = float(os.getenv('BM_OPENAI_READ_TIMEOUT', 120))
+OPENAI_MAX_RETRIES = int(os.getenv('BM_OPENAI_MAX_RETRIES', 3))
+OPENAI_BACKOFF_FACTOR = float(os.getenv('BM_OPENAI_BACKOFF_FACTOR', 0.5))
+OPENAI_POOL_SIZE = int(os.getenv('BM_OPENAI_POOL_SIZE', 20))
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+_session = None
+_session_lock = threading.Lock()
+
+def _headers():
+    return {
+        'Content-Type': 'application/json',
+        'Authorization': f"Bearer {os.getenv('ICED_DEMO_API_KEY')}",
+    }
+
+def _payload(messages, max_tokens, temperature, n, model, extra):
+    payload = {
+        'model': model,
+        'messages': messages,
+        'max_tokens': max_tokens,
+        'n': n,
+        'stop': None,
+        'temperature': temperature,
+    }
+    payload.update(extra)
+    return payload
+
+# Function to get the process-wide pooled session
+def get_session():
+    global _session
+    with _session_lock:
+        if _session is None:
+            retry = Retry(
+                total=OPENAI_MAX_RETRIES,
+                read=False,
+                backoff_factor=OPENAI_BACKOFF_FACTOR,
+                status_forcelist=RETRY_STATUSES,
+                allowed_methods=frozenset(['POST']),
+                respect_retry_after_header=True,
+                raise_on_status=False,
+            )
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=OPENAI_POOL_SIZE, max_retries=retry)
+            session = requests.Session()
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _session = session
+        return _session
+
+# Function to call the chat completions API, returns the decoded response
+def chat_completion(messages, max_tokens=1000, temperature=0.1, n=1, model=OPENAI_MODEL, **extra):
+    response = get_session().post(
+        f"{OPENAI_API_BASE}/chat/completions",
+        json=_payload(messages, max_tokens, temperature, n, model, extra),
+        headers=_headers(),
+        timeout=(OPENAI_CONNECT_TIMEOUT, OPENAI_READ_TIMEOUT),
+    )
+    return response.json()
+
+# Function to call the chat completions API with streaming, yields the text
+# deltas of the first choice as they arrive
+def stream_chat_completion(messages, max_tokens=1000, temperature=0.1, model=OPENAI_MODEL, **extra):
+    payload = _payload(messages, max_tokens, temperature, 1, model, extra)
+    payload['stream'] = True
+    with get_session().post(
+        f"{OPENAI_API_BASE}/chat/completions",
+        json=payload,
+        headers=_headers(),
+        timeout=(OPENAI_CONNECT_TIMEOUT, OPENAI_READ_TIMEOUT),
+        stream=True,
+    ) as response:
+        if response.status_code != 200:
+            raise RuntimeError(f"OpenAI returned {response.status_code}: {response.text}")
+        for line in response.iter_lines(decode_unicode=True):
+            if not line or not line.startswith('data:'):
+                continue
+            data = line[len('data:'):].strip()
+            if data == '[DONE]':
+                break
+            chunk = json.loads(data)
+            if not chunk.get('choices'):
+                continue
+            text = chunk['choices'][0].get('delta', {}).get('content')
+            if text:
+                yield text
+
+# Function to call the embeddings API, returns one vector per text
+def create_embeddings(texts, model=OPENAI_EMBEDDING_MODEL):
+    response = get_session().post(
+        f"{OPENAI_API_BASE}/embeddings",
+        json={'model': model, 'input': texts},
+        headers=_headers(),
+        timeout=(OPENAI_CONNECT_TIMEOUT, OPENAI_READ_TIMEOUT),
+    )
+    response_data = response.json()
+    if 'data' not in response_data:
+        raise RuntimeError(f"OpenAI returned {response.status_code}: {response_data}")
+    return [item['embedding'] for item in sorted(response_data['data'], key=lambda item: item['index'])]
+
+# Function to get the text of one choice of a chat completions response
+def completion_text(response_data, index=0):
+    return response_data['choices'][index]['message']['content'].strip()
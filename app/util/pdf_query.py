@@ -0,0 +1,53 @@
+import os
+
+# Question answering over PDF documents with langchain and Chroma.
+#
+# The langchain stack takes seconds and a lot of memory to import, so nothing
+# of it is imported with this module: PDFQuery imports it when the first
+# instance is created. The PDF reports of a package are searched through
+# app.util.document_index, which does not need it.
+
+def _import_langchain():
+    from langchain.embeddings.openai import OpenAIEmbeddings
+    from langchain.text_splitter import RecursiveCharacterTextSplitter
+    from langchain.vectorstores import Chroma
+    from langchain.document_loaders import PyPDFium2Loader
+    from langchain.chains.question_answering import load_qa_chain
+    from langchain.chat_models import ChatOpenAI
+    return OpenAIEmbeddings, RecursiveCharacterTextSplitter, Chroma, PyPDFium2Loader, load_qa_chain, ChatOpenAI
+
+class PDFQuery:
+    def __init__(self, openai_api_key=None) -> None:
+        (OpenAIEmbeddings, RecursiveCharacterTextSplitter, self._Chroma, self._PyPDFium2Loader,
+         self._load_qa_chain, ChatOpenAI) = _import_langchain()
+        self.embeddings = OpenAIEmbeddings(openai_api_key=openai_api_key)
+        os.environ["ICED_DEMO_API_KEY"] = openai_api_key
+        self.text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
+        self.llm = ChatOpenAI(temperature=0, openai_api_key=openai_api_key)
+        self.chain = None
+        self.db = None
+
+    def ask(self, question: str, chat_history: list) -> str:
+        if self.chain is None:
+            response = "Please, add a document."
+        else:
+            docs = self.db.get_relevant_documents(question)
+            response = self.chain.run(input_documents=docs, question=question, chat_history=chat_history)
+        return response
+
+    def ingest(self, file_path: os.PathLike) -> None:
+        loader = self._PyPDFium2Loader(file_path)
+        documents = loader.load()
+        splitted_documents = self.text_splitter.split_documents(documents)
+        self.db = self._Chroma.from_documents(splitted_documents, self.embeddings).as_retriever()
+        self.chain = self._load_qa_chain(self.llm, chain_type="stuff")
+
+    def ingest_folder(self, folder_path: os.PathLike) -> None:
+        for filename in os.listdir(folder_path):
+            if filename.endswith('.pdf'):
+                file_path = os.path.join(folder_path, filename)
+                self.ingest(file_path)
+
+    def forget(self) -> None:
+        self.db = None
+        self.chain = None
@@ -0,0 +1,117 @@
+import os
+import re
+
+# Compact text rendering of dataset metadata for the /bm-chat system prompt.
+#
+# Instead of the JSON dump of every column, each column becomes one line of
+# "name | type | values": the full value list for low-cardinality columns
+# (deduplicated and capped), the range for numeric columns and a few examples
+# for other columns. For wide datasets only the columns relevant to the
+# question are described, the others are listed by name.
+
+PROMPT_MAX_VALUES = int(os.getenv('BM_PROMPT_MAX_VALUES', 10))
+PROMPT_MAX_EXAMPLES = int(os.getenv('BM_PROMPT_MAX_EXAMPLES', 3))
+PROMPT_MAX_VALUE_LENGTH = int(os.getenv('BM_PROMPT_MAX_VALUE_LENGTH', 40))
+PROMPT_COLUMN_RELEVANCE = os.getenv('BM_PROMPT_COLUMN_RELEVANCE', '1') != '0'
+# Datasets with more columns than this only describe the relevant ones
+PROMPT_RELEVANCE_MIN_COLUMNS = int(os.getenv('BM_PROMPT_RELEVANCE_MIN_COLUMNS', 60))
+
+NUMERIC_TYPES = ('int', 'float')
+STOP_WORDS = {
+    'the', 'and', 'for', 'are', 'was', 'were', 'what', 'which', 'who', 'how', 'many', 'much', 'with', 'from',
+    'this', 'that', 'there', 'their', 'does', 'did', 'have', 'has', 'between', 'show', 'plot', 'graph', 'chart',
+    'average', 'mean', 'number', 'percentage', 'per', 'by', 'of', 'in', 'is', 'me', 'can', 'you', 'data',
+    'dataset', 'give', 'tell', 'about', 'all', 'each', 'compare', 'calculate',
+}
+
+_WORD_PATTERN = re.compile(r"[a-z]+")
+
+def _format_value(value):
+    if isinstance(value, float):
+        if value.is_integer():
+            return str(int(value))
+        return f"{value:.4g}"
+    text = str(value)
+    if len(text) > PROMPT_MAX_VALUE_LENGTH:
+        text = text[:PROMPT_MAX_VALUE_LENGTH - 3] + '...'
+    return text
+
+# Function to deduplicate the potential values of a column, dropping nulls
+def distinct_values(values):
+    seen = set()
+    result = []
+    for value in values or []:
+        if value is None or value == '' or value != value:
+            continue
+        text = _format_value(value)
+        if text not in seen:
+            seen.add(text)
+            result.append(text)
+    return result
+
+def _is_numeric(column):
+    return column['type'].startswith(NUMERIC_TYPES) and column.get('min') is not None
+
+# Function to describe the values of one column
+def describe_values(column, max_values=PROMPT_MAX_VALUES, max_examples=PROMPT_MAX_EXAMPLES):
+    values = distinct_values(column.get('potentialValues'))
+    unique = column.get('uniqueValues') or 0
+    # The metadata keeps every value of columns with few distinct values
+    complete = unique <= len(column.get('potentialValues') or [])
+
+    if complete and values:
+        shown = values[:max_values]
+        text = ', '.join(shown)
+        if len(values) > len(shown):
+            text += f", ... ({len(values)} values)"
+        return text
+    if _is_numeric(column):
+        text = f"{_format_value(column['min'])} to {_format_value(column['max'])}"
+        if column.get('avg') is not None:
+            text += f", mean {_format_value(column['avg'])}"
+        return f"{text}, {unique} distinct"
+    if values:
+        return f"{unique} distinct, e.g. {', '.join(values[:max_examples])}"
+    return f"{unique} distinct"
+
+def _words(text):
+    return {word for word in _WORD_PATTERN.findall(text.lower()) if len(word) > 2 and word not in STOP_WORDS}
+
+def _matches(word, part):
+    return word == part or (len(part) > 3 and len(word) > 3 and (word.startswith(part) or part.startswith(word)))
+
+# Function to score how relevant a column is to a question, by the words of
+# the question found in its name and values
+def column_relevance(column, question_words):
+    name_parts = _words(column['name'].replace('_', ' '))
+    score = sum(2 for word in question_words for part in name_parts if _matches(word, part))
+    value_words = set()
+    for value in distinct_values(column.get('potentialValues')):
+        value_words |= _words(value)
+    score += sum(1 for word in question_words if word in value_words)
+    return score
+
+# Function to pick the columns to describe for a question, or None for all
+def select_relevant_columns(metadata, question, min_columns=PROMPT_RELEVANCE_MIN_COLUMNS):
+    if not question or len(metadata) <= min_columns:
+        return None
+    question_words = _words(question)
+    if not question_words:
+        return None
+    relevant = {column['name'] for column in metadata if column_relevance(column, question_words) > 0}
+    return relevant or None
+
+# Function to render dataset metadata as compact text for a prompt
+def render_metadata(metadata, question=None, column_relevance=PROMPT_COLUMN_RELEVANCE):
+    relevant = select_relevant_columns(metadata, question) if column_relevance else None
+
+    lines = ['column | type | values']
+    others = []
+    for column in metadata:
+        if relevant is not None and column['name'] not in relevant:
+            others.append(column['name'])
+            continue
+        lines.append(f"{column['name']} | {column['type']} | {describe_values(column)}")
+    if others:
+        lines.append(f"Other columns (not described): {', '.join(others)}")
+    return '\n'.join(lines)
@@ -0,0 +1,123 @@
+import os
+import re
+import json
+import time
+import hashlib
+import logging
+import threading
+from cachetools import TTLCache
+
+logger = logging.getLogger(__name__)
+
+# Cache of /bm-chat replies.
+#
+# Keyed on the package, file, content version of the normalized dataset, the
+# normalized question and optionally the previous assistant turn, so a reply
+# is only reused for the same question against the same data. Follow-up
+# questions are not cached unless the previous turn is part of the key, as
+# their answer depends on the conversation. Entries expire
+# after a TTL and the least recently used ones are evicted when the cache is
+# full. Setting BM_RESPONSE_CACHE_DIR also keeps entries on disk, so they
+# survive restarts and are shared between worker processes.
+
+RESPONSE_CACHE_SIZE = int(os.getenv('BM_RESPONSE_CACHE_SIZE', 512))
+RESPONSE_CACHE_TTL = float(os.getenv('BM_RESPONSE_CACHE_TTL', 24 * 60 * 60))
+RESPONSE_CACHE_DIR = os.getenv('BM_RESPONSE_CACHE_DIR')
+# Cache follow-up questions too, keyed on the previous assistant turn
+RESPONSE_CACHE_PRIOR_TURN = os.getenv('BM_RESPONSE_CACHE_PRIOR_TURN', '0') == '1'
+
+_PUNCTUATION = re.compile(r"[^\w\s]")
+_WHITESPACE = re.compile(r"\s+")
+
+# Function to normalize a question so trivially different phrasings match
+def normalize_question(question):
+    question = _PUNCTUATION.sub(' ', question.lower())
+    return _WHITESPACE.sub(' ', question).strip()
+
+# Function to build the cache key of a question
+def response_cache_key(package, filename, dataset_version, question, prior_turn=None):
+    parts = [package, filename, dataset_version, normalize_question(question)]
+    if prior_turn is not None:
+        parts.append(hashlib.sha256(prior_turn.encode('utf-8')).hexdigest())
+    return hashlib.sha256(json.dumps(parts).encode('utf-8')).hexdigest()
+
+class ResponseCache:
+    def __init__(self, maxsize=RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL, directory=RESPONSE_CACHE_DIR):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.directory = directory
+        self._memory = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+    def _read_disk(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'r') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if time.time() - entry['created'] > self.ttl:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+        # Touch the file so pruning drops the least recently used entries
+        os.utime(path)
+        return entry['value']
+
+    def _write_disk(self, key, value):
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump({'created': time.time(), 'value': value}, f)
+        os.replace(tmp_path, path)
+        self._prune_disk()
+
+    def _prune_disk(self):
+        entries = [os.path.join(self.directory, name) for name in os.listdir(self.directory) if name.endswith('.json')]
+        if len(entries) <= self.maxsize:
+            return
+        entries.sort(key=os.path.getmtime)
+        for path in entries[:len(entries) - self.maxsize]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def get(self, key):
+        if key is None:
+            return None
+        with self._lock:
+            value = self._memory.get(key)
+        if value is None and self.directory:
+            value = self._read_disk(key)
+            if value is not None:
+                with self._lock:
+                    self._memory[key] = value
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def set(self, key, value):
+        if key is None:
+            return
+        with self._lock:
+            self._memory[key] = value
+        if self.directory:
+            try:
+                self._write_disk(key, value)
+            except OSError as e:
+                logger.warning(f"Could not persist cached response: {e}")
+
+response_cache = ResponseCache()
@@ -0,0 +1,132 @@
+import os
+import json
+import zlib
+import logging
+import threading
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+# Streaming and compression helpers for dataset responses.
+#
+# Rows are serialized in batches so the first bytes go out before the whole
+# table has been serialized, and compression is applied to the stream as it
+# is produced. Static files get precompressed variants kept in a hidden
+# directory next to them.
+
+STREAM_BATCH_ROWS = int(os.getenv('BM_STREAM_BATCH_ROWS', 1000))
+PRECOMPRESSED_DIR_NAME = '.precompressed'
+FILE_EXTENSIONS = {'gzip': '.gz', 'br': '.br'}
+
+# Function to list the content encodings this server can produce, best first
+def supported_encodings():
+    return (['br'] if brotli is not None else []) + ['gzip']
+
+# Function to pick the content encoding for a request
+def negotiate_encoding(accept_encodings):
+    best = accept_encodings.best_match(supported_encodings() + ['identity'], default='identity')
+    return None if best == 'identity' else best
+
+# Function to blank the missing values of a batch of rows. Categorical
+# columns are decoded first, as '' is not one of their categories
+def _fill_missing(batch):
+    categorical = batch.select_dtypes('category').columns
+    if len(categorical):
+        batch = batch.astype({column: object for column in categorical})
+    return batch.fillna('')
+
+# Function to serialize a DataFrame as a JSON array, one batch of rows at a time
+def iter_json_array(data, dumps=json.dumps, batch_rows=STREAM_BATCH_ROWS):
+    yield '['
+    for start in range(0, len(data), batch_rows):
+        batch = _fill_missing(data.iloc[start:start + batch_rows])
+        rows = dumps(batch.to_dict(orient='records'))[1:-1]
+        yield rows if start == 0 else ',' + rows
+    yield ']'
+
+# Function to serialize a DataFrame as newline delimited JSON
+def iter_ndjson(data, dumps=json.dumps, batch_rows=STREAM_BATCH_ROWS):
+    for start in range(0, len(data), batch_rows):
+        batch = _fill_missing(data.iloc[start:start + batch_rows])
+        yield ''.join(dumps(row) + '\n' for row in batch.to_dict(orient='records'))
+
+def _compressor(encoding):
+    if encoding == 'gzip':
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        return compressor.compress, compressor.flush
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=5)
+        return compressor.process, compressor.finish
+    raise ValueError(f"Unsupported encoding {encoding}")
+
+# Function to compress a stream of text or byte chunks with the given encoding
+def compress_chunks(chunks, encoding):
+    compress, flush = _compressor(encoding)
+    for chunk in chunks:
+        compressed = compress(chunk.encode('utf-8') if isinstance(chunk, str) else chunk)
+        if compressed:
+            yield compressed
+    yield flush()
+
+# Function to write a stream of chunks to a compressed file atomically
+def write_compressed_file(path, chunks, encoding):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        for block in compress_chunks(chunks, encoding):
+            f.write(block)
+    os.replace(tmp_path, path)
+    return path
+
+def _iter_file_blocks(path, block_size=1024 * 1024):
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            yield block
+
+# Function to get the precompressed variant of a file, creating it when
+# missing or older than the file itself
+def ensure_precompressed_file(path, encoding):
+    directory, name = os.path.split(path)
+    compressed_path = os.path.join(directory, PRECOMPRESSED_DIR_NAME, name + FILE_EXTENSIONS[encoding])
+    if not os.path.exists(compressed_path) or os.path.getmtime(compressed_path) < os.path.getmtime(path):
+        logger.info(f"Precompressing {path} with {encoding}")
+        write_compressed_file(compressed_path, _iter_file_blocks(path), encoding)
+    return compressed_path
+
+# Function to precompress a file with every supported encoding
+def precompress_file(path):
+    for encoding in supported_encodings():
+        ensure_precompressed_file(path, encoding)
+
+# Function to get the precompressed JSON array of a whole dataset version,
+# stored in the dataset's cache directory
+def ensure_precompressed_json(directory, version, data, encoding, dumps=json.dumps):
+    name = f"records-{version[:16]}.json{FILE_EXTENSIONS[encoding]}"
+    compressed_path = os.path.join(directory, name)
+    if not os.path.exists(compressed_path):
+        logger.info(f"Precompressing {len(data)} rows to {compressed_path}")
+        write_compressed_file(compressed_path, iter_json_array(data, dumps), encoding)
+        # Drop variants of older dataset versions
+        for other in os.listdir(directory):
+            if other.startswith('records-') and other.endswith(FILE_EXTENSIONS[encoding]) and other != name:
+                try:
+                    os.remove(os.path.join(directory, other))
+                except FileNotFoundError:
+                    # Removed by another request at the same time
+                    pass
+    return compressed_path
+
+# Function to format (event, payload) tuples as server-sent events
+def iter_sse(events, dumps=json.dumps):
+    for event, payload in events:
+        yield f"event: {event}\ndata: {dumps(payload)}\n\n"
+
+# Function to check whether a request asked for a server-sent event stream
+def wants_event_stream(request, data=None):
+    if data and data.get('stream'):
+        return True
+    return request.accept_mimetypes.best_match(['application/json', 'text/event-stream']) == 'text/event-stream'
@@ -0,0 +1,451 @@
+import os
+import io
+import sys
+import time
+import glob
+import queue
+import logging
+import tempfile
+import threading
+import traceback
+import subprocess
+import signal
+import socket
+import contextlib
+import multiprocessing
+import multiprocessing.connection
+from app.util.dataset_cache import load_normalized_dataframe, dataset_store, dataset_version
+from app.util.execution_cache import execution_cache
+
+logger = logging.getLogger(__name__)
+
+# Pool of long-lived processes that run the Python analysis code generated
+# for PREFORM_PYTHON_ANALYSIS.
+#
+# Workers are started as separate interpreters, import pandas/scipy and load
+# the normalized datasets (memory-mapped from their columnar caches) once,
+# then fork a fresh child for every job. Each job therefore starts from the
+# same pre-warmed state and nothing it changes (patched builtins, the working
+# directory, pandas options) reaches later jobs. Jobs attach the dataset from
+# the shared dataset store without copying it: workers run pandas in
+# copy-on-write mode, so a job only copies the columns it modifies. Each job
+# runs with a timeout and an output limit, each worker with an address space
+# limit; a job that times out or is cancelled is killed, its worker is kept.
+#
+# Setting BM_SANDBOX_WORKERS=0 falls back to one fresh interpreter per job.
+#
+# Results are memoized per code and dataset version (execution_cache), so the
+# same analysis is only run once per version of a dataset.
+#
+# run_analysis_candidates runs several versions of the code at once and keeps
+# the first that succeeds; the others are cancelled by killing their job.
+
+SANDBOX_WORKERS = int(os.getenv('BM_SANDBOX_WORKERS', 2))
+SANDBOX_TIMEOUT = float(os.getenv('BM_SANDBOX_TIMEOUT', 60))
+SANDBOX_MEMORY_MB = int(os.getenv('BM_SANDBOX_MEMORY_MB', 2048))
+SANDBOX_OUTPUT_LIMIT = int(os.getenv('BM_SANDBOX_OUTPUT_LIMIT', 64 * 1024))
+# How often a running job checks whether it was cancelled, in seconds
+SANDBOX_POLL_INTERVAL = 0.05
+# How long a worker gets to kill a cancelled or timed out job, in seconds
+SANDBOX_KILL_TIMEOUT = 5
+WORKER_KILL = 'kill'
+WORKER_MODULE = 'app.util.sandbox_pool'
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+EXECUTION_CANCELLED = "Execution cancelled, another candidate succeeded first"
+# Outputs of runs that did not complete, which may succeed another time
+TRANSIENT_OUTPUTS = ("Execution timed out", "Execution process exited unexpectedly", EXECUTION_CANCELLED)
+
+class SandboxTimeout(Exception):
+    pass
+
+class SandboxCancelled(Exception):
+    pass
+
+# Text stream that keeps at most `limit` characters
+class LimitedOutput(io.TextIOBase):
+    def __init__(self, limit):
+        self.limit = limit
+        self.parts = []
+        self.size = 0
+        self.truncated = False
+
+    def writable(self):
+        return True
+
+    def write(self, text):
+        remaining = self.limit - self.size
+        if remaining <= 0:
+            self.truncated = self.truncated or bool(text)
+            return len(text)
+        if len(text) > remaining:
+            self.truncated = True
+        self.parts.append(text[:remaining])
+        self.size += min(len(text), remaining)
+        return len(text)
+
+    def getvalue(self):
+        value = ''.join(self.parts)
+        if self.truncated:
+            value += f"\n[output truncated after {self.limit} characters]"
+        return value
+
+def _limit_memory(memory_mb):
+    if not memory_mb:
+        return
+    try:
+        import resource
+        limit = memory_mb * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    except (ImportError, ValueError, OSError) as e:
+        logger.warning(f"Could not limit sandbox memory: {e}")
+
+# Function to get the frame a job works on: a view of the shared dataset
+# under copy-on-write, a full copy otherwise
+def _job_frame(pd, data):
+    try:
+        copy_on_write = pd.get_option('mode.copy_on_write') is True
+    except KeyError:
+        copy_on_write = False
+    return data.copy(deep=not copy_on_write)
+
+# Function to run one job inside a worker, returns (succeeded, output)
+def _run_job(dataset_path, code, output_limit):
+    import pandas as pd
+
+    output = LimitedOutput(output_limit)
+    succeeded = True
+    with contextlib.redirect_stdout(output), contextlib.redirect_stderr(output):
+        try:
+            with dataset_store.attach(dataset_path) as data:
+                dataset = _job_frame(pd, data)
+                exec(compile(code, '<analysis>', 'exec'), {'__name__': '__main__', 'pd': pd, 'dataset': dataset})
+        except SystemExit as e:
+            succeeded = e.code in (None, 0)
+        except BaseException as e:
+            # Leave this function's own frame out of the traceback
+            traceback.print_exception(type(e), e, e.__traceback__.tb_next)
+            succeeded = False
+    return succeeded, output.getvalue().strip()
+
+def _kill_process_group(pid):
+    try:
+        os.killpg(pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+# Function to run one job in a child forked from the worker, so nothing the
+# job changes in the interpreter (patched builtins, the working directory,
+# pandas options, matplotlib state) is seen by the next one. A WORKER_KILL
+# message from the web process while the job runs kills the child
+def _run_forked(conn, dataset_path, code, output_limit):
+    reader, writer = multiprocessing.Pipe(duplex=False)
+    pid = os.fork()
+    if pid == 0:
+        reader.close()
+        conn.close()
+        try:
+            writer.send(_run_job(dataset_path, code, output_limit))
+        finally:
+            os._exit(0)
+
+    writer.close()
+    try:
+        while True:
+            ready = multiprocessing.connection.wait([reader, conn])
+            if reader in ready:
+                try:
+                    return reader.recv()
+                except EOFError:
+                    _, status = os.waitpid(pid, 0)
+                    pid = None
+                    return False, f"Execution process exited unexpectedly (exit code {os.waitstatus_to_exitcode(status)})"
+            if conn.recv() == WORKER_KILL:
+                return False, EXECUTION_CANCELLED
+    finally:
+        reader.close()
+        if pid is not None:
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            os.waitpid(pid, 0)
+
+def _worker_main(fd, memory_mb, output_limit, parent_pid):
+    os.environ.setdefault('OPENBLAS_NUM_THREADS', '1')
+    os.environ.setdefault('MPLBACKEND', 'Agg')
+    conn = multiprocessing.connection.Connection(fd)
+    _limit_memory(memory_mb)
+
+    import pandas
+    try:
+        pandas.set_option('mode.copy_on_write', True)
+    except (KeyError, ValueError):
+        # Older pandas without copy-on-write, jobs get a full copy instead
+        pass
+    try:
+        import scipy.stats  # noqa: F401
+    except ImportError:
+        pass
+    warm_datasets()
+
+    while True:
+        try:
+            while not conn.poll(1):
+                if os.getppid() != parent_pid:
+                    return
+            job = conn.recv()
+        except (EOFError, OSError, KeyboardInterrupt):
+            break
+        if job is None:
+            break
+        if job == WORKER_KILL:
+            # The job it was meant for had already finished
+            continue
+        dataset_path, code = job
+        # Load the dataset in the worker itself, so the jobs forked later
+        # inherit it; a failure is reported by the job
+        try:
+            load_normalized_dataframe(dataset_path)
+        except Exception:
+            pass
+        try:
+            conn.send(_run_forked(conn, dataset_path, code, output_limit))
+        except (EOFError, OSError):
+            break
+
+class SandboxWorker:
+    def __init__(self, memory_mb, output_limit):
+        parent_socket, child_socket = socket.socketpair()
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [ROOT, os.environ.get('PYTHONPATH')])))
+        # Started as a new interpreter rather than forked from the web
+        # process, whose other threads may hold locks at the time of the fork.
+        # It leads its own process group, so it is killed with its job
+        with child_socket:
+            self.process = subprocess.Popen(
+                [sys.executable, '-m', WORKER_MODULE, str(child_socket.fileno()), str(memory_mb), str(output_limit), str(os.getpid())],
+                pass_fds=[child_socket.fileno()], env=env, start_new_session=True,
+            )
+        self.conn = multiprocessing.connection.Connection(parent_socket.detach())
+        self.responsive = True
+
+    def run(self, dataset_path, code, timeout, cancel=None):
+        self.conn.send((dataset_path, code))
+        deadline = time.monotonic() + timeout
+        while not self.conn.poll(SANDBOX_POLL_INTERVAL if cancel is not None else timeout):
+            if cancel is not None and cancel.is_set():
+                self._kill_job()
+                raise SandboxCancelled(EXECUTION_CANCELLED)
+            if time.monotonic() >= deadline:
+                self._kill_job()
+                raise SandboxTimeout(f"Execution timed out after {timeout:g} seconds")
+        return self.conn.recv()
+
+    # Kills the running job but keeps the worker
+    def _kill_job(self):
+        try:
+            self.conn.send(WORKER_KILL)
+            # Either the answer to the kill or the result the job sent just
+            # before it
+            if self.conn.poll(SANDBOX_KILL_TIMEOUT):
+                self.conn.recv()
+                return
+        except (EOFError, OSError):
+            pass
+        self.responsive = False
+
+    def alive(self):
+        return self.responsive and self.process.poll() is None
+
+    def stop(self, force=False):
+        if not force:
+            try:
+                self.conn.send(None)
+                self.process.wait(1)
+            except (OSError, ValueError, subprocess.TimeoutExpired):
+                pass
+        # A busy or stuck worker would not read the stop message
+        if self.process.poll() is None:
+            _kill_process_group(self.process.pid)
+            self.process.wait()
+        self.conn.close()
+
+class SandboxPool:
+    def __init__(self, size=SANDBOX_WORKERS, timeout=SANDBOX_TIMEOUT, memory_mb=SANDBOX_MEMORY_MB,
+                 output_limit=SANDBOX_OUTPUT_LIMIT):
+        self.size = size
+        self.timeout = timeout
+        self.memory_mb = memory_mb
+        self.output_limit = output_limit
+        self._idle = queue.Queue()
+        self._lock = threading.Lock()
+        self._started = False
+
+    def _spawn(self):
+        return SandboxWorker(self.memory_mb, self.output_limit)
+
+    def start(self):
+        with self._lock:
+            if self._started:
+                return
+            for _ in range(self.size):
+                self._idle.put(self._spawn())
+            self._started = True
+            logger.info(f"Started {self.size} sandbox workers")
+
+    def _acquire(self, cancel):
+        if cancel is None:
+            return self._idle.get()
+        while not cancel.is_set():
+            try:
+                return self._idle.get(timeout=SANDBOX_POLL_INTERVAL)
+            except queue.Empty:
+                pass
+        return None
+
+    def run(self, dataset_path, code, timeout=None, cancel=None):
+        self.start()
+        timeout = timeout or self.timeout
+        worker = self._acquire(cancel)
+        if worker is None:
+            return False, EXECUTION_CANCELLED
+        try:
+            return worker.run(dataset_path, code, timeout, cancel)
+        except (SandboxCancelled, SandboxTimeout) as e:
+            return False, str(e)
+        except (EOFError, OSError):
+            worker.stop(force=True)
+            return False, f"Execution process exited unexpectedly (exit code {worker.process.returncode})"
+        finally:
+            # Only a worker that died or stopped answering is replaced, jobs
+            # never change the worker itself
+            if not worker.alive():
+                worker.stop(force=True)
+                worker = self._spawn()
+            self._idle.put(worker)
+
+    def shutdown(self):
+        with self._lock:
+            while not self._idle.empty():
+                self._idle.get().stop()
+            self._started = False
+
+# Function to load all normalized datasets in this process before forking
+# jobs from it
+def warm_datasets():
+    for path in glob.glob(os.path.join('data', '*', 'normalized_data', '*_normalized.csv')):
+        try:
+            load_normalized_dataframe(path)
+        except Exception as e:
+            logger.warning(f"Could not preload {path}: {e}")
+
+_pool = None
+_pool_lock = threading.Lock()
+
+# Function to get the process-wide sandbox pool
+def get_sandbox_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = SandboxPool()
+        return _pool
+
+# Function to run code in a fresh interpreter, as done before the pool existed
+def _run_in_subprocess(dataset_path, code, timeout, cancel=None):
+    dataset_path = dataset_path.replace('\\', '\\\\')
+    python_code = f"""
+import pandas as pd
+
+dataset = pd.read_csv('{dataset_path}')
+{code}
+"""
+    with tempfile.NamedTemporaryFile(delete=False, suffix=".py") as temp_py_file:
+        temp_py_file.write(python_code.encode('utf-8'))
+        temp_py_file_path = temp_py_file.name
+
+    try:
+        process = subprocess.Popen([sys.executable, temp_py_file_path], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                result, _ = process.communicate(timeout=SANDBOX_POLL_INTERVAL if cancel is not None else timeout)
+                break
+            except subprocess.TimeoutExpired:
+                cancelled = cancel is not None and cancel.is_set()
+                if cancelled or time.monotonic() >= deadline:
+                    process.kill()
+                    process.communicate()
+                    return False, EXECUTION_CANCELLED if cancelled else f"Execution timed out after {timeout:g} seconds"
+        return process.returncode == 0, result.decode('utf-8').strip()
+    finally:
+        os.remove(temp_py_file_path)
+
+def _execute(dataset_path, code, timeout, cancel=None):
+    if SANDBOX_WORKERS > 0 and hasattr(os, 'fork'):
+        return get_sandbox_pool().run(dataset_path, code, timeout, cancel)
+    return _run_in_subprocess(dataset_path, code, timeout, cancel)
+
+def _run(dataset_path, code, timeout, cancel=None):
+    try:
+        key = execution_cache.key(code, dataset_path, dataset_version(dataset_path))
+    except OSError:
+        key = None
+    cached = execution_cache.get(key)
+    if cached is not None:
+        logger.info("Using the cached result of the analysis code")
+        return cached
+
+    succeeded, output = _execute(dataset_path, code, timeout, cancel)
+    if not output.startswith(TRANSIENT_OUTPUTS):
+        execution_cache.set(key, succeeded, output)
+    return succeeded, output
+
+def _format_output(succeeded, output):
+    if succeeded:
+        return output
+    return f"Error executing Python code: {output}"
+
+# Function to run generated analysis code against a normalized dataset
+def run_analysis_code(dataset_path, code, timeout=SANDBOX_TIMEOUT):
+    return _format_output(*_run(dataset_path, code, timeout))
+
+# Function to run several candidate versions of the analysis code at once.
+# Returns the index of the first candidate that succeeded (None when all
+# failed) and per candidate its output, whether it succeeded or was cancelled,
+# and how long it ran. Candidates still running when one succeeds are
+# cancelled and not waited for
+def run_analysis_candidates(dataset_path, codes, timeout=SANDBOX_TIMEOUT):
+    cancel = threading.Event()
+    finished = queue.Queue()
+    results = [None] * len(codes)
+    started = time.monotonic()
+
+    def run_candidate(index):
+        succeeded, output = _run(dataset_path, codes[index], timeout, cancel)
+        results[index] = {
+            'succeeded': succeeded,
+            'cancelled': not succeeded and output == EXECUTION_CANCELLED,
+            'output': _format_output(succeeded, output),
+            'seconds': time.monotonic() - started,
+        }
+        finished.put(index)
+
+    for index in range(len(codes)):
+        threading.Thread(target=run_candidate, args=(index,), name=f"analysis-candidate-{index}", daemon=True).start()
+
+    winner = None
+    for _ in codes:
+        index = finished.get()
+        if results[index]['succeeded']:
+            winner = index
+            cancel.set()
+            break
+
+    elapsed = time.monotonic() - started
+    return winner, [
+        result if result is not None else
+        {'succeeded': False, 'cancelled': True, 'output': _format_output(False, EXECUTION_CANCELLED), 'seconds': elapsed}
+        for result in list(results)
+    ]
+
+if __name__ == '__main__':
+    _worker_main(*(int(arg) for arg in sys.argv[1:5]))
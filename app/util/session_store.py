@@ -0,0 +1,166 @@
+import os
+import json
+import hashlib
+import time
+import sqlite3
+import logging
+import threading
+from cachetools import TTLCache
+from app.util.token_count import count_tokens
+
+logger = logging.getLogger(__name__)
+
+# Store of /bm-chat conversation contexts.
+#
+# A context is the list of chat messages sent to the model: the system prompt
+# followed by the latest user/assistant turns. Sessions that have not been
+# used for a TTL expire, and the least recently used ones are evicted when the
+# store is full. The turns of a context are trimmed to a token budget of their
+# own, always keeping the system prompt (which can be large for datasets with
+# many columns) and the latest user/assistant pair.
+#
+# BM_SESSION_STORE=sqlite keeps sessions in a SQLite database instead of
+# process memory, so all gunicorn workers on a host see the same sessions.
+# Session ids contain the JWT of the user, both stores key sessions on their
+# SHA-256 so the token itself is never stored.
+
+SESSION_STORE = os.getenv('BM_SESSION_STORE', 'memory')
+SESSION_DB_PATH = os.getenv('BM_SESSION_DB', os.path.join('data', '.sessions.sqlite3'))
+SESSION_MAX_SESSIONS = int(os.getenv('BM_SESSION_MAX_SESSIONS', 1000))
+SESSION_TTL = float(os.getenv('BM_SESSION_TTL', 2 * 60 * 60))
+# Tokens of user/assistant messages kept in a context, the system prompt is not counted
+SESSION_TOKEN_BUDGET = int(os.getenv('BM_SESSION_TOKEN_BUDGET', 4000))
+# Latest user/assistant messages kept in a context, on top of the token budget
+SESSION_MAX_MESSAGES = int(os.getenv('BM_SESSION_MAX_MESSAGES', 4))
+
+def _message_tokens(message):
+    # Each message carries a few tokens of role and separators
+    return count_tokens(message['content']) + 4
+
+# Function to trim a context to the latest messages that fit in the budget,
+# keeping a leading system prompt and the latest user/assistant pair whatever
+# their size
+def trim_session_context(session_context, token_budget=SESSION_TOKEN_BUDGET, max_messages=SESSION_MAX_MESSAGES):
+    system = [m for m in session_context[:1] if m['role'] == 'system']
+    turns = session_context[len(system):]
+    if max_messages is not None:
+        turns = turns[-max_messages:] if max_messages > 0 else []
+
+    remaining = token_budget
+    kept = []
+    for message in reversed(turns):
+        remaining -= _message_tokens(message)
+        if remaining < 0 and len(kept) >= 2:
+            break
+        kept.append(message)
+    kept.reverse()
+    # Do not start the history with an assistant reply to a dropped question
+    if kept and kept[0]['role'] == 'assistant':
+        kept = kept[1:]
+    return system + kept
+
+# Function to get the key a session is stored under
+def session_key(session_id):
+    return hashlib.sha256(session_id.encode('utf-8')).hexdigest()
+
+class MemorySessionStore:
+    def __init__(self, maxsize=SESSION_MAX_SESSIONS, ttl=SESSION_TTL):
+        self._sessions = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._lock = threading.Lock()
+
+    def get(self, session_id):
+        key = session_key(session_id)
+        with self._lock:
+            session_context = self._sessions.get(key)
+            if session_context is not None:
+                # Re-insert to restart the TTL of an active session
+                self._sessions[key] = session_context
+        return list(session_context) if session_context is not None else None
+
+    def set(self, session_id, session_context):
+        with self._lock:
+            self._sessions[session_key(session_id)] = list(session_context)
+
+    def delete(self, session_id):
+        with self._lock:
+            self._sessions.pop(session_key(session_id), None)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._sessions)
+
+class SQLiteSessionStore:
+    def __init__(self, path=SESSION_DB_PATH, maxsize=SESSION_MAX_SESSIONS, ttl=SESSION_TTL):
+        self.path = path
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._local = threading.local()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS sessions ("
+                "id TEXT PRIMARY KEY, messages TEXT NOT NULL, updated REAL NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS sessions_updated ON sessions (updated)")
+            # Drop sessions stored under their raw id, which contains a JWT
+            conn.execute("DELETE FROM sessions WHERE length(id) != 64")
+
+    # One connection per thread and process, connections must not cross a fork
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def get(self, session_id):
+        session_id = session_key(session_id)
+        now = time.time()
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT messages FROM sessions WHERE id = ? AND updated > ?", (session_id, now - self.ttl)).fetchone()
+            if row is None:
+                return None
+            conn.execute("UPDATE sessions SET updated = ? WHERE id = ?", (now, session_id))
+        return json.loads(row[0])
+
+    def set(self, session_id, session_context):
+        session_id = session_key(session_id)
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO sessions (id, messages, updated) VALUES (?, ?, ?)",
+                (session_id, json.dumps(session_context), now))
+            conn.execute("DELETE FROM sessions WHERE updated <= ?", (now - self.ttl,))
+            conn.execute(
+                "DELETE FROM sessions WHERE id NOT IN "
+                "(SELECT id FROM sessions ORDER BY updated DESC LIMIT ?)", (self.maxsize,))
+
+    def delete(self, session_id):
+        session_id = session_key(session_id)
+        with self._connect() as conn:
+            conn.execute("DELETE FROM sessions WHERE id = ?", (session_id,))
+
+    def __len__(self):
+        with self._connect() as conn:
+            return conn.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+
+_store = None
+_store_lock = threading.Lock()
+
+# Function to get the session store configured by BM_SESSION_STORE
+def get_session_store():
+    global _store
+    with _store_lock:
+        if _store is None:
+            if SESSION_STORE == 'sqlite':
+                _store = SQLiteSessionStore()
+            else:
+                if SESSION_STORE != 'memory':
+                    logger.warning(f"Unknown session store {SESSION_STORE}, using memory")
+                _store = MemorySessionStore()
+        return _store
@@ -0,0 +1,133 @@
+import os
+import time
+import sqlite3
+import logging
+import threading
+import pandas as pd
+from cachetools import LRUCache
+from app.util.dataset_cache import load_normalized_dataframe, dataset_version
+
+logger = logging.getLogger(__name__)
+
+# In-process SQL engine over the normalized datasets.
+#
+# Each dataset is loaded into an in-memory SQLite database as the table
+# 'dataset', with an index on every column with few distinct values (region,
+# state, year...), so grouped aggregations answer in milliseconds without
+# starting an interpreter. Databases are built on first use, per dataset
+# version, and the least recently used ones are dropped.
+#
+# Queries are read-only (only SELECT statements get past the authorizer),
+# are interrupted after BM_SQL_TIMEOUT seconds and return at most
+# BM_SQL_MAX_ROWS rows.
+
+SQL_TABLE = 'dataset'
+SQL_TIMEOUT = float(os.getenv('BM_SQL_TIMEOUT', 5))
+SQL_MAX_ROWS = int(os.getenv('BM_SQL_MAX_ROWS', 1000))
+SQL_DATASETS = int(os.getenv('BM_SQL_DATASETS', 8))
+# Columns with at most this many distinct values are indexed
+SQL_INDEX_MAX_DISTINCT = int(os.getenv('BM_SQL_INDEX_MAX_DISTINCT', 50))
+# Number of SQLite virtual machine instructions between timeout checks
+SQL_PROGRESS_STEPS = 10000
+
+_READ_ONLY_ACTIONS = {sqlite3.SQLITE_SELECT, sqlite3.SQLITE_READ, sqlite3.SQLITE_FUNCTION, sqlite3.SQLITE_RECURSIVE}
+
+class SQLQueryError(ValueError):
+    pass
+
+class SQLQueryTimeout(SQLQueryError):
+    pass
+
+def _read_only_authorizer(action, arg1, arg2, database, source):
+    return sqlite3.SQLITE_OK if action in _READ_ONLY_ACTIONS else sqlite3.SQLITE_DENY
+
+def _quote(name):
+    return '"' + name.replace('"', '""') + '"'
+
+class SQLDataset:
+    def __init__(self, data, version):
+        self.version = version
+        self.columns = list(data.columns)
+        self.indexed = []
+        # One line per column with its SQL type, for prompts
+        self.schema = ''
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(':memory:', check_same_thread=False)
+        data.to_sql(SQL_TABLE, self.conn, index=False)
+
+        distinct = data.nunique(dropna=True)
+        for position, column in enumerate(data.columns):
+            if 2 <= distinct[column] <= SQL_INDEX_MAX_DISTINCT:
+                self.conn.execute(f"CREATE INDEX ix_{position} ON {SQL_TABLE} ({_quote(column)})")
+                self.indexed.append(column)
+        self.conn.execute('ANALYZE')
+        self.conn.commit()
+        self.schema = '\n'.join(
+            f"{column[1]} {column[2] or 'TEXT'}" for column in self.conn.execute(f"PRAGMA table_info({SQL_TABLE})"))
+        self.conn.execute('PRAGMA query_only = 1')
+        self.conn.set_authorizer(_read_only_authorizer)
+
+    # Runs one read-only statement, returns its columns and rows
+    def query(self, sql, params=(), timeout=SQL_TIMEOUT, max_rows=SQL_MAX_ROWS):
+        deadline = time.monotonic() + timeout
+        with self._lock:
+            self.conn.set_progress_handler(lambda: time.monotonic() > deadline, SQL_PROGRESS_STEPS)
+            started = time.monotonic()
+            try:
+                cursor = self.conn.execute(sql, params)
+                rows = cursor.fetchmany(max_rows + 1)
+                columns = [description[0] for description in cursor.description or []]
+                cursor.close()
+            except sqlite3.OperationalError as e:
+                if str(e) == 'interrupted':
+                    raise SQLQueryTimeout(f"Query took longer than {timeout:g} seconds")
+                raise SQLQueryError(str(e))
+            except (sqlite3.DatabaseError, sqlite3.Warning, ValueError) as e:
+                raise SQLQueryError(str(e))
+            finally:
+                self.conn.set_progress_handler(None, 0)
+        return {
+            'columns': columns,
+            'rows': [list(row) for row in rows[:max_rows]],
+            'truncated': len(rows) > max_rows,
+            'seconds': round(time.monotonic() - started, 6),
+        }
+
+_databases = LRUCache(maxsize=SQL_DATASETS)
+_databases_lock = threading.Lock()
+_build_locks = {}
+
+def _build_lock(csv_path):
+    with _databases_lock:
+        return _build_locks.setdefault(csv_path, threading.Lock())
+
+# Function to get the SQL database of a normalized csv, building it on first
+# use and again when the dataset changed
+def get_sql_dataset(csv_path):
+    version = dataset_version(csv_path)
+    with _databases_lock:
+        database = _databases.get(csv_path)
+    if database is not None and database.version == version:
+        return database
+
+    with _build_lock(csv_path):
+        with _databases_lock:
+            database = _databases.get(csv_path)
+        if database is None or database.version != version:
+            started = time.monotonic()
+            database = SQLDataset(load_normalized_dataframe(csv_path), version)
+            logger.info(f"Loaded {csv_path} into SQLite in {time.monotonic() - started:.2f}s, "
+                        f"indexed {len(database.indexed)} columns")
+            with _databases_lock:
+                _databases[csv_path] = database
+        return database
+
+# Function to render a query result as text for a prompt
+def format_query_result(result, max_rows=50):
+    if not result['rows']:
+        return 'The query returned no rows.'
+    frame = pd.DataFrame(result['rows'][:max_rows], columns=result['columns'])
+    text = frame.to_string(index=False)
+    if result['truncated'] or len(result['rows']) > max_rows:
+        text += f"\n[only the first {min(max_rows, len(result['rows']))} rows are shown]"
+    return text
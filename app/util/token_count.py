@@ -0,0 +1,84 @@
+import logging
+import threading
+from collections import defaultdict
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+logger = logging.getLogger(__name__)
+
+# Token accounting of the OpenAI calls made for /bm-chat.
+#
+# Counts with the model's tokenizer when tiktoken is installed and its
+# encoding can be loaded, and estimates about four characters per token
+# otherwise. Prompt and completion tokens are
+# logged and summed per stage (intent, graph, analysis, answer) so the cost of
+# each stage can be followed over time.
+
+DEFAULT_ENCODING = 'o200k_base'
+
+_encodings = {}
+_encodings_lock = threading.Lock()
+_usage_lock = threading.Lock()
+_usage = defaultdict(lambda: {'calls': 0, 'prompt_tokens': 0, 'completion_tokens': 0})
+
+# Returns the tokenizer of a model, None when it cannot be loaded (e.g. the
+# encoding cannot be downloaded offline); failures are cached as well, so the
+# load is only tried once per model
+def _encoding(model):
+    with _encodings_lock:
+        if model not in _encodings:
+            try:
+                try:
+                    _encodings[model] = tiktoken.encoding_for_model(model)
+                except KeyError:
+                    _encodings[model] = tiktoken.get_encoding(DEFAULT_ENCODING)
+            except Exception as e:
+                logger.warning(f"Tokenizer unavailable for model '{model}', estimating tokens: {e}")
+                _encodings[model] = None
+        return _encodings[model]
+
+def _estimate_tokens(text):
+    return (len(text) + 3) // 4
+
+# Function to count the tokens of a text
+def count_tokens(text, model=None):
+    if not text:
+        return 0
+    encoding = _encoding(model or '') if tiktoken is not None else None
+    if encoding is None:
+        return _estimate_tokens(text)
+    return len(encoding.encode(text, disallowed_special=()))
+
+# Function to count the prompt tokens of a list of chat messages, including
+# the few tokens each message adds for its role and separators
+def count_message_tokens(messages, model=None):
+    return sum(count_tokens(message['content'], model) + 4 for message in messages) + 3
+
+# Function to record the tokens used by one call of a stage
+def record_usage(stage, prompt_tokens, completion_tokens):
+    with _usage_lock:
+        usage = _usage[stage]
+        usage['calls'] += 1
+        usage['prompt_tokens'] += prompt_tokens
+        usage['completion_tokens'] += completion_tokens
+    logger.info(f"Tokens used by {stage}: prompt {prompt_tokens}, completion {completion_tokens}")
+
+# Function to record the usage of a chat completions response, falling back
+# to counting locally when the response does not report it
+def record_response_usage(stage, messages, response_data, completion=None, model=None):
+    usage = response_data.get('usage') if isinstance(response_data, dict) else None
+    if usage:
+        record_usage(stage, usage.get('prompt_tokens', 0), usage.get('completion_tokens', 0))
+    else:
+        record_usage(stage, count_message_tokens(messages, model), count_tokens(completion, model))
+
+# Function to get the token counters per stage
+def token_stats():
+    with _usage_lock:
+        stages = {stage: dict(usage) for stage, usage in _usage.items()}
+    for usage in stages.values():
+        usage['average_prompt_tokens'] = usage['prompt_tokens'] / usage['calls'] if usage['calls'] else 0.0
+    return {'tokenizer': 'tiktoken' if tiktoken is not None else 'estimate', 'stages': stages}
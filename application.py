@@ -2,16 +2,30 @@ import os
 import logging
 import jwt
 import datetime
+import threading
 import re
+import tempfile
 import pandas as pd
 import json  # Add this import
 from dotenv import load_dotenv
 load_dotenv()
-from flask import Flask, request, jsonify, send_from_directory, render_template
+from flask import Flask, request, jsonify, send_from_directory, send_file, render_template, Response, stream_with_context, abort
+from werkzeug.security import safe_join
 from flask_cors import CORS
 from functools import wraps
-from app.util.chat_handler import handle_chat_request
-from app.util.ingest_data import ingest_new_data, save_metadata, save_normalized_data, generate_metadata_from_file, normalize_data
+from app.util.chat_handler import handle_chat_request, iter_chat_events, analysis_timing_stats
+from app.util.intent_router import router_stats
+from app.util.token_count import token_stats
+from app.util.ingest_data import save_metadata, generate_metadata_from_file, write_normalized_data
+from app.util.ingest_jobs import ingest_jobs, IngestQueueFull
+from app.util.dataset_cache import normalized_data_path, load_normalized_dataframe, columnar_cache_dir, dataset_version
+from app.util.dataset_catalog import dataset_catalog
+from app.util.document_index import warm_document_indexes
+from app.util.dataset_profile import load_profile, profile_path
+from app.util.aggregation import parse_aggregate_query, aggregate_cached
+from app.util.sql_engine import get_sql_dataset, SQLQueryError, SQLQueryTimeout, SQL_MAX_ROWS
+from app.util.dataset_query import parse_dataset_query, apply_dataset_query, RESERVED_PARAMS
+from app.util.response_stream import negotiate_encoding, iter_json_array, iter_ndjson, compress_chunks, ensure_precompressed_file, ensure_precompressed_json, iter_sse, wants_event_stream
 
 application = app = Flask(__name__, static_folder='app/static/build')
 
@@ -127,17 +141,61 @@ def upload_file():
         return jsonify({"error": "No selected file"}), 400
     if file and file.filename.endswith('.csv'):
         package = request.form.get('package', 'default_package')
-        ingest_new_data(file, package)
-        
-        return jsonify({"message": "File processed successfully"}), 200
+        mode = request.form.get('mode', 'create')
+        target = None
+        if mode == 'append':
+            # Rows are appended to an existing file of the package, by default
+            # the one with the name of the upload
+            target = os.path.splitext(os.path.basename(request.form.get('target') or file.filename))[0] + '.csv'
+            data_path = safe_join('data', package, 'data', target)
+            if data_path is None or not os.path.isfile(data_path):
+                return jsonify({"error": f"No file {target} in package {package} to append to"}), 404
+        elif mode != 'create':
+            return jsonify({"error": f"Unknown upload mode {mode}"}), 400
+        try:
+            job = ingest_jobs.submit(file, package, mode, target)
+        except IngestQueueFull as e:
+            response = jsonify({"error": f"Too many uploads in progress: {e}"})
+            response.headers['Retry-After'] = '30'
+            return response, 503
+
+        return jsonify({
+            "message": "File queued for processing",
+            "jobId": job.id,
+            "status": job.status,
+            "statusUrl": f"/upload/{job.id}",
+        }), 202
     else:
         return jsonify({"error": "Unsupported file type"}), 400
 
+@app.route('/upload/<job_id>', methods=['GET'])
+def upload_status(job_id):
+    bm_api_key = request.headers.get('BINARYMINDS-API-KEY')
+    if not (check_internal_api_key(bm_api_key)):
+        return jsonify({
+            "error": "Could not verify BinaryMinds API key"
+        }), 401
+
+    job = ingest_jobs.get(job_id)
+    if job is None:
+        return jsonify({"error": "Unknown upload job"}), 404
+    return jsonify(job)
+
 @app.route('/data/<package>/<filename>', methods=['GET'])
 @token_required
 def serve_data(package, filename):
     package_path = os.path.join('data', package, 'data')
-    return send_from_directory(package_path, filename)
+    encoding = negotiate_encoding(request.accept_encodings)
+    if not encoding:
+        return send_from_directory(package_path, filename)
+
+    data_path = safe_join(package_path, filename)
+    if data_path is None or not os.path.isfile(data_path):
+        abort(404)
+    response = send_file(ensure_precompressed_file(data_path, encoding), mimetype='text/csv', download_name=filename)
+    response.headers['Content-Encoding'] = encoding
+    response.headers['Vary'] = 'Accept-Encoding'
+    return response
 
 @app.route('/data-info/<package>', methods=['GET'])
 @token_required
@@ -158,19 +216,100 @@ def serve_normalized_data(package, filename):
     normalized_data_dir = os.path.join('data', package, 'normalized_data')
     normalized_data_path = os.path.join(normalized_data_dir, f"{filename}_normalized.csv")
     print(f"normalized_data_path: {normalized_data_path}")
-    if os.path.exists(normalized_data_path):
+    if not os.path.exists(normalized_data_path):
+        data_path = os.path.join('data', package, 'data', filename + '.csv')
+        os.makedirs(normalized_data_dir, exist_ok=True)
+        # Each request writes its own temporary file, the last one to finish wins
+        partial_fd, partial_path = tempfile.mkstemp(suffix='.part', dir=normalized_data_dir)
+        os.close(partial_fd)
+        try:
+            write_normalized_data(data_path, partial_path)
+            os.replace(partial_path, normalized_data_path)
+        except Exception:
+            os.remove(partial_path)
+            raise
+    else:
         print("Normal data exists")
-        data = pd.read_csv(normalized_data_path)
-        data = data.fillna('')  # Fill NaN with an empty string or another placeholder
-        normalized_data = data.to_dict(orient='records')
+    data = load_normalized_dataframe(normalized_data_path)
+
+    try:
+        query = parse_dataset_query(request.args, data.columns, RESERVED_PARAMS | {'format'})
+        total, data = apply_dataset_query(data, query)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    ndjson = request.args.get('format') == 'ndjson' or request.accept_mimetypes.best == 'application/x-ndjson'
+    encoding = negotiate_encoding(request.accept_encodings)
+    headers = {'X-Total-Count': str(total), 'Vary': 'Accept-Encoding'}
+    if encoding:
+        headers['Content-Encoding'] = encoding
+
+    if encoding and not ndjson and query.is_empty():
+        # The whole table is requested often enough to keep it compressed on disk
+        precompressed_path = ensure_precompressed_json(
+            columnar_cache_dir(normalized_data_path), dataset_version(normalized_data_path), data, encoding, app.json.dumps)
+        response = send_file(precompressed_path, mimetype='application/json')
+        response.headers.update(headers)
+        return response
+
+    if ndjson:
+        chunks, mimetype = iter_ndjson(data, app.json.dumps), 'application/x-ndjson'
     else:
-        data_path = os.path.join('data', package, 'data', filename + '.csv')
-        data = pd.read_csv(data_path)
-        normalized_data = normalize_data(data.to_dict(orient='records'))
-        save_normalized_data(os.path.join('data', package), filename, normalized_data)
-        #print(f"Normalized data: {normalized_data}")  # Logging the normalized data
-    
-    return jsonify(normalized_data)
+        chunks, mimetype = iter_json_array(data, app.json.dumps), 'application/json'
+    if encoding:
+        chunks = compress_chunks(chunks, encoding)
+    return Response(stream_with_context(chunks), mimetype=mimetype, headers=headers)
+
+@app.route('/aggregate/<package>/<filename>', methods=['GET'])
+@token_required
+def serve_aggregate(package, filename):
+    csv_path = normalized_data_path(package, filename)
+    if not os.path.exists(csv_path):
+        abort(404)
+    data = load_normalized_dataframe(csv_path)
+
+    try:
+        query = parse_aggregate_query(request.args, data.columns)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify(aggregate_cached(data, dataset_version(csv_path), query))
+
+@app.route('/query/<package>/<filename>', methods=['GET', 'POST'])
+@token_required
+def serve_query(package, filename):
+    csv_path = normalized_data_path(package, filename)
+    if not os.path.exists(csv_path):
+        abort(404)
+
+    # GET /query/...?sql=SELECT... or POST {"sql": "...", "params": [...], "limit": 100}
+    body = request.get_json(silent=True) if request.method == 'POST' else None
+    if not isinstance(body, dict):
+        body = {}
+    sql = body.get('sql') or request.args.get('sql')
+    if not sql:
+        return jsonify({"error": "'sql' is required"}), 400
+    params = body.get('params') or []
+    if not isinstance(params, (list, dict)):
+        return jsonify({"error": "'params' must be a list or an object"}), 400
+    try:
+        limit = min(int(body.get('limit') or request.args.get('limit') or SQL_MAX_ROWS), SQL_MAX_ROWS)
+    except (TypeError, ValueError):
+        return jsonify({"error": "'limit' must be an integer"}), 400
+
+    try:
+        return jsonify(get_sql_dataset(csv_path).query(sql, params, max_rows=limit))
+    except SQLQueryTimeout as e:
+        return jsonify({"error": str(e)}), 408
+    except SQLQueryError as e:
+        return jsonify({"error": str(e)}), 400
+
+@app.route('/profile/<package>/<filename>', methods=['GET'])
+@token_required
+def serve_profile(package, filename):
+    csv_path = normalized_data_path(package, filename)
+    if not os.path.exists(csv_path):
+        abort(404)
+    return jsonify(load_profile(csv_path, profile_path(package, filename)))
 
 @app.route('/metadata/data/<package>/<filename>', methods=['GET'])
 @token_required
@@ -182,7 +321,7 @@ def serve_metadata(package, filename):
             metadata = json.load(f)
         return jsonify(metadata)
     data_path = os.path.join('data', package, 'data', filename + '.csv')
-    metadata, normalized_data = generate_metadata_from_file(data_path)
+    metadata = generate_metadata_from_file(data_path)
     save_metadata(os.path.join('data', package), filename, metadata)
     return jsonify(metadata)
 
@@ -193,38 +332,32 @@ def chat():
     data = request.get_json()
     token = request.headers.get('Authorization').split(" ")[1]
     logging.info(f"Received data: {data}")
+    if wants_event_stream(request, data):
+        events = iter_chat_events(token, data, stream_tokens=True)
+        headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+        return Response(stream_with_context(iter_sse(events)), mimetype='text/event-stream', headers=headers)
     response = handle_chat_request(token, data)
     return jsonify(response)
 
+@app.route('/bm-chat/router-stats', methods=['GET'])
+@token_required
+def chat_router_stats():
+    return jsonify(router_stats())
+
+@app.route('/bm-chat/token-stats', methods=['GET'])
+@token_required
+def chat_token_stats():
+    return jsonify(token_stats())
+
+@app.route('/bm-chat/analysis-stats', methods=['GET'])
+@token_required
+def chat_analysis_stats():
+    return jsonify(analysis_timing_stats())
+
 @app.route('/data/list', methods=['GET'])
 @token_required
 def list_data():
-    data_directory = 'data'
-    datasets = []
-    
-    for package in os.listdir(data_directory):
-        package_path = os.path.join(data_directory, package)
-        data_path = os.path.join(package_path, 'data')
-        if os.path.isdir(data_path):
-            title_file = os.path.join(package_path, 'title.txt')
-            data_files = [f for f in os.listdir(data_path) if os.path.isfile(os.path.join(data_path, f))]
-            
-            title = 'No description available'
-            if os.path.exists(title_file):
-                with open(title_file, 'r') as file:
-                    title = file.read().strip()
-
-            print(title)
-            
-            for data_file in data_files:
-                if '.csv' in data_file:
-                    datasets.append({
-                        'package': package,
-                        'file': data_file,
-                        'title': title
-                    })
-    
-    return jsonify(datasets)
+    return jsonify(dataset_catalog.datasets())
 
 @app.route('/health')
 def health_check():
@@ -239,6 +372,14 @@ def list_endpoints():
             output.append((rule.rule, methods))
     return output
 
+# Build the dataset catalog before serving requests
+dataset_catalog.refresh()
+
+# Load or build the PDF indexes in the background, so the first questions
+# about a package do not wait for them
+if os.getenv('BM_DOCUMENT_INDEX_WARM', '1') != '0':
+    threading.Thread(target=warm_document_indexes, name='document-index-warm', daemon=True).start()
+
 # Print the list of registered endpoints to the terminal
 endpoints = list_endpoints()
 for endpoint in endpoints:
@@ -250,6 +391,7 @@ def after_request(response):
     response.headers['Access-Control-Allow-Origin'] = '*'
     response.headers['Access-Control-Allow-Headers'] = 'Content-Type,Authorization,X-API-Key'
     response.headers['Access-Control-Allow-Methods'] = 'GET,POST,PUT,DELETE,OPTIONS'
+    response.headers['Access-Control-Expose-Headers'] = 'X-Total-Count'
     return response
 
 def main():
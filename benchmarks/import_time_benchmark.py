@@ -0,0 +1,71 @@
+import os
+import sys
+import subprocess
+
+# Measures the cold import of the web application with `python -X importtime`
+# and fails when it regresses: when a module that must stay lazily imported
+# (the langchain/Chroma document-QA stack, PDF loaders) is imported at boot,
+# or when the import takes longer than the budget.
+#
+# Run from the repository root:
+#   python benchmarks/import_time_benchmark.py [repeats] [budget_ms]
+#
+# Prints the modules with the largest cumulative import time of the fastest
+# run and exits with 1 on a regression.
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TARGET_MODULE = 'application'
+# Top-level packages that must not be imported when the application starts
+LAZY_PACKAGES = ['langchain', 'langchain_core', 'langchain_community', 'chromadb', 'pypdfium2']
+DEFAULT_BUDGET_MS = float(os.getenv('BM_IMPORT_BUDGET_MS', 1500))
+TOP_MODULES = 20
+
+# Function to import a module in a fresh interpreter, returns
+# [(module, self_us, cumulative_us, depth)] in import order
+def import_times(module=TARGET_MODULE):
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f"import {module}"],
+        cwd=ROOT, capture_output=True, text=True,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed:\n{result.stderr[-2000:]}")
+
+    times = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip())) // 2
+        times.append((name.strip(), int(self_us), int(cumulative_us), depth))
+    return times
+
+def main():
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    budget_ms = float(sys.argv[2]) if len(sys.argv) > 2 else DEFAULT_BUDGET_MS
+
+    # Keep the fastest run, the others mostly measure a cold disk cache
+    best_total, best = None, None
+    for _ in range(repeats):
+        times = import_times()
+        total = next(cumulative for name, _, cumulative, _ in reversed(times) if name == TARGET_MODULE)
+        if best_total is None or total < best_total:
+            best_total, best = total, times
+
+    print(f"{'module':<60} {'self':>10} {'cumulative':>12}")
+    for name, self_us, cumulative_us, depth in sorted(best, key=lambda t: -t[2])[:TOP_MODULES]:
+        print(f"{('  ' * depth + name)[:60]:<60} {self_us / 1000:>8.1f}ms {cumulative_us / 1000:>10.1f}ms")
+    print(f"\nimport {TARGET_MODULE}: {best_total / 1000:.1f}ms (budget {budget_ms:.0f}ms), {len(best)} modules")
+
+    failed = False
+    eager = sorted({name for name, _, _, _ in best if name.split('.')[0] in LAZY_PACKAGES})
+    if eager:
+        failed = True
+        print(f"FAIL: imported at startup but should be lazy: {', '.join(eager[:10])}"
+              + (f" and {len(eager) - 10} more" if len(eager) > 10 else ""))
+    if best_total / 1000 > budget_ms:
+        failed = True
+        print(f"FAIL: import took longer than the {budget_ms:.0f}ms budget")
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
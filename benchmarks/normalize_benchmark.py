@@ -0,0 +1,82 @@
+import os
+import re
+import sys
+import glob
+import json
+import time
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.util.ingest_data import CHAR_MAP, normalize_data, normalize_dataframe
+
+# Compares the column-wise normalize_data against the original row-by-row
+# implementation on the bundled datasets and checks both give identical output.
+#
+# Run from the repository root:
+#   python benchmarks/normalize_benchmark.py [repeats]
+
+# The row-by-row implementation normalize_data replaced, kept as the reference
+def normalize_data_rowwise(data):
+    def normalize_key(key):
+        key = key.strip().lower()
+        key = re.sub(r'[^a-zA-Z0-9]', lambda match: CHAR_MAP.get(match.group(0), '_'), key)
+        if re.match(r'^[0-9]', key):
+            key = '_' + key
+        return key
+
+    def handle_nan(value):
+        if pd.isna(value):
+            return None
+        return value
+
+    normalized_data = []
+    for row in data:
+        normalized_row = {}
+        for key, value in row.items():
+            normalized_key = normalize_key(key)
+            if isinstance(value, str):
+                normalized_row[normalized_key] = value.strip().lower()
+            else:
+                normalized_row[normalized_key] = handle_nan(value)
+        normalized_data.append(normalized_row)
+
+    return normalized_data
+
+def best_of(repeats, fn, *args):
+    best = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = fn(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+def main():
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    paths = sorted(glob.glob(os.path.join('data', '*', 'data', '*.csv')))
+    if not paths:
+        print("No datasets found, run from the repository root")
+        return 1
+
+    failed = False
+    # 'frame only' is normalize_dataframe without converting back to row dicts,
+    # which is what the ingest path uses
+    print(f"{'dataset':<60} {'rows':>6} {'cols':>5} {'row-wise':>10} {'columnar':>10} {'speedup':>8} {'frame only':>11}")
+    for path in paths:
+        data = pd.read_csv(path)
+        rowwise_time, expected = best_of(repeats, lambda: normalize_data_rowwise(data.to_dict(orient='records')))
+        columnar_time, actual = best_of(repeats, normalize_data, data)
+        frame_time, _ = best_of(repeats, normalize_dataframe, data)
+
+        identical = json.dumps(expected) == json.dumps(actual)
+        failed = failed or not identical
+
+        name = os.path.basename(path)[:58]
+        print(f"{name:<60} {len(data):>6} {len(data.columns):>5} {rowwise_time * 1000:>8.1f}ms {columnar_time * 1000:>8.1f}ms {rowwise_time / columnar_time:>7.1f}x {frame_time * 1000:>9.1f}ms"
+              + ("" if identical else "  OUTPUT DIFFERS"))
+
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,21 @@
+import os
+import json
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# The document-QA stack is imported on first use, not when the app starts
+HEAVY_MODULES = ('langchain', 'chromadb', 'pypdfium2')
+
+def test_application_import_skips_document_qa_stack():
+    env = dict(os.environ, BM_DOCUMENT_INDEX_WARM='0')
+    script = (
+        "import sys, json, application\n"
+        "print(json.dumps(sorted(sys.modules)))\n"
+    )
+    result = subprocess.run(
+        [sys.executable, '-c', script], cwd=ROOT, env=env, capture_output=True, text=True, check=True)
+    modules = json.loads(result.stdout.strip().splitlines()[-1])
+    loaded = [name for name in modules if name.split('.')[0].startswith(HEAVY_MODULES)]
+    assert loaded == []
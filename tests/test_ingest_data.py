@@ -0,0 +1,46 @@
+import glob
+import pytest
+from app.util.ingest_data import collect_column_stats
+
+DATASETS = sorted(glob.glob('data/*/data/*.csv'))
+
+# Columns whose type is only visible in some chunks: missing values late in
+# an integer column, text after numbers, booleans next to missing values
+MIXED_CSV = (
+    "id,score,code,flag,empty\n"
+    + "".join(f"{i},{i % 7},{i % 3},{'True' if i % 2 else 'False'},\n" for i in range(50))
+    + "50,,x,,\n"
+    + "".join(f"{i},{i % 7}.5,{i % 3},True,\n" for i in range(51, 80))
+)
+
+def _ingest(path, tmp_path, chunk_rows):
+    normalized_path = tmp_path / f"normalized_{chunk_rows}.csv"
+    column_stats, rows = collect_column_stats(str(path), str(normalized_path), chunk_rows=chunk_rows)
+    return normalized_path.read_bytes(), [stats.to_metadata() for stats in column_stats], rows
+
+@pytest.mark.parametrize('chunk_rows', [1, 7, 100])
+def test_chunked_ingest_matches_single_read(tmp_path, chunk_rows):
+    path = tmp_path / 'mixed.csv'
+    path.write_text(MIXED_CSV)
+    assert _ingest(path, tmp_path, chunk_rows) == _ingest(path, tmp_path, 10 ** 6)
+
+@pytest.mark.parametrize('path', DATASETS)
+def test_chunked_ingest_of_datasets_matches_single_read(tmp_path, path):
+    assert _ingest(path, tmp_path, 100) == _ingest(path, tmp_path, 10 ** 6)
+
+def test_appended_rows_keep_the_column_types(tmp_path):
+    original = tmp_path / 'original.csv'
+    original.write_text("year,flag,name\n2019,True,a\n2019,False,b\n")
+    column_stats, _ = collect_column_stats(str(original), str(tmp_path / 'normalized.csv'))
+    appended = tmp_path / 'appended.csv'
+    appended.write_text("year,flag,name\n2022,,1\n,True,c\n")
+    appended_path = tmp_path / 'appended_normalized.csv'
+    column_stats, rows = collect_column_stats(
+        str(appended), str(appended_path), column_stats=column_stats, header=False)
+    assert rows == 2
+    assert appended_path.read_text() == "2022,,1\n,True,c\n"
+    metadata = {stats.name: stats.to_metadata() for stats in column_stats}
+    assert metadata['year']['type'] == 'int64'
+    assert metadata['year']['potentialValues'] == [2019, 2022, None]
+    assert metadata['flag']['type'] == 'bool'
+    assert metadata['name']['potentialValues'] == ['a', 'b', '1', 'c']
@@ -0,0 +1,34 @@
+import pytest
+from app.util.intent_router import (
+    TRAINING_EXAMPLES, ROUTER_THRESHOLD, GENERATE_GRAPH, PREFORM_PYTHON_ANALYSIS, DONT_GENERATE_GRAPH_OR_CODE,
+    classify_locally, route_intent,
+)
+
+def _no_llm():
+    raise AssertionError("routed to the LLM")
+
+@pytest.mark.parametrize('label, message', TRAINING_EXAMPLES)
+def test_training_examples_route_to_their_label(label, message):
+    if classify_locally(message)[2] == 'rule':
+        assert route_intent(message, _no_llm) == label
+    else:
+        assert route_intent(message, lambda: 'llm') in (label, 'llm')
+
+@pytest.mark.parametrize('message', ["show me", "and by region", "what about the north", "tell me more", "yield"])
+def test_low_evidence_messages_go_to_the_llm(message):
+    assert classify_locally(message)[2] == 'classifier'
+    assert route_intent(message, lambda: 'llm') == 'llm'
+
+@pytest.mark.parametrize('message, label', [
+    ("what does the column bl_state mean", DONT_GENERATE_GRAPH_OR_CODE),
+    ("can you draw conclusions from this study?", DONT_GENERATE_GRAPH_OR_CODE),
+    ("plot income by state", GENERATE_GRAPH),
+    ("what is the mean income", PREFORM_PYTHON_ANALYSIS),
+])
+def test_keywords_in_another_sense(message, label):
+    assert classify_locally(message)[0] == label
+
+def test_rule_and_classifier_disagreeing_go_to_the_llm():
+    label, confidence, _ = classify_locally("what is the average plot size")
+    assert confidence < ROUTER_THRESHOLD
+    assert route_intent("what is the average plot size", lambda: 'llm') == 'llm'
@@ -0,0 +1,69 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+import requests
+from app.util import openai_client
+
+COMPLETION = {'choices': [{'message': {'role': 'assistant', 'content': ' hello '}}]}
+
+# Stub of the chat completions API, answering each request with the next
+# (status, delay) of its script and recording the client port of each request
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        server = self.server
+        with server.lock:
+            server.ports.append(self.client_address[1])
+            status, delay = server.script.pop(0) if server.script else (200, 0)
+        time.sleep(delay)
+        body = json.dumps(COMPLETION if status == 200 else {'error': status}).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+@pytest.fixture
+def stub(monkeypatch):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    server.ports = []
+    server.script = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    monkeypatch.setattr(openai_client, 'OPENAI_API_BASE', f"http://127.0.0.1:{server.server_port}")
+    monkeypatch.setattr(openai_client, 'OPENAI_BACKOFF_FACTOR', 0.01)
+    monkeypatch.setattr(openai_client, 'OPENAI_READ_TIMEOUT', 0.5)
+    monkeypatch.setattr(openai_client, '_session', None)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+def _complete():
+    return openai_client.completion_text(openai_client.chat_completion([{'role': 'user', 'content': 'hi'}]))
+
+def test_calls_reuse_one_pooled_connection(stub):
+    assert [_complete() for _ in range(3)] == ['hello'] * 3
+    assert len(stub.ports) == 3
+    assert len(set(stub.ports)) == 1
+
+def test_error_statuses_are_retried(stub):
+    stub.script = [(503, 0), (429, 0)]
+    assert _complete() == 'hello'
+    assert len(stub.ports) == 3
+
+def test_read_timeouts_are_not_retried(stub):
+    stub.script = [(200, 1.5)]
+    with pytest.raises(requests.exceptions.ReadTimeout):
+        _complete()
+    # The stub sleeps past the read timeout, wait for it before counting
+    time.sleep(1.2)
+    assert len(stub.ports) == 1